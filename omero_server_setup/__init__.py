@@ -1,16 +1,34 @@
-from .db import (
-    DB_UPTODATE,
-    DB_UPGRADE_NEEDED,
-    DB_INIT_NEEDED,
-    DB_NO_CONNECTION,
-    DbAdmin,
-    Stop,
-)
+import sys
+
 __all__ = [
     'DB_UPTODATE',
     'DB_UPGRADE_NEEDED',
     'DB_INIT_NEEDED',
     'DB_NO_CONNECTION',
+    'DB_UNREACHABLE',
     'DbAdmin',
+    'SchemaVersion',
     'Stop',
 ]
+
+if sys.version_info >= (3, 7):
+    # Load the database module on first use (PEP 562) so that lightweight
+    # modules such as omero_server_setup.check can be run without loading
+    # OMERO
+    def __getattr__(name):
+        if name in __all__:
+            from . import db
+            return getattr(db, name)
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+else:
+    from .db import (  # noqa: F401
+        DB_UPTODATE,
+        DB_UPGRADE_NEEDED,
+        DB_INIT_NEEDED,
+        DB_NO_CONNECTION,
+        DB_UNREACHABLE,
+        DbAdmin,
+        SchemaVersion,
+        Stop,
+    )
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Catalog and retention of physical base backups of a managed PostgreSQL
+server
+"""
+
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+import json
+import logging
+import os
+import re
+
+log = logging.getLogger(__name__)
+
+BACKUP_TYPES = ('full', 'incremental', 'differential')
+COMPRESSION = ('none', 'gzip', 'lz4', 'zstd')
+
+# Index of backups in the base backup directory
+INDEX = 'backups.json'
+
+# Default PostgreSQL WAL segment size
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# ISO 8601 date and optional time and UTC offset, as written by
+# datetime.isoformat
+TIME_REGEXP = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+def get_backup_dirs(backupdir):
+    """
+    Get the directories for base backups and archived WAL
+    """
+    return os.path.join(backupdir, 'base'), os.path.join(backupdir, 'wal')
+
+
+def read_index(basedir):
+    """
+    Read the list of backups, oldest first
+    """
+    try:
+        with open(os.path.join(basedir, INDEX)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def write_index(basedir, backups):
+    indexfile = os.path.join(basedir, INDEX)
+    with open(indexfile + '.tmp', 'w') as f:
+        json.dump(backups, f, indent=2, sort_keys=True)
+    os.replace(indexfile + '.tmp', indexfile)
+
+
+def wal_filename(timeline, lsn, segsize=WAL_SEGMENT_SIZE):
+    """
+    Get the name of the WAL segment containing a log sequence number
+    :param timeline: Timeline ID
+    :param lsn: Log sequence number in the form XXX/XXXXXXXX
+    """
+    hi, lo = (int(x, 16) for x in lsn.split('/'))
+    segments = 0x100000000 // segsize
+    segno = (hi << 32 | lo) // segsize
+    return '{:08X}{:08X}{:08X}'.format(
+        timeline, segno // segments, segno % segments)
+
+
+def read_manifest_start_wal(backuppath):
+    """
+    Get the first WAL segment required by a backup from its backup_manifest
+    """
+    with open(os.path.join(backuppath, 'backup_manifest')) as f:
+        manifest = json.load(f)
+    walrange = manifest['WAL-Ranges'][0]
+    return wal_filename(walrange['Timeline'], walrange['Start-LSN'])
+
+
+def find_backup(backups, label):
+    for b in backups:
+        if b['label'] == label:
+            return b
+    raise KeyError('Backup not found: {}'.format(label))
+
+
+def choose_parent(backups, backuptype):
+    """
+    Choose the backup an incremental or differential backup is based on:
+    the latest backup for incremental, the latest full backup for
+    differential
+    :return: The parent backup, or None if a full backup is required
+    """
+    if backuptype == 'full':
+        return None
+    for b in reversed(backups):
+        if backuptype == 'incremental' or b['type'] == 'full':
+            return b
+    return None
+
+
+def backup_chain(backups, label):
+    """
+    Get the list of backups required to restore a backup, starting with the
+    full backup
+    """
+    chain = [find_backup(backups, label)]
+    while chain[0]['parent']:
+        chain.insert(0, find_backup(backups, chain[0]['parent']))
+    return chain
+
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 time such as 2026-10-01T12:00:00+01:00. This is
+    equivalent to datetime.fromisoformat, which requires Python 3.7.
+    :return: A datetime, naive if there is no UTC offset
+    :raise ValueError: if the time is invalid
+    """
+    m = TIME_REGEXP.match(value.strip())
+    if not m:
+        raise ValueError('Invalid time: {}'.format(value))
+    year, month, day, hour, minute, second, fraction, offset = m.groups()
+    tz = None
+    if offset == 'Z':
+        tz = timezone.utc
+    elif offset:
+        sign = -1 if offset[0] == '-' else 1
+        digits = offset[1:].replace(':', '')
+        tz = timezone(sign * timedelta(
+            hours=int(digits[:2]), minutes=int(digits[2:])))
+    return datetime(
+        int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+        int(second or 0), int((fraction or '0').ljust(6, '0')), tz)
+
+
+def select_restore_backup(backups, target_time=None):
+    """
+    Choose the latest backup that finished before the recovery target
+    :param target_time: A datetime, or None for the latest backup
+    """
+    for b in reversed(backups):
+        if target_time is None or parse_time(b['time']) <= target_time:
+            return b
+    return None
+
+
+def select_expired(backups, keepfull):
+    """
+    Get the backups that are not needed to keep the latest keepfull full
+    backups and the incremental and differential backups based on them
+    """
+    fulls = [b['label'] for b in backups if b['type'] == 'full']
+    keep = set(fulls[-keepfull:]) if keepfull > 0 else set()
+    expired = []
+    for b in backups:
+        if backup_chain(backups, b['label'])[0]['label'] not in keep:
+            expired.append(b)
+    return expired
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
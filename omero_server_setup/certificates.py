@@ -1,80 +1,763 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-Wrap openssl to manage self-signed certificates
+Manage self-signed certificates using the cryptography package if it's
+installed, otherwise by wrapping openssl
 """
 
+from base64 import (
+    b64decode,
+    b64encode,
+)
+from concurrent.futures import ProcessPoolExecutor
+from datetime import (
+    datetime,
+    timedelta,
+)
+import hashlib
+import ipaddress
+import json
 import logging
 import os
+import re
+import shutil
+import tempfile
+import time
 from .external import (
     run,
     RunException,
 )
 
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import (
+        hashes,
+        serialization,
+    )
+    from cryptography.hazmat.primitives.asymmetric import (
+        ec,
+        ed25519,
+        rsa,
+    )
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    from cryptography.x509.oid import NameOID
+except ImportError:
+    x509 = None
+
 log = logging.getLogger(__name__)
 
+# Number of days before expiry at which certificates are regenerated
+DEFAULT_RENEW_DAYS = '30'
+# Number of days a new certificate is valid for
+DEFAULT_DAYS = '365'
+# Number of days a new local certificate authority is valid for
+DEFAULT_CA_DAYS = '3650'
+
+# Supported private key types, rsa is 2048 bit, ecdsa uses the P-256 curve
+KEY_TYPES = ('rsa', 'ecdsa', 'ed25519')
+DEFAULT_KEY_TYPE = 'rsa'
+
+BACKENDS = ('auto', 'cryptography', 'openssl')
+
+PEM_REGEXP = re.compile(
+    r'-----BEGIN ([A-Z ]+)-----\s+(.*?)\s+-----END \1-----', re.DOTALL)
+
+# Short names of the subject attributes accepted in ssl.certificate.owner
+SUBJECT_ATTRIBUTES = ('C', 'ST', 'L', 'O', 'OU', 'CN', 'emailAddress')
+
+# Hostnames that can be used for batch certificates, also used as directory
+# names so must not contain path separators
+HOSTNAME_REGEXP = re.compile(r'^[A-Za-z0-9*][A-Za-z0-9.:*_-]*$')
+
+
+def parse_subject(subject):
+    """
+    Split an openssl subject of the form /L=OMERO/O=OMERO.server/CN=localhost
+    into a list of (name, value) tuples
+    """
+    parsed = []
+    for part in subject.strip().split('/'):
+        if part:
+            name, sep, value = part.partition('=')
+            parsed.append((name.strip(), value.strip()))
+    return parsed
+
+
+def _pem_blocks(text, label):
+    """
+    Return the normalised base64 bodies of all PEM blocks with this label
+    """
+    return [''.join(m.group(2).split()) for m in PEM_REGEXP.finditer(text)
+            if m.group(1) == label]
+
+
+def _read_pem_blocks(path, label):
+    with open(path) as f:
+        return _pem_blocks(f.read(), label)
+
+
+def _openssl_keytype(text):
+    """
+    Return the key type from openssl's text description of a public key
+    """
+    if 'ED25519' in text:
+        return 'ed25519'
+    if 'prime256v1' in text:
+        return 'ecdsa'
+    if 'Modulus' in text:
+        return 'rsa'
+    return 'unknown'
+
+
+def certificate_fingerprint(certificate):
+    """
+    Return the SHA256 fingerprint of a certificate returned by
+    CertificateBackend.read_certificate
+    """
+    digest = hashlib.sha256(b64decode(certificate[0])).hexdigest().upper()
+    return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+
+def read_hosts(hostsfile):
+    """
+    Read a file of hostnames, one per line. Blank lines and comments
+    starting with # are ignored.
+    """
+    hosts = []
+    with open(hostsfile) as f:
+        for line in f:
+            host = line.split('#', 1)[0].strip()
+            if not host:
+                continue
+            if not HOSTNAME_REGEXP.match(host):
+                raise Exception('Invalid hostname: {}'.format(host))
+            if host not in hosts:
+                hosts.append(host)
+    return hosts
+
+
+def _subject_alt_name(hostname):
+    try:
+        return 'IP', ipaddress.ip_address(hostname)
+    except ValueError:
+        return 'DNS', hostname
+
+
+class CertificateBackend(object):
+    """
+    Base class for reading and creating keys and certificates.
+    Certificates and public keys are compared as base64 encoded DER.
+    """
+
+    name = None
+
+    def read_certificate(self, certpath):
+        """
+        Return a dictionary of the subject, expiry date and public key of an
+        existing certificate, and the certificate itself
+        """
+        raise NotImplementedError()
+
+    def read_key(self, keypath):
+        """
+        Return the key type and public key of a private key
+        """
+        raise NotImplementedError()
+
+    def read_pkcs12(self, pkcs12path, password):
+        """
+        Return the certificate in a PKCS12 bundle
+        """
+        raise NotImplementedError()
+
+    def read_pkcs12_with_key(self, pkcs12path, password):
+        """
+        Return the certificate and the private key in a PKCS12 bundle. The
+        key is None unless it can be read without extra work, see
+        OpensslBackend.
+        """
+        return self.read_pkcs12(pkcs12path, password), None
+
+    def create_key(self, keypath, keytype):
+        raise NotImplementedError()
+
+    def create_certificate(self, keypath, certpath, subject, days,
+                           ca=None, hostname=None):
+        """
+        Create a self-signed CA certificate, or if ca is a tuple of
+        (CA key path, CA certificate path) a certificate for hostname signed
+        by that CA
+        """
+        raise NotImplementedError()
+
+    def create_pkcs12(self, keypath, certpath, pkcs12path, password,
+                      cacertpath=None):
+        raise NotImplementedError()
+
+    def check(self, keypath, certpath, pkcs12path, subject, password,
+              renewdays, keytype=DEFAULT_KEY_TYPE):
+        """
+        Check whether existing certificates can be reused.
+        Returns None if they are valid, otherwise a string describing why
+        they must be regenerated.
+        If pkcs12path is None the PKCS12 bundle is not checked.
+        """
+        for path in (keypath, certpath, pkcs12path):
+            if path and not os.path.exists(path):
+                return '{} not found'.format(path)
+        try:
+            info = self.read_certificate(certpath)
+        except (RunException, ValueError) as e:
+            log.debug(e)
+            return 'unable to read certificate {}'.format(certpath)
+
+        if info.get('subject') != parse_subject(subject):
+            return 'subject changed: {} → {}'.format(
+                info.get('subject'), subject)
+
+        renewafter = datetime.utcnow() + timedelta(days=renewdays)
+        if 'notafter' not in info or info['notafter'] < renewafter:
+            return 'certificate expires {}, renewal window {} days'.format(
+                info.get('notafter'), renewdays)
+
+        bundledkey = None
+        if pkcs12path:
+            try:
+                bundled, bundledkey = self.read_pkcs12_with_key(
+                    pkcs12path, password)
+            except (RunException, ValueError) as e:
+                log.debug(e)
+                return ('unable to read PKCS12 bundle {}, '
+                        'password changed?'.format(pkcs12path))
+            if bundled != info['certificate']:
+                return 'PKCS12 bundle does not match certificate'
+
+        try:
+            if bundledkey and bundledkey == _read_pem_blocks(
+                    keypath, 'PRIVATE KEY'):
+                # The bundle can only contain the key for its certificate
+                existingtype, keypub = info['keytype'], info['pubkey']
+            else:
+                existingtype, keypub = self.read_key(keypath)
+        except (OSError, RunException, ValueError) as e:
+            log.debug(e)
+            return 'unable to read key {}'.format(keypath)
+        if existingtype != keytype:
+            return 'key type changed: {} → {}'.format(existingtype, keytype)
+        if not keypub or keypub != info['pubkey']:
+            return 'key changed: {}'.format(keypath)
+        return None
+
+
+class OpensslBackend(CertificateBackend):
+    """
+    Create and read certificates by running openssl. Each file is read by a
+    single openssl command, and checking existing certificates usually
+    runs openssl twice.
+    """
+
+    name = 'openssl'
+
+    def __init__(self):
+        if not shutil.which('openssl'):
+            log.fatal('openssl not found, is it installed?')
+            raise FileNotFoundError('openssl not found')
+
+    def _openssl(self, args):
+        stdout, stderr = run('openssl', args, capturestd=True)
+        if stderr:
+            log.debug('openssl stderr: %s', stderr)
+        return stdout.decode()
+
+    def read_certificate(self, certpath):
+        # Without -noout the certificate itself is also printed
+        out = self._openssl([
+            'x509', '-in', certpath,
+            '-subject', '-issuer', '-enddate', '-pubkey', '-text',
+            '-nameopt', 'compat',
+        ])
+        info = {}
+        for line in out.splitlines():
+            k, sep, v = line.partition('=')
+            if k in ('subject', 'issuer'):
+                info[k] = parse_subject(v)
+            elif k == 'notAfter':
+                info['notafter'] = datetime.strptime(
+                    v.strip(), '%b %d %H:%M:%S %Y %Z')
+        keyinfo = out.partition('Subject Public Key Info:')[2]
+        info['keytype'] = _openssl_keytype(
+            keyinfo.partition('Signature Algorithm')[0])
+        info['pubkey'] = _pem_blocks(out, 'PUBLIC KEY')
+        info['certificate'] = _pem_blocks(out, 'CERTIFICATE')
+        return info
+
+    def read_key(self, keypath):
+        out = self._openssl(['pkey', '-in', keypath, '-pubout', '-text_pub'])
+        return _openssl_keytype(out), _pem_blocks(out, 'PUBLIC KEY')
+
+    def read_pkcs12(self, pkcs12path, password):
+        return self.read_pkcs12_with_key(pkcs12path, password)[0]
+
+    def read_pkcs12_with_key(self, pkcs12path, password):
+        out = self._openssl([
+            'pkcs12', '-in', pkcs12path, '-nodes', '-clcerts',
+            '-passin', 'pass:{}'.format(password),
+        ])
+        return (_pem_blocks(out, 'CERTIFICATE'),
+                _pem_blocks(out, 'PRIVATE KEY'))
+
+    def create_key(self, keypath, keytype):
+        if keytype == 'rsa':
+            run('openssl', ['genrsa', '-out', keypath, '2048'])
+        elif keytype == 'ecdsa':
+            run('openssl', [
+                'genpkey', '-algorithm', 'EC',
+                '-pkeyopt', 'ec_paramgen_curve:P-256', '-out', keypath])
+        elif keytype == 'ed25519':
+            run('openssl', [
+                'genpkey', '-algorithm', 'ED25519', '-out', keypath])
+        else:
+            raise Exception('Invalid key type: {}'.format(keytype))
 
-def create_certificates(external):
+    def create_certificate(self, keypath, certpath, subject, days,
+                           ca=None, hostname=None):
+        if not ca:
+            run('openssl', [
+                'req', '-new', '-x509',
+                '-subj', subject,
+                '-days', str(days),
+                '-key', keypath, '-out', certpath,
+                '-extensions', 'v3_ca',
+            ])
+            return
+
+        cakeypath, cacertpath = ca
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csrpath = os.path.join(tmpdir, 'server.csr')
+            extpath = os.path.join(tmpdir, 'server.ext')
+            with open(extpath, 'w') as f:
+                f.write('basicConstraints=critical,CA:FALSE\n')
+                f.write('subjectKeyIdentifier=hash\n')
+                f.write('authorityKeyIdentifier=keyid\n')
+                if hostname:
+                    f.write('subjectAltName={}:{}\n'.format(
+                        *_subject_alt_name(hostname)))
+            run('openssl', [
+                'req', '-new', '-subj', subject,
+                '-key', keypath, '-out', csrpath,
+            ])
+            run('openssl', [
+                'x509', '-req', '-in', csrpath,
+                '-CA', cacertpath, '-CAkey', cakeypath,
+                '-set_serial', '0x' + os.urandom(16).hex(),
+                '-days', str(days),
+                '-extfile', extpath, '-out', certpath,
+            ])
+
+    def create_pkcs12(self, keypath, certpath, pkcs12path, password,
+                      cacertpath=None):
+        args = [
+            'pkcs12', '-export',
+            '-out', pkcs12path,
+            '-inkey', keypath,
+            '-in', certpath,
+            '-name', 'server',
+            '-password', 'pass:{}'.format(password),
+        ]
+        if cacertpath:
+            args += ['-certfile', cacertpath]
+        run('openssl', args)
+
+
+class CryptographyBackend(CertificateBackend):
+    """
+    Create and read certificates in-process without running openssl
+    """
+
+    name = 'cryptography'
+
+    def __init__(self):
+        if x509 is None:
+            raise Exception('cryptography package not installed')
+        self.oids = dict((name, getattr(NameOID, attr)) for name, attr in (
+            ('C', 'COUNTRY_NAME'),
+            ('ST', 'STATE_OR_PROVINCE_NAME'),
+            ('L', 'LOCALITY_NAME'),
+            ('O', 'ORGANIZATION_NAME'),
+            ('OU', 'ORGANIZATIONAL_UNIT_NAME'),
+            ('CN', 'COMMON_NAME'),
+            ('emailAddress', 'EMAIL_ADDRESS'),
+        ))
+        self.names = dict((v, k) for (k, v) in self.oids.items())
+
+    @staticmethod
+    def _der_b64(obj):
+        if isinstance(obj, x509.Certificate):
+            der = obj.public_bytes(serialization.Encoding.DER)
+        else:
+            der = obj.public_bytes(
+                serialization.Encoding.DER,
+                serialization.PublicFormat.SubjectPublicKeyInfo)
+        return [b64encode(der).decode()]
+
+    @staticmethod
+    def _keytype(key):
+        if isinstance(key, rsa.RSAPrivateKey):
+            return 'rsa'
+        if isinstance(key, ec.EllipticCurvePrivateKey) and (
+                key.curve.name == 'secp256r1'):
+            return 'ecdsa'
+        if isinstance(key, ed25519.Ed25519PrivateKey):
+            return 'ed25519'
+        return 'unknown'
+
+    def _load_key(self, keypath):
+        with open(keypath, 'rb') as f:
+            pem = f.read()
+        # RSA key validation is slow and unnecessary for our own keys
+        try:
+            return serialization.load_pem_private_key(
+                pem, None, unsafe_skip_rsa_key_validation=True)
+        except TypeError:
+            return serialization.load_pem_private_key(pem, None)
+
+    def _name(self, name):
+        return [(self.names.get(a.oid, a.oid.dotted_string), a.value)
+                for a in name]
+
+    def _load_certificate(self, certpath):
+        with open(certpath, 'rb') as f:
+            return x509.load_pem_x509_certificate(f.read())
+
+    def read_certificate(self, certpath):
+        cert = self._load_certificate(certpath)
+        notafter = getattr(cert, 'not_valid_after_utc', None)
+        if notafter is None:
+            notafter = cert.not_valid_after
+        return {
+            'subject': self._name(cert.subject),
+            'issuer': self._name(cert.issuer),
+            'notafter': notafter.replace(tzinfo=None),
+            'pubkey': self._der_b64(cert.public_key()),
+            'certificate': self._der_b64(cert),
+        }
+
+    def read_key(self, keypath):
+        key = self._load_key(keypath)
+        return self._keytype(key), self._der_b64(key.public_key())
+
+    def read_pkcs12(self, pkcs12path, password):
+        with open(pkcs12path, 'rb') as f:
+            key, cert, additional = pkcs12.load_key_and_certificates(
+                f.read(), password.encode())
+        if cert is None:
+            return []
+        return self._der_b64(cert)
+
+    def create_key(self, keypath, keytype):
+        if keytype == 'rsa':
+            key = rsa.generate_private_key(
+                public_exponent=65537, key_size=2048)
+        elif keytype == 'ecdsa':
+            key = ec.generate_private_key(ec.SECP256R1())
+        elif keytype == 'ed25519':
+            key = ed25519.Ed25519PrivateKey.generate()
+        else:
+            raise Exception('Invalid key type: {}'.format(keytype))
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption())
+        fd = os.open(keypath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem)
+
+    def _x509_name(self, subject):
+        try:
+            return x509.Name([x509.NameAttribute(self.oids[k], v)
+                              for (k, v) in parse_subject(subject)])
+        except KeyError as e:
+            raise Exception('Unsupported subject attribute {}, expected '
+                            'one of {}'.format(e, SUBJECT_ATTRIBUTES))
+
+    def create_certificate(self, keypath, certpath, subject, days,
+                           ca=None, hostname=None):
+        key = self._load_key(keypath)
+        name = self._x509_name(subject)
+        ski = x509.SubjectKeyIdentifier.from_public_key(key.public_key())
+        if ca:
+            signingkey = self._load_key(ca[0])
+            cacert = self._load_certificate(ca[1])
+            issuer = cacert.subject
+            aki = x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                cacert.public_key())
+        else:
+            signingkey = key
+            issuer = name
+            aki = x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                key.public_key())
+        now = datetime.utcnow()
+        cert = x509.CertificateBuilder().subject_name(
+            name
+        ).issuer_name(
+            issuer
+        ).public_key(
+            key.public_key()
+        ).serial_number(
+            x509.random_serial_number()
+        ).not_valid_before(
+            now
+        ).not_valid_after(
+            now + timedelta(days=int(days))
+        ).add_extension(
+            ski, critical=False
+        ).add_extension(
+            aki, critical=False
+        ).add_extension(
+            x509.BasicConstraints(ca=not ca, path_length=None), critical=True
+        )
+        if hostname:
+            kind, value = _subject_alt_name(hostname)
+            if kind == 'IP':
+                altname = x509.IPAddress(value)
+            else:
+                altname = x509.DNSName(value)
+            cert = cert.add_extension(
+                x509.SubjectAlternativeName([altname]), critical=False)
+        # Ed25519 signatures don't take a separate digest
+        algorithm = None
+        if not isinstance(signingkey, ed25519.Ed25519PrivateKey):
+            algorithm = hashes.SHA256()
+        cert = cert.sign(signingkey, algorithm)
+        with open(certpath, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+    def create_pkcs12(self, keypath, certpath, pkcs12path, password,
+                      cacertpath=None):
+        key = self._load_key(keypath)
+        cert = self._load_certificate(certpath)
+        cas = None
+        if cacertpath:
+            cas = [self._load_certificate(cacertpath)]
+        data = pkcs12.serialize_key_and_certificates(
+            b'server', key, cert, cas,
+            serialization.BestAvailableEncryption(password.encode()))
+        with open(pkcs12path, 'wb') as f:
+            f.write(data)
+
+
+def get_backend(name='auto'):
+    """
+    Get a certificate backend, auto uses cryptography if it's installed and
+    falls back to openssl
+    """
+    if name == 'auto':
+        name = 'openssl' if x509 is None else 'cryptography'
+    if name == 'cryptography':
+        return CryptographyBackend()
+    if name == 'openssl':
+        return OpensslBackend()
+    raise Exception('Invalid certificate backend: {}'.format(name))
+
+
+def _create_key(backend, keypath, keytype):
+    """
+    Create a private key unless one of the required type already exists
+    """
+    existingtype = None
+    if os.path.exists(keypath):
+        try:
+            existingtype, keypub = backend.read_key(keypath)
+        except (RunException, ValueError) as e:
+            log.warning('Unable to read existing key %s: %s', keypath, e)
+    if existingtype == keytype:
+        log.info('Using existing key: %s', keypath)
+    else:
+        log.info('Creating %s key: %s', keytype, keypath)
+        backend.create_key(keypath, keytype)
+
+
+def _get_certificate_config(external, local=True):
+    """
+    Get the certificate configuration, if local is False only the
+    configuration required for issuing host certificates is checked
+    """
     cfgmap = external.get_config()
 
-    def getcfg(key):
+    def getcfg(key, default=None):
         if not cfgmap.get(key):
+            if default is not None:
+                return default
             raise Exception('Property {} required'.format(key))
         log.debug('%s=%s', key, cfgmap[key])
         return cfgmap[key]
 
-    enabled = getcfg('setup.omero.certificates').lower()
-    if enabled != 'true':
+    enabled = getcfg(
+        'setup.omero.certificates', None if local else 'false'
+    ).lower() == 'true'
+    if local and not enabled:
+        return {'enabled': False}
+    cfg = {
+        'enabled': enabled,
+        'owner': getcfg('ssl.certificate.owner'),
+        'days': int(getcfg('ssl.certificate.days', DEFAULT_DAYS)),
+        'renewdays': int(getcfg(
+            'ssl.certificate.renewdays', DEFAULT_RENEW_DAYS)),
+        'keytype': getcfg('ssl.certificate.keytype', DEFAULT_KEY_TYPE),
+        'password': getcfg('omero.glacier2.IceSSL.Password'),
+    }
+    if cfg['keytype'] not in KEY_TYPES:
+        raise Exception('Invalid ssl.certificate.keytype {}, expected one '
+                        'of {}'.format(cfg['keytype'], KEY_TYPES))
+    if local:
+        certdir = getcfg('omero.glacier2.IceSSL.DefaultDir')
+        cfg.update({
+            'certdir': certdir,
+            'cn': getcfg('ssl.certificate.commonname'),
+            'pkcs12path': os.path.join(
+                certdir, getcfg('omero.glacier2.IceSSL.CertFile')),
+            'keypath': os.path.join(certdir, getcfg('ssl.certificate.key')),
+            'certpath': os.path.join(
+                certdir, getcfg('omero.glacier2.IceSSL.CAs')),
+        })
+    return cfg
+
+
+def create_certificates(external, force=False, backend='auto'):
+    cfg = _get_certificate_config(external)
+    if not cfg['enabled']:
         log.warning('setup.omero.certificates is false, not doing anything')
         return
 
-    certdir = getcfg('omero.glacier2.IceSSL.DefaultDir')
+    certdir = cfg['certdir']
+    keypath = cfg['keypath']
+    certpath = cfg['certpath']
+    pkcs12path = cfg['pkcs12path']
+    password = cfg['password']
+    subject = '{}/CN={}'.format(cfg['owner'], cfg['cn'])
 
-    cn = getcfg('ssl.certificate.commonname')
-    owner = getcfg('ssl.certificate.owner')
-    days = '365'
-    pkcs12path = os.path.join(
-        certdir, getcfg('omero.glacier2.IceSSL.CertFile'))
-    keypath = os.path.join(certdir, getcfg('ssl.certificate.key'))
-    certpath = os.path.join(certdir, getcfg('omero.glacier2.IceSSL.CAs'))
-    password = getcfg('omero.glacier2.IceSSL.Password')
+    start = time.time()
+    backend = get_backend(backend)
+    log.info('Certificate backend: %s', backend.name)
 
-    try:
-        stdout, stderr = run('openssl', ['version'], capturestd=True)
-    except FileNotFoundError:
-        log.fatal('openssl not found, is it installed?')
-        raise
-    except RunException:
-        log.fatal('openssl failed')
-        raise
-    if stderr:
-        log.warning('openssl: %s', stderr)
-    log.info('openssl version: %s', stdout.strip().decode())
+    if force:
+        log.info('Forcing regeneration of certificates')
+    else:
+        reason = backend.check(
+            keypath, certpath, pkcs12path, subject, password,
+            cfg['renewdays'], cfg['keytype'])
+        if reason is None:
+            log.info('Existing certificates are valid: %s [%.3f s]',
+                     certpath, time.time() - start)
+            return
+        log.info('Regenerating certificates: %s', reason)
 
     os.makedirs(certdir, exist_ok=True)
 
     # Private key
-    if os.path.exists(keypath):
-        log.info('Using existing key: %s', keypath)
-    else:
-        log.info('Creating self-signed CA key: %s', keypath)
-        run('openssl', ['genrsa', '-out', keypath, '2048'])
+    _create_key(backend, keypath, cfg['keytype'])
     # Self-signed certificate
     log.info('Creating self-signed certificate: %s', certpath)
-    run('openssl', [
-        'req', '-new', '-x509',
-        '-subj', '{}/CN={}'.format(owner, cn),
-        '-days', days,
-        '-key', keypath, '-out', certpath,
-        '-extensions', 'v3_ca',
-    ])
+    backend.create_certificate(keypath, certpath, subject, cfg['days'])
     # PKCS12 format
     log.info('Creating PKCS12 bundle: %s', pkcs12path)
-    run('openssl', [
-        'pkcs12', '-export',
-        '-out', pkcs12path,
-        '-inkey', keypath,
-        '-in', certpath,
-        '-name', 'server',
-        '-password', 'pass:{}'.format(password),
-    ])
+    backend.create_pkcs12(keypath, certpath, pkcs12path, password)
+    log.info('Created certificates [%.3f s]', time.time() - start)
+
+
+def _manifest_entry(backend, certpath, **kwargs):
+    info = backend.read_certificate(certpath)
+    entry = {
+        'certificate': certpath,
+        'fingerprint': certificate_fingerprint(info['certificate']),
+        'notafter': info['notafter'].isoformat() + 'Z',
+    }
+    entry.update(kwargs)
+    return entry
+
+
+def issue_host_certificate(backendname, hostdir, host, subject, keytype,
+                           days, renewdays, password, ca, casubject, force):
+    """
+    Create or reuse the key, certificate and PKCS12 bundle for a single
+    host signed by a local CA, and return its manifest entry.
+    This is run in a separate process by create_host_certificates.
+    """
+    backend = get_backend(backendname)
+    keypath = os.path.join(hostdir, 'server.key')
+    certpath = os.path.join(hostdir, 'server.pem')
+    pkcs12path = os.path.join(hostdir, 'server.p12')
+
+    if force:
+        reason = 'forced'
+    else:
+        reason = backend.check(
+            keypath, certpath, pkcs12path, subject, password, renewdays,
+            keytype)
+    if reason is None and (
+            backend.read_certificate(certpath).get('issuer') != casubject):
+        reason = 'not issued by current CA'
+    if reason:
+        log.info('Issuing certificate for %s: %s', host, reason)
+        os.makedirs(hostdir, exist_ok=True)
+        _create_key(backend, keypath, keytype)
+        backend.create_certificate(
+            keypath, certpath, subject, days, ca=ca, hostname=host)
+        backend.create_pkcs12(
+            keypath, certpath, pkcs12path, password, cacertpath=ca[1])
+    else:
+        log.info('Existing certificate for %s is valid', host)
+    return _manifest_entry(
+        backend, certpath, host=host, key=keypath, pkcs12=pkcs12path,
+        issued=bool(reason))
+
+
+def create_host_certificates(external, hostsfile, cadir, force=False,
+                             backend='auto', jobs=None):
+    """
+    Create or reuse a local certificate authority in cadir, and use it to
+    issue certificates for every host in hostsfile in parallel.
+    Host certificates are written to cadir/hosts/HOST/, and a manifest of
+    fingerprints and expiry dates to cadir/manifest.json.
+    Returns the manifest.
+    """
+    cfg = _get_certificate_config(external, local=False)
+    hosts = read_hosts(hostsfile)
+    start = time.time()
+    backend = get_backend(backend)
+    log.info('Certificate backend: %s', backend.name)
+
+    os.makedirs(cadir, exist_ok=True)
+    cakeypath = os.path.join(cadir, 'ca.key')
+    cacertpath = os.path.join(cadir, 'ca.pem')
+    casubject = '{}/CN=OMERO CA'.format(cfg['owner'])
+    reason = 'forced' if force else backend.check(
+        cakeypath, cacertpath, None, casubject, None, cfg['renewdays'],
+        cfg['keytype'])
+    if reason:
+        log.info('Creating local CA %s: %s', cacertpath, reason)
+        _create_key(backend, cakeypath, cfg['keytype'])
+        backend.create_certificate(
+            cakeypath, cacertpath, casubject, DEFAULT_CA_DAYS)
+    else:
+        log.info('Using existing local CA: %s', cacertpath)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(
+            issue_host_certificate, backend.name,
+            os.path.join(cadir, 'hosts', host), host,
+            '{}/CN={}'.format(cfg['owner'], host), cfg['keytype'],
+            cfg['days'], cfg['renewdays'], cfg['password'],
+            (cakeypath, cacertpath), parse_subject(casubject), bool(reason))
+            for host in hosts]
+        entries = [f.result() for f in futures]
+
+    manifest = {
+        'ca': _manifest_entry(backend, cacertpath, issued=bool(reason)),
+        'hosts': entries,
+    }
+    with open(os.path.join(cadir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    log.info('Issued %d certificates [%.3f s]', sum(
+        e['issued'] for e in entries), time.time() - start)
+    return manifest
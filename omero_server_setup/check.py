@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fast database readiness check, for example for Kubernetes probes.
+
+Only the standard library is imported so that this can be run as
+python -m omero_server_setup.check without loading OMERO.
+"""
+
+from argparse import ArgumentParser
+from glob import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from xml.etree.ElementTree import parse
+
+# Exit codes for db upgrade --dry-run (also used internally)
+DB_UPTODATE = 0
+DB_UPGRADE_NEEDED = 2
+DB_INIT_NEEDED = 3
+DB_NO_CONNECTION = 4
+DB_UNREACHABLE = 5
+
+# Defaults for database connection checks: seconds to wait for each
+# connection, number of retries if the server is unreachable, and initial
+# and maximum seconds between retries
+CONNECT_TIMEOUT = 10
+CONNECT_RETRIES = 3
+CONNECT_BACKOFF = 1
+CONNECT_BACKOFF_MAX = 30
+
+# Substrings of libpq error messages identifying the cause of a failed
+# connection
+CONNECTION_ERRORS = (
+    ('dns', ('could not translate host name',)),
+    ('refused', ('Connection refused', 'No such file or directory')),
+    ('timeout', ('timeout expired', 'Connection timed out')),
+    ('starting', ('the database system is starting up',
+                  'the database system is shutting down',
+                  'the database system is in recovery mode')),
+    ('auth', ('password authentication failed', 'no password supplied',
+              'authentication failed', 'no pg_hba.conf entry', 'role "')),
+    ('database', ('database "',)),
+)
+
+# Failures that may be temporary, and are retried
+TRANSIENT_CONNECTION_ERRORS = ('dns', 'refused', 'timeout', 'starting')
+
+CHECK_STATUS = {
+    DB_UPTODATE: 'uptodate',
+    DB_UPGRADE_NEEDED: 'upgrade_needed',
+    DB_INIT_NEEDED: 'init_needed',
+    DB_NO_CONNECTION: 'no_connection',
+    DB_UNREACHABLE: 'unreachable',
+}
+
+# Same defaults as DbAdmin.get_config_with_defaults
+DB_DEFAULTS = {
+    'omero.db.name': 'omero',
+    'omero.db.host': 'localhost',
+    'omero.db.port': '5432',
+    'omero.db.user': 'omero',
+    'omero.db.pass': 'omero',
+}
+
+CHECK_QUERY = ('SELECT currentversion, currentpatch FROM dbpatch '
+               'ORDER BY id DESC LIMIT 1')
+
+
+def classify_connection_error(stderr):
+    """
+    Get the cause of a failed connection from the psql error message, one
+    of the kinds in CONNECTION_ERRORS or unknown
+    """
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode(errors='replace')
+    for kind, messages in CONNECTION_ERRORS:
+        if any(m in (stderr or '') for m in messages):
+            return kind
+    return 'unknown'
+
+
+def read_config(omerodir):
+    """
+    Read the properties of the active profile in etc/grid/config.xml
+    without loading OMERO
+    """
+    configxml = os.path.join(omerodir, 'etc', 'grid', 'config.xml')
+    try:
+        root = parse(configxml).getroot()
+    except FileNotFoundError:
+        return {}
+    profiles = {}
+    for properties in root.findall('properties'):
+        profiles[properties.get('id')] = dict(
+            (p.get('name'), p.get('value'))
+            for p in properties.findall('property'))
+    profile = os.getenv('OMERO_CONFIG') or profiles.get(
+        '__ACTIVE__', {}).get('omero.config.profile') or 'default'
+    return profiles.get(profile, {})
+
+
+def check_database(omerodir, overrides=None, use_config=True,
+                   timeout=CONNECT_TIMEOUT):
+    """
+    Check whether the database is ready using a single connection
+    :param overrides: Dictionary of omero.db.* properties used if they are
+           not in the OMERO configuration
+    :param use_config: If False ignore the OMERO configuration
+    :return: A dictionary of the DB_* code as rc, its name as status, the
+             database version if known, and the seconds taken. If the
+             connection failed also the cause and message.
+    """
+    config = read_config(omerodir) if use_config else {}
+    cfg = {}
+    for key, default in DB_DEFAULTS.items():
+        if key in config:
+            cfg[key] = config[key]
+        elif overrides and overrides.get(key) is not None:
+            cfg[key] = overrides[key]
+        else:
+            cfg[key] = default
+
+    # Connect to PostgreSQL directly if OMERO.server uses a pooler
+    if config.get('postgres.port'):
+        cfg['omero.db.port'] = config['postgres.port']
+    socketdir = config.get('postgres.socket.dir')
+    if socketdir and os.path.exists(os.path.join(
+            socketdir, '.s.PGSQL.' + cfg['omero.db.port'])):
+        cfg['omero.db.host'] = socketdir
+
+    env = os.environ.copy()
+    env['PGPASSWORD'] = cfg['omero.db.pass']
+    env['PGCONNECT_TIMEOUT'] = str(timeout)
+    env['PGAPPNAME'] = 'omero-setup-check'
+    args = [
+        'psql', '-v', 'ON_ERROR_STOP=on', '-w', '-A', '-t',
+        '-h', cfg['omero.db.host'],
+        '-p', cfg['omero.db.port'],
+        '-U', cfg['omero.db.user'],
+        '-d', cfg['omero.db.name'],
+        '-c', CHECK_QUERY,
+    ]
+    result = {'version': None}
+    start = time.time()
+    try:
+        p = subprocess.run(
+            args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        p = None
+        result.update({'error': 'psql', 'message': str(e)})
+    result['seconds'] = time.time() - start
+
+    if p is None:
+        rc = DB_NO_CONNECTION
+    elif p.returncode == 2:
+        # psql exit code 2 is a connection failure
+        stderr = p.stderr.decode(errors='replace')
+        kind = classify_connection_error(stderr)
+        rc = (DB_UNREACHABLE if kind in TRANSIENT_CONNECTION_ERRORS
+              else DB_NO_CONNECTION)
+        result.update({'error': kind, 'message': stderr.strip()})
+    else:
+        row = p.stdout.decode().strip()
+        if p.returncode or not row:
+            rc = DB_INIT_NEEDED
+        else:
+            result['version'] = '__'.join(row.split('|'))
+            upgrades = glob(os.path.join(
+                omerodir, 'sql', 'psql', 'OMERO*',
+                result['version'] + '.sql'))
+            rc = DB_UPGRADE_NEEDED if upgrades else DB_UPTODATE
+    result.update({'rc': rc, 'status': CHECK_STATUS[rc]})
+    return result
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=(
+        'Check whether the OMERO database is ready and print the result as '
+        'JSON. Exits with code {}'.format(', '.join(
+            '{}:{}'.format(k, v) for k, v in sorted(CHECK_STATUS.items())))))
+    parser.add_argument(
+        '--omerodir', default=os.getenv('OMERODIR'),
+        help='OMERO.server directory, default $OMERODIR')
+    parser.add_argument(
+        '--timeout', type=int, default=CONNECT_TIMEOUT,
+        help='Seconds to wait for the database connection')
+    args = parser.parse_args(argv)
+    if not args.omerodir:
+        parser.error('OMERODIR not set')
+    result = check_database(args.omerodir, timeout=args.timeout)
+    print(json.dumps(result, sort_keys=True))
+    return result['rc']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
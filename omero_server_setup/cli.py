@@ -1,23 +1,56 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+import json
 import logging
 import os
+import traceback
 from omero.cli import BaseControl
-from .certificates import create_certificates
+from .basebackup import (
+    BACKUP_TYPES,
+    COMPRESSION,
+)
+from .certificates import (
+    BACKENDS,
+    KEY_TYPES,
+    create_certificates,
+    create_host_certificates,
+)
+from .check import check_database
 from .createconfig import CreateConfig
 from .db import (
+    CONNECT_BACKOFF,
+    CONNECT_RETRIES,
+    CONNECT_TIMEOUT,
     DbAdmin,
     DB_INIT_NEEDED,
     DB_NO_CONNECTION,
+    DB_UNREACHABLE,
     DB_UPGRADE_NEEDED,
     DB_UPTODATE,
     Stop,
 )
-from .external import External
+from .external import (
+    External,
+    RunException,
+)
+from .postmaster import STOP_MODES
+from .serve import (
+    SOCKET_NAME,
+    get_socket_path,
+    serve,
+)
+from .status import (
+    STATUS_FORMATS,
+    STATUS_TOP_TABLES,
+)
 
 DEFAULT_LOGLEVEL = logging.WARNING
 
+log = logging.getLogger(__name__)
+
 
 def _omerodir():
     omerodir = os.getenv('OMERODIR')
@@ -69,11 +102,24 @@ class SetupControl(BaseControl):
                 "{}:upgrade required "
                 "{}:database isn't initialised "
                 "{}:unable to connect to database "
+                "{}:database server unreachable "
                 "{}:database is up-to-date.".format(
                     DB_UPGRADE_NEEDED,
                     DB_INIT_NEEDED,
                     DB_NO_CONNECTION,
+                    DB_UNREACHABLE,
                     DB_UPTODATE)))
+        db_parser.add_argument(
+            '--connect-timeout', type=int, default=CONNECT_TIMEOUT,
+            help="Seconds to wait for each database connection attempt")
+        db_parser.add_argument(
+            '--connect-retries', type=int, default=CONNECT_RETRIES, help=(
+                "Number of times to retry connecting if the database server "
+                "is unreachable"))
+        db_parser.add_argument(
+            '--connect-backoff', type=float, default=CONNECT_BACKOFF, help=(
+                "Initial seconds between connection retries, doubled after "
+                "each attempt with random jitter"))
 
         omerosql_parser = ArgumentParser(add_help=False)
         omerosql_parser.add_argument(
@@ -99,6 +145,18 @@ class SetupControl(BaseControl):
         parser_createconfig.add_argument(
             '--manage-postgres', action='store_true',
             help='Manage a local PostgreSQL server for OMERO only')
+        parser_createconfig.add_argument(
+            '--pooler', action='store_true', help=(
+                'Run PgBouncer between OMERO.server and the managed '
+                'PostgreSQL server, requires --manage-postgres'))
+        parser_createconfig.add_argument(
+            '--db-poolsize', default=None, help=(
+                'OMERO.server database connection pool size, default based '
+                'on --db-concurrency and the number of CPUs of this host'))
+        parser_createconfig.add_argument(
+            '--db-concurrency', type=int, default=None, help=(
+                'Expected number of concurrent OMERO requests using the '
+                'database, used to size the connection pool'))
         parser_createconfig.add_argument(
             '--data-dir', default=None, help=(
                 'OMERO data directory, use "auto" to use $CONDA_PREFIX/OMERO '
@@ -106,6 +164,13 @@ class SetupControl(BaseControl):
         parser_createconfig.add_argument(
             '--no-certificates', action='store_true',
             help='Disable self-signed certs, use anonymous DH instead')
+        parser_createconfig.add_argument(
+            '--cert-key-type', choices=KEY_TYPES, default=None, help=(
+                'Type of private key for self-signed certs, ecdsa and '
+                'ed25519 are faster but may not be supported by all clients'))
+        parser_createconfig.add_argument(
+            '--cert-days', default=None,
+            help='Number of days self-signed certs are valid for')
         parser_createconfig.add_argument(
             '--no-websockets', action='store_true',
             help='Disable websockets and enable insecure connections')
@@ -126,17 +191,176 @@ class SetupControl(BaseControl):
             'Initialise a database')
 
         _subparser(
-            sub, 'upgrade', self.execute, [common_parser, db_parser],
+            sub, 'check', self.check, [common_parser, db_parser],
+            'Check whether the database is ready using a single connection. '
+            'Prints the result as JSON and exits with the same codes as '
+            'upgrade --dry-run. python -m omero_server_setup.check is '
+            'faster since it does not load OMERO.')
+
+        parser_upgrade = _subparser(
+            sub, 'upgrade', self.execute,
+            [common_parser, db_parser, pgadmin_parser],
             'Upgrade a database')
+        parser_upgrade.add_argument(
+            '--estimate', action='store_true', help=(
+                'Estimate the duration, locks and additional disk space '
+                'required for the upgrade using the current table '
+                'statistics, without upgrading'))
+        parser_upgrade.add_argument(
+            '--progress', action='store_true', help=(
+                'Report the progress of each upgrade script with an '
+                'estimated time remaining'))
+        parser_upgrade.add_argument(
+            '--progress-file', default=None, help=(
+                'Append progress reports to this file as JSON lines, '
+                'implies --progress'))
+        parser_upgrade.add_argument(
+            '--backup', action='store_true', help=(
+                'Snapshot the database before upgrading and restore it if '
+                'the upgrade fails'))
+        parser_upgrade.add_argument(
+            '--backup-method', choices=('auto', 'template', 'dump'),
+            default='auto', help=(
+                'template clones the database on the server and requires no '
+                'other connections, dump uses a parallel pg_dump. auto uses '
+                'template if possible'))
+        parser_upgrade.add_argument(
+            '--keep-backup', action='store_true',
+            help='Keep the cloned database after a successful upgrade')
+        parser_upgrade.add_argument(
+            '--upgrade-memory', default=None, help=(
+                'maintenance_work_mem for the upgrade session, for example '
+                '2GB. work_mem is set to a quarter of this. Default '
+                'postgres.upgrade.memory, or sized from this host if '
+                'PostgreSQL is managed'))
+        parser_upgrade.add_argument(
+            '--upgrade-parallel', type=int, default=None, help=(
+                'max_parallel_maintenance_workers for the upgrade session. '
+                'Default postgres.upgrade.parallel, or sized from this host '
+                'if PostgreSQL is managed'))
+        parser_upgrade.add_argument(
+            '--analyze-jobs', type=int, default=None, help=(
+                'After upgrading refresh the statistics of all tables using '
+                'this many parallel connections'))
+
+        parser_maintain = _subparser(
+            sub, 'maintain', self.execute, [common_parser, db_parser],
+            'Refresh planner statistics of all tables in parallel, most '
+            'changed first, in stages of increasing statistics targets')
+        parser_maintain.add_argument(
+            '--jobs', '-j', type=int, default=None, help=(
+                'Number of parallel connections, default the number of '
+                'CPUs'))
+        parser_maintain.add_argument(
+            '--vacuum', action='store_true',
+            help='Vacuum tables in the final stage')
 
         parser_dump = _subparser(
             sub, 'dump', self.execute, [common_parser, db_parser],
             'Dump a database')
         parser_dump.add_argument('--dumpfile', help='Database dump file')
-
-        _subparser(
+        parser_dump.add_argument(
+            '--dump-dir', default=None, help=(
+                'Directory for timestamped dumps if --dumpfile is not given, '
+                'default the current directory'))
+        parser_dump.add_argument(
+            '--list', action='store_true', help=(
+                'List the timestamped dumps in --dump-dir with their size, '
+                'duration and checksum instead of dumping'))
+        parser_dump.add_argument(
+            '--keep-last', type=int, default=None,
+            help='After dumping keep the latest KEEP_LAST dumps')
+        parser_dump.add_argument(
+            '--keep-daily', type=int, default=None, help=(
+                'After dumping keep the latest dump for each of the last '
+                'KEEP_DAILY days'))
+        parser_dump.add_argument(
+            '--keep-weekly', type=int, default=None, help=(
+                'After dumping keep the latest dump for each of the last '
+                'KEEP_WEEKLY weeks'))
+
+        parser_status = _subparser(
+            sub, 'status', self.execute, [common_parser, db_parser],
+            'Report the database version, size, largest tables, managed '
+            'PostgreSQL state, certificate expiry and last dump age for '
+            'monitoring')
+        parser_status.add_argument(
+            '--format', choices=STATUS_FORMATS, default='json',
+            help='Output format')
+        parser_status.add_argument(
+            '--top', type=int, default=STATUS_TOP_TABLES,
+            help='Number of tables to report by size')
+        parser_status.add_argument(
+            '--dump-dir', default=None, help=(
+                'Directory containing timestamped database dumps, default '
+                'the current directory'))
+
+        parser_certificates = _subparser(
             sub, 'certificates', self.certificates, [common_parser],
-            'Create and update self-signed server certificates')
+            'Create and update self-signed server certificates. '
+            'Existing certificates are only regenerated if the '
+            'configuration has changed or they are due to expire. '
+            'Use --hosts to issue certificates for multiple hosts from a '
+            'local certificate authority.')
+        parser_certificates.add_argument(
+            '--force', action='store_true',
+            help='Regenerate certificates even if they are still valid')
+        parser_certificates.add_argument(
+            '--backend', choices=BACKENDS, default='auto', help=(
+                'Create certificates using the cryptography package or '
+                'openssl, auto uses cryptography if it is installed'))
+        parser_certificates.add_argument(
+            '--hosts', default=None, help=(
+                'File containing hostnames, one per line, to issue '
+                'certificates for instead of creating a self-signed '
+                'certificate for this server'))
+        parser_certificates.add_argument(
+            '--ca-dir', default=None, help=(
+                'Directory for the local certificate authority used with '
+                '--hosts, created if necessary. Host certificates are '
+                'written to CA_DIR/hosts/HOST/'))
+        parser_certificates.add_argument(
+            '--jobs', '-j', type=int, default=None,
+            help='Number of parallel processes used with --hosts')
+
+        parser_backup = _subparser(
+            sub, 'backup', self.execute,
+            [common_parser, db_parser, pgadmin_parser],
+            'Take, list or restore physical base backups of a local '
+            'PostgreSQL server. Use --archive-wal once to enable '
+            'point-in-time recovery.')
+        parser_backup.add_argument(
+            '--type', choices=BACKUP_TYPES, default='full', help=(
+                'incremental backups are based on the previous backup, '
+                'differential on the previous full backup. Requires '
+                'PostgreSQL 17 and --archive-wal'))
+        parser_backup.add_argument(
+            '--compress', choices=COMPRESSION, default='none',
+            help='Compress the backup, uses tar format if enabled')
+        parser_backup.add_argument(
+            '--backup-dir', default=None, help=(
+                'Directory for base backups and archived WAL, default '
+                'OMERO_DATA_DIR/pgbackup'))
+        parser_backup.add_argument(
+            '--keep-full', type=int, default=None, help=(
+                'After taking a backup delete all but the latest KEEP_FULL '
+                'full backups, along with the backups and WAL that depend '
+                'on them'))
+        parser_backup.add_argument(
+            '--archive-wal', action='store_true', help=(
+                'Archive WAL to the backup directory, requires a restart '
+                'of PostgreSQL'))
+        parser_backup.add_argument(
+            '--list', action='store_true', help='List backups')
+        parser_backup.add_argument(
+            '--restore', nargs='?', const='latest', default=None, help=(
+                'Replace the PostgreSQL data directory with this backup, '
+                'default the latest backup before --target-time. '
+                'PostgreSQL must be stopped'))
+        parser_backup.add_argument(
+            '--target-time', default=None, help=(
+                'Recover to this ISO 8601 time using archived WAL when '
+                'restoring'))
 
         _subparser(
             sub, 'pginit', self.execute, [common_parser],
@@ -146,9 +370,30 @@ class SetupControl(BaseControl):
             sub, 'pgstart', self.execute, [common_parser],
             'Start a local PostgreSQL server')
 
-        _subparser(
-            sub, 'pgstop', self.execute, [common_parser],
-            'Stop a local PostgreSQL server')
+        parser_pgstop = _subparser(
+            sub, 'pgstop', self.execute,
+            [common_parser, db_parser, pgadmin_parser],
+            'Stop a local PostgreSQL server. A checkpoint is run first so '
+            'that shutdown and the next startup are faster.')
+        parser_pgstop.add_argument(
+            '--mode', choices=STOP_MODES, default='fast', help=(
+                'smart waits for all clients to disconnect, fast '
+                'disconnects them, immediate aborts and requires recovery '
+                'on the next startup'))
+        parser_pgstop.add_argument(
+            '--timeout', type=int, default=None, help=(
+                'Seconds to wait for the server to stop, default the '
+                'pg_ctl default'))
+
+        parser_serve = _subparser(
+            sub, 'serve', self.serve, [common_parser],
+            'Run setup commands sent to a Unix socket, keeping OMERO and the '
+            'configuration loaded between commands. Send commands with '
+            'python -m omero_server_setup.serve COMMAND [ARGS...]')
+        parser_serve.add_argument(
+            '--socket', default=None, help=(
+                'Socket path, default $OMERO_SETUP_SOCKET or '
+                'OMERODIR/var/{}'.format(SOCKET_NAME)))
 
         _subparser(
             sub, 'start', self.omeroctl, [common_parser],
@@ -162,13 +407,38 @@ class SetupControl(BaseControl):
         loglevel = max(DEFAULT_LOGLEVEL - 10 * args.verbose, 10)
         logging.getLogger('omero_server_setup').setLevel(level=loglevel)
 
+    def external(self, omerodir):
+        """
+        Get an External for omerodir, shared by all commands run by this
+        process so that OMERO plugins and config.xml are only loaded once
+        """
+        if not hasattr(self, '_externals'):
+            self._externals = {}
+        if omerodir not in self._externals:
+            self._externals[omerodir] = External(omerodir)
+        return self._externals[omerodir]
+
     def createconfig(self, args):
         self.setup_logging(args)
         omerodir = _omerodir()
         try:
-            c = CreateConfig(omerodir, args)
+            if args.pooler and not args.manage_postgres:
+                raise Stop(20, '--pooler requires --manage-postgres')
+            c = CreateConfig(omerodir, args, self.external(omerodir))
             created, changes = c.create_or_update_config()
             self.ctx.out('\n'.join(changes))
+            if not args.manage_postgres and not args.dry_run:
+                # An existing server, check it has enough connections if
+                # the database can already be reached
+                db = DbAdmin(
+                    omerodir, args, self.external(omerodir), self.ctx)
+                try:
+                    report, headroom = db.connection_report()
+                except (OSError, RunException) as e:
+                    log.info('Not checking max_connections, unable to '
+                             'connect to the database: %s', e)
+                else:
+                    self.ctx.out(report)
         except Stop as e:
             self.ctx.die(e.args[0], e.args[1])
 
@@ -176,26 +446,92 @@ class SetupControl(BaseControl):
         self.setup_logging(args)
         omerodir = _omerodir()
         try:
-            create_certificates(External(omerodir))
+            if args.hosts:
+                if not args.ca_dir:
+                    raise Stop(20, '--ca-dir is required with --hosts')
+                manifest = create_host_certificates(
+                    self.external(omerodir), args.hosts, args.ca_dir,
+                    force=args.force, backend=args.backend, jobs=args.jobs)
+                for entry in [manifest['ca']] + manifest['hosts']:
+                    self.ctx.out('{}\t{}\t{}\t{}'.format(
+                        entry.get('host', 'CA'), entry['fingerprint'],
+                        entry['notafter'], entry['certificate']))
+            else:
+                create_certificates(
+                    self.external(omerodir), force=args.force,
+                    backend=args.backend)
         except Stop as e:
             self.ctx.die(e.args[0], e.args[1])
 
+    def check(self, args):
+        self.setup_logging(args)
+        overrides = {
+            'omero.db.name': args.dbname,
+            'omero.db.host': args.dbhost,
+            'omero.db.port': args.dbport,
+            'omero.db.user': args.dbuser,
+            'omero.db.pass': args.dbpass,
+        }
+        result = check_database(
+            _omerodir(), overrides, use_config=not args.no_db_config,
+            timeout=args.connect_timeout)
+        self.ctx.out(json.dumps(result, sort_keys=True))
+        if result['rc']:
+            self.ctx.die(result['rc'], result['status'])
+
     def execute(self, args):
         self.setup_logging(args)
 
         # Is this the same as self.dir?
         omerodir = _omerodir()
         try:
-            DbAdmin(omerodir, args.command, args)
+            DbAdmin(omerodir, args, self.external(omerodir), self.ctx).run(
+                args.command)
         except Stop as e:
             self.ctx.die(e.args[0], e.args[1])
             # self.ctx.set("last.upload.id", obj.id.val)
             # self.ctx.out("OriginalFile:%s" % obj_ids)
 
+    def serve(self, args):
+        self.setup_logging(args)
+        omerodir = _omerodir()
+        path = args.socket or get_socket_path(omerodir)
+        # Load OMERO plugins and config.xml before the first request
+        self.external(omerodir).get_config(raise_missing=False)
+        try:
+            serve(path, self.run_captured)
+        except (OSError, RuntimeError) as e:
+            self.ctx.die(110, 'Unable to serve on {}: {}'.format(path, e))
+
+    def run_captured(self, argv):
+        """
+        Run an omero setup command in this process
+        :return: (exit code, stdout, stderr), the exit code is 1 and stderr
+                 includes the traceback if the command raised an exception
+        """
+        stdout = StringIO()
+        stderr = StringIO()
+        handler = logging.StreamHandler(stderr)
+        logger = logging.getLogger('omero_server_setup')
+        logger.addHandler(handler)
+        rc = None
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                try:
+                    self.ctx.invoke(['setup'] + list(argv))
+                except Exception:
+                    traceback.print_exc()
+                    rc = 1
+        finally:
+            logger.removeHandler(handler)
+        if rc is None:
+            rc = self.ctx.rv
+        return rc, stdout.getvalue(), stderr.getvalue()
+
     def omeroctl(self, args):
         self.setup_logging(args)
         omerodir = _omerodir()
-        cfg = CreateConfig(omerodir, args)
+        cfg = CreateConfig(omerodir, args, self.external(omerodir))
         if args.verbose:
             v = ' -' + ('v' * args.verbose)
         else:
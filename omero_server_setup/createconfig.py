@@ -6,32 +6,61 @@ Wrap openssl to manage self-signed certificates
 
 import logging
 import os
-from .external import External
+from .certificates import (
+    DEFAULT_DAYS,
+    DEFAULT_KEY_TYPE,
+    DEFAULT_RENEW_DAYS,
+)
+from .external import (
+    External,
+    get_config_diff,
+)
+from .memory import (
+    HEAP_DIVISOR,
+    allocate_memory,
+    format_heap_size,
+    unconfigured_jvm_roles,
+)
+from .pooler import (
+    DEFAULT_POOLER_PORT,
+    SUPERUSER_RESERVED_CONNECTIONS,
+    format_connection_report,
+    pool_sizes,
+    recommended_pool_size,
+    required_max_connections,
+)
+from .tuning import (
+    format_memory,
+    host_resources,
+)
 
 log = logging.getLogger(__name__)
 
+# Maximum length of a Unix socket path on Linux
+MAX_SOCKET_PATH = 107
 
-def get_config_changes(a, b):
-    keys_a = set(a.keys())
-    keys_b = set(b.keys())
-    keys_common = keys_a.intersection(keys_b)
-    keys_new = keys_b.difference(keys_a)
+
+def format_config_changes(diff):
     changes = []
-    for k in keys_common:
-        if a[k] != b[k]:
-            changes.append('{}: {} → {}'.format(k, a[k], b[k]))
-    for k in keys_new:
-        changes.append('{}: → {}'.format(k, b[k]))
+    for k, (old, new) in sorted(diff.items()):
+        if old is None:
+            changes.append('{}: → {}'.format(k, new))
+        else:
+            changes.append('{}: {} → {}'.format(k, old, new))
     return changes
 
 
+def get_config_changes(a, b):
+    return format_config_changes(get_config_diff(a, b))
+
+
 class CreateConfig(object):
-    def __init__(self, omerodir, args):
+    def __init__(self, omerodir, args, external=None):
         self.dir = omerodir
         self.args = args
         if not os.path.exists(self.dir):
             raise Exception("%s does not exist!" % self.dir)
-        self.external = External(self.dir)
+        self.external = external or External(self.dir)
 
     def certificates_enabled(self):
         cfgmap = self.external.get_config(raise_missing=False)
@@ -72,6 +101,10 @@ class CreateConfig(object):
         update_value('omero.db.host', 'dbhost', 'localhost')
         update_value('omero.db.user', 'dbuser', 'omero')
         update_value('omero.db.pass', 'dbpass', 'omero')
+        memory, cpus = host_resources()
+        update_value('omero.db.poolsize', 'db_poolsize', str(
+            recommended_pool_size(
+                cpus, getattr(self.args, 'db_concurrency', None))))
 
         update_value('omero.data.dir', 'data_dir', '/OMERO')
         if created['omero.data.dir'].lower() == 'auto':
@@ -85,9 +118,52 @@ class CreateConfig(object):
             # TODO: Set to a random port?
             # created['omero.db.port'] = str(randint(30000, 60000))
             update_value('postgres.admin.user', 'adminuser', 'postgres')
+            if getattr(self.args, 'pooler', False):
+                # OMERO.server connects to PgBouncer on omero.db.port,
+                # PostgreSQL listens on postgres.port
+                update_value('postgres.port', '', created['omero.db.port'])
+                update_value('postgres.pooler.dir', '', os.path.join(
+                    created['omero.data.dir'], 'pgbouncer'))
+                update_value('postgres.pooler.port', '', DEFAULT_POOLER_PORT)
+                created['omero.db.port'] = created['postgres.pooler.port']
+            # Used by this plugin, OMERO.server connects over TCP since the
+            # PostgreSQL JDBC driver doesn't support Unix sockets
+            socketdir = os.path.join(created['omero.data.dir'], 'pgsocket')
+            pgport = created.get('postgres.port', created['omero.db.port'])
+            if len(os.path.join(
+                    socketdir, '.s.PGSQL.' + pgport)) <= MAX_SOCKET_PATH:
+                update_value('postgres.socket.dir', '', socketdir)
+            else:
+                log.warning('%s is too long for a Unix socket, using TCP',
+                            socketdir)
+            # Enough server connections for OMERO.server's pools or the
+            # pooler, and this plugin
+            sizes = None
+            if created.get('postgres.pooler.dir'):
+                sizes = pool_sizes(created['omero.db.poolsize'], cpus)
+            update_value('postgres.max_connections', '', str(
+                required_max_connections(created['omero.db.poolsize'], sizes)))
         else:
             update_value('omero.db.port', 'dbport', '5432')
 
+        # Memory
+        if memory:
+            allocation = allocate_memory(memory, self.args.manage_postgres)
+            used = allocation.get('postgres', 0)
+            if self.args.manage_postgres:
+                update_value('postgres.shared_buffers', '', format_memory(
+                    allocation['shared_buffers']))
+            # Leave the JVM settings of the administrator alone
+            for role in unconfigured_jvm_roles(cfgmap):
+                update_value('omero.jvmcfg.heap_size.' + role, '',
+                             format_heap_size(allocation[role]))
+                used += allocation[role] * HEAP_DIVISOR
+            if used > memory:
+                log.warning('%s memory is too small for OMERO.server%s',
+                            format_memory(memory),
+                            ' and PostgreSQL' if self.args.manage_postgres
+                            else '')
+
         # Certificates
         if self.args.no_certificates:
             created['setup.omero.certificates'] = 'false'
@@ -99,6 +175,10 @@ class CreateConfig(object):
             update_value('ssl.certificate.owner', '',
                          '/L=OMERO/O=OMERO.server')
             update_value('ssl.certificate.key', '', 'server.key')
+            update_value('ssl.certificate.keytype', 'cert_key_type',
+                         DEFAULT_KEY_TYPE)
+            update_value('ssl.certificate.days', 'cert_days', DEFAULT_DAYS)
+            update_value('ssl.certificate.renewdays', '', DEFAULT_RENEW_DAYS)
             update_value('omero.glacier2.IceSSL.CertFile', '', 'server.p12')
             update_value('omero.glacier2.IceSSL.CAs', '', 'server.pem')
             update_value('omero.glacier2.IceSSL.Password', '', 'secret')
@@ -112,9 +192,15 @@ class CreateConfig(object):
             update_value('omero.client.icetransports', '', 'ssl,wss')
 
         log.info('Configuration: %s', created)
-        if not self.args.dry_run:
-            self.external.update_config(created)
-
-        changes = get_config_changes(cfgmap, created)
+        if self.args.dry_run:
+            diff = get_config_diff(cfgmap, created)
+        else:
+            diff = self.external.update_config(created, current=cfgmap)
+        changes = format_config_changes(diff)
+        if self.args.manage_postgres:
+            changes.append(format_connection_report(
+                created['omero.db.poolsize'],
+                created['postgres.max_connections'],
+                SUPERUSER_RESERVED_CONNECTIONS, sizes))
         log.info('Changes: %s', changes)
         return created, changes
@@ -1,17 +1,117 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import total_ordering
 from glob import glob
+import json
 import os
 import logging
+import random
 import re
-
+import shutil
+import signal
+import threading
+import time
+
+from .basebackup import (
+    backup_chain,
+    choose_parent,
+    directory_size,
+    find_backup,
+    get_backup_dirs,
+    parse_time,
+    read_index,
+    read_manifest_start_wal,
+    select_expired,
+    select_restore_backup,
+    write_index,
+)
+from .certificates import get_backend
+from .check import (
+    CONNECT_BACKOFF,
+    CONNECT_BACKOFF_MAX,
+    CONNECT_RETRIES,
+    CONNECT_TIMEOUT,
+    DB_INIT_NEEDED,
+    DB_NO_CONNECTION,
+    DB_UNREACHABLE,
+    DB_UPGRADE_NEEDED,
+    DB_UPTODATE,
+    TRANSIENT_CONNECTION_ERRORS,
+    classify_connection_error,
+)
+from .dumps import (
+    dump_basename,
+    format_dump_index,
+    list_dumps,
+    prune_dumps,
+    record_dump,
+)
+from .estimate import (
+    estimate_upgrade,
+    format_estimate,
+)
 from .external import (
     External,
     run,
     RunException,
 )
+from .formatting import (
+    format_bytes,
+    format_seconds,
+)
+from .maintain import (
+    ANALYZE_STAGES,
+    TABLE_ACTIVITY_QUERY,
+    format_maintenance_report,
+    maintenance_commands,
+    order_tables,
+    parse_table_activity,
+)
+from .pooler import (
+    ADMIN_CONNECTIONS,
+    DEFAULT_OMERO_POOLSIZE,
+    DEFAULT_POOLER_PORT,
+    POOLER_INI,
+    POOLER_PIDFILE,
+    POOLER_STOP_TIMEOUT,
+    POOLER_USERLIST,
+    connection_headroom,
+    format_connection_report,
+    format_pgbouncer_ini,
+    format_userlist,
+    pool_sizes,
+)
+from .postmaster import (
+    PidFileUnreadable,
+    process_exists,
+    read_postmaster_status,
+)
+from .progress import (
+    PROGRESS_INTERVAL,
+    UpgradeProgress,
+)
+from .toolchain import (
+    discover_toolchain,
+    version_num,
+)
+from .tuning import (
+    auto_tuning,
+    format_memory,
+    host_resources,
+    parse_memory,
+    session_options,
+    upgrade_settings,
+)
+from .status import (
+    STATUS_QUERY,
+    STATUS_TOP_TABLES,
+    format_prometheus,
+    parse_status_query,
+)
 
 log = logging.getLogger(__name__)
 
@@ -20,11 +120,13 @@ HELP = """Manage an OMERO PostgreSQL database"""
 # Regular expression identifying a SQL schema
 SQL_SCHEMA_REGEXP = re.compile(r'.*OMERO(\d+)(\.|A)?(\d*)([A-Z]*)__(\d+)$')
 
-# Exit codes for db upgrade --dry-run (also used internally)
-DB_UPTODATE = 0
-DB_UPGRADE_NEEDED = 2
-DB_INIT_NEEDED = 3
-DB_NO_CONNECTION = 4
+# Free disk space required to clone a database as a multiple of its size,
+# allowing room for the upgrade itself
+BACKUP_DISK_FACTOR = 2
+
+# Maximum seconds for the checkpoint before stopping PostgreSQL if
+# pgstop --timeout isn't given
+CHECKPOINT_TIMEOUT = 60
 
 
 class Stop(Exception):
@@ -50,27 +152,96 @@ def timestamp_filename(basename, ext=None):
 
 ##########
 
+@total_ordering
+class SchemaVersion(object):
+    """
+    An OMERO database schema version of the form
+    currentversion__currentpatch, e.g. OMERO5.4__0
+
+    Instances are interned so each version string is only parsed once.
+    They compare and hash equal to their string form, and are ordered by
+    schema version.
+    """
+
+    __slots__ = ('name', 'version', 'patch', 'key')
+
+    _interned = {}
+
+    def __new__(cls, name):
+        if isinstance(name, SchemaVersion):
+            return name
+        try:
+            return cls._interned[name]
+        except KeyError:
+            pass
+        m = SQL_SCHEMA_REGEXP.match(name)
+        if m is None:
+            raise ValueError('Invalid schema version: {}'.format(name))
+        x = m.groups()
+        self = super().__new__(cls)
+        self.name = name
+        self.version, _, self.patch = name.rpartition('__')
+        # x3: 'DEV' should come before ''
+        self.key = (int(x[0]), x[1] if x[1] else '',
+                    int(x[2]) if x[2] else '', x[3] if x[3] else 'zzz',
+                    int(x[4]))
+        cls._interned[name] = self
+        return self
+
+    @classmethod
+    def from_db(cls, currentversion, currentpatch):
+        """
+        Get the version corresponding to the dbpatch table columns
+        """
+        return cls('{}__{}'.format(currentversion, currentpatch))
+
+    def __eq__(self, other):
+        if isinstance(other, SchemaVersion):
+            return self is other
+        if isinstance(other, str):
+            return self.name == other
+        return NotImplemented
+
+    def __lt__(self, other):
+        if not isinstance(other, SchemaVersion):
+            try:
+                other = SchemaVersion(other)
+            except (TypeError, ValueError):
+                return NotImplemented
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'SchemaVersion({!r})'.format(self.name)
+
+    def __reduce__(self):
+        return (SchemaVersion, (self.name,))
+
+
 def is_schema(s):
     """Return true if the string is a valid SQL schema"""
-    return SQL_SCHEMA_REGEXP.match(s) is not None
+    try:
+        SchemaVersion(s)
+        return True
+    except ValueError:
+        return False
 
 
 def sort_schemas(schemas):
     """Sort a list of SQL schemas in order"""
-    def keyfun(v):
-        x = SQL_SCHEMA_REGEXP.match(v).groups()
-        # x3: 'DEV' should come before ''
-        return (int(x[0]), x[1] if x[1] else '', int(x[2]) if x[2] else '',
-                x[3] if x[3] else 'zzz', int(x[4]))
-
-    return sorted(schemas, key=keyfun)
+    return sorted(SchemaVersion(s) for s in schemas)
 
 
 def parse_schema_files(files):
     """
     Parse a list of SQL files and return a dictionary of valid schema
     files where each key is a valid schema file and the corresponding value is
-    a tuple containing the source and the target schema.
+    a tuple containing the source and the target SchemaVersion.
     """
     f_dict = {}
     for f in files:
@@ -79,49 +250,174 @@ def parse_schema_files(files):
             continue
         vto, vfrom = os.path.split(root)
         vto = os.path.split(vto)[1]
-        if is_schema(vto) and is_schema(vfrom):
-            f_dict[f] = (vfrom, vto)
+        try:
+            f_dict[f] = (SchemaVersion(vfrom), SchemaVersion(vto))
+        except ValueError:
+            continue
     return f_dict
 
 
+# Commands that can be passed to DbAdmin.run
+DB_COMMANDS = (
+    'create',
+    'dump',
+    'init',
+    'justdoit',
+    'maintain',
+    'status',
+    'upgrade',
+
+    'backup',
+    'pginit',
+    'pgstart',
+    'pgstop',
+)
+
+
 class DbAdmin(object):
 
-    # def __init__(self, dir, command, args, external):
-    def __init__(self, omerodir, command, args):
+    _toolchain = None
+    _checked_clients = frozenset()
+    _memo = None
+    ctx = None
+
+    def __init__(self, omerodir, args, external=None, ctx=None):
+        """
+        :param external: An External for omerodir, created if None
+        :param ctx: The OMERO CLI context used for output, if None output
+               is printed
+        """
 
         self.dir = omerodir
         self.args = args
+        self.ctx = ctx
 
         # Server directory
         if not os.path.exists(self.dir):
             raise Exception("%s does not exist!" % self.dir)
 
-        self.external = External(self.dir)
+        self.external = external or External(self.dir)
 
-        psqlv = self.psql(version=True)
-        log.info('psql version: %s', psqlv.strip())
+    def run(self, command):
+        """
+        Run one of DB_COMMANDS
+        """
+        if command not in DB_COMMANDS:
+            raise Stop(10, 'Invalid db command: %s' % command)
+        return getattr(self, command)()
 
-        if command in (
-            'create',
-            'dump',
-            'init',
-            'justdoit',
-            'upgrade',
+    @property
+    def toolchain(self):
+        """
+        The paths and versions of external programs, see discover_toolchain
+        """
+        if self._toolchain is None:
+            self._toolchain = discover_toolchain()
+            for tool, info in sorted(self._toolchain.items()):
+                if info:
+                    log.info('%s version: %s', info['path'], info['version'])
+                else:
+                    log.info('%s not found', tool)
+        return self._toolchain
+
+    def check_client_version(self, tool):
+        """
+        Check a PostgreSQL client program is not older than the server, since
+        for example pg_dump refuses to dump a newer server. This is checked
+        once per program, so call it before starting a slow operation.
+        """
+        if tool in self._checked_clients:
+            return
+        info = self.toolchain.get(tool)
+        if not info or not info['version']:
+            raise Stop(60, '{} not found'.format(tool))
+        server = self.get_server_version_num()
+        servermajor = server // 10000 * 10000 if server >= 100000 else (
+            server // 100 * 100)
+        if version_num(info['version']) < servermajor:
+            raise Stop(60, '{} {} is older than the PostgreSQL server {}, '
+                       'use a newer client'.format(tool, info['version'],
+                                                   server))
+        self._checked_clients = self._checked_clients | {tool}
+
+    def out(self, *lines):
+        """
+        Write output for the user
+        """
+        for line in lines:
+            if self.ctx:
+                self.ctx.out(line)
+            else:
+                print(line)
 
-            'pginit',
-            'pgstart',
-            'pgstop',
-        ):
-            getattr(self, command)()
-        elif command is not None:
-            raise Stop(10, 'Invalid db command: %s' % command)
+    def memoize(self, key, fetch):
+        """
+        Get the result of a read-only query, calling fetch only if it hasn't
+        been fetched since the database was last modified. Exceptions are
+        not cached.
+        """
+        if self._memo is None:
+            self._memo = {}
+        if key in self._memo:
+            log.debug('Query cache hit: %s', key)
+            return self._memo[key]
+        log.debug('Query cache miss: %s', key)
+        value = fetch()
+        self._memo[key] = value
+        return value
+
+    def invalidate(self, reason):
+        """
+        Clear the results of memoized queries after modifying the database
+        """
+        if self._memo:
+            log.debug('Query cache cleared after %s: %s', reason, ', '.join(
+                str(k) for k in self._memo))
+        self._memo = {}
 
     def check_connection(self):
-        try:
-            self.psql('-c', r'\conninfo')
-        except RunException as e:
-            log.error(e)
-            raise Stop(DB_NO_CONNECTION, 'Database connection check failed')
+        """
+        Check the database can be connected to, retrying with exponential
+        backoff and jitter if the server is unreachable.
+        Raises Stop(DB_UNREACHABLE) if the server can't be reached, or
+        Stop(DB_NO_CONNECTION) if the connection was rejected, for example
+        because the user or database doesn't exist.
+        :return: A dictionary of the number of attempts and the round trip
+                 time of each in seconds
+        """
+        return self.memoize('connection', self._check_connection)
+
+    def _check_connection(self):
+        def arg(name, default):
+            value = getattr(self.args, name, None)
+            return default if value is None else value
+
+        timeout = arg('connect_timeout', CONNECT_TIMEOUT)
+        retries = arg('connect_retries', CONNECT_RETRIES)
+        backoff = arg('connect_backoff', CONNECT_BACKOFF)
+        rtts = []
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                self.psql('-c', r'\conninfo', connect_timeout=timeout)
+                rtts.append(time.time() - start)
+                log.info('Connected in %.3f s, attempt %d',
+                         rtts[-1], attempt + 1)
+                return {'attempts': attempt + 1, 'rtts': rtts}
+            except RunException as e:
+                rtts.append(time.time() - start)
+                kind = classify_connection_error(e.stderr)
+                if kind not in TRANSIENT_CONNECTION_ERRORS:
+                    log.error(e)
+                    raise Stop(DB_NO_CONNECTION,
+                               'Database connection check failed')
+                log.warning('Connection attempt %d failed after %.3f s: %s',
+                            attempt + 1, rtts[-1], kind)
+            if attempt < retries:
+                time.sleep(random.uniform(
+                    0, min(backoff * 2 ** attempt, CONNECT_BACKOFF_MAX)))
+        raise Stop(DB_UNREACHABLE, 'Database server unreachable: {}'.format(
+            kind))
 
     def choose_omero_data_home(self):
         # if os.path.exists('/OMERO'):
@@ -152,7 +448,10 @@ class DbAdmin(object):
 
         log.info('Creating database using %s', omerosql)
         if not self.args.dry_run:
-            self.psql('-f', omerosql)
+            try:
+                self.psql('-f', omerosql)
+            finally:
+                self.invalidate('init')
 
         if autoupgrade:
             self.upgrade()
@@ -172,11 +471,11 @@ class DbAdmin(object):
 
         # Create a set of unique schema versions
         versions = set()
-        for v in list(f_dict.values()):
+        for v in f_dict.values():
             versions.update(v)
-        versions = sort_schemas(versions)
+        versions = sorted(versions)
         n = len(versions)
-        versionsrev = dict(vi for vi in zip(versions, range(n)))
+        versionsrev = dict(zip(versions, range(n)))
 
         # M(from,to) = upgrade script for this pair or None
         M = [[None for b in range(n)] for a in range(n)]
@@ -201,7 +500,8 @@ class DbAdmin(object):
             raise Exception('No upgrade path found from %s to %s' % (
                 versions[ifrom], versions[ito]))
 
-        ugpath = resolve_index(M, versions.index(vfrom), len(versions) - 1)
+        versionsrev = dict(zip(versions, range(len(versions))))
+        ugpath = resolve_index(M, versionsrev[vfrom], len(versions) - 1)
         return ugpath
 
     def check(self):
@@ -215,7 +515,7 @@ class DbAdmin(object):
                 return e.rc
             raise e
         try:
-            currentsqlv = '%s__%s' % self.get_current_db_version()
+            currentsqlv = self.get_current_db_version()
         except RunException as e:
             log.error(e)
             if check:
@@ -225,22 +525,386 @@ class DbAdmin(object):
         M, versions = self.sql_version_matrix()
         latestsqlv = versions[-1]
 
+        estimate = not check and getattr(self.args, 'estimate', False)
         if latestsqlv == currentsqlv:
             log.info('Database is already at %s', latestsqlv)
             if check:
                 return DB_UPTODATE
+            if estimate:
+                self.out('Database is already at {}'.format(latestsqlv))
         else:
             ugpath = self.sql_version_resolve(M, versions, currentsqlv)
             log.debug('Database upgrade path: %s', ugpath)
             if check:
                 return DB_UPGRADE_NEEDED
+            if estimate:
+                self.out('Database upgrade required {}->{}'.format(
+                    currentsqlv, latestsqlv))
+                self.out(*format_estimate(self.estimate_upgrade(ugpath)))
+                return
             if self.args.dry_run:
                 raise Stop(
                     DB_UPGRADE_NEEDED, 'Database upgrade required %s->%s' % (
                         currentsqlv, latestsqlv))
-            for upgradesql in ugpath:
+            backup = None
+            if getattr(self.args, 'backup', False):
+                backup = self.backup_database()
+            start = time.time()
+            try:
+                self.upgrade_scripts(ugpath)
+            except (RunException, Stop):
+                if backup:
+                    log.error('Upgrade failed, restoring database from %s',
+                              backup['name'])
+                    self.restore_backup(backup)
+                raise
+            self.out('Upgrade completed in {}'.format(
+                format_seconds(time.time() - start)))
+            if backup and backup['method'] == 'template' and not getattr(
+                    self.args, 'keep_backup', False):
+                self.drop_database(backup['name'])
+            if getattr(self.args, 'analyze_jobs', None):
+                self.maintain(self.args.analyze_jobs)
+
+    def backup_database(self):
+        """
+        Take a snapshot of the database that can be restored if an upgrade
+        fails, using the fastest available method:
+        - template: clone the database with CREATE DATABASE ... TEMPLATE,
+          requires no other sessions and enough free disk space
+        - dump: a parallel pg_dump in directory format
+        Returns a dictionary of the method, backup name and duration
+        """
+        db, env = self.get_db_args_env()
+        method = getattr(self.args, 'backup_method', None) or 'auto'
+        if method == 'auto':
+            method = 'template' if self.can_clone_database() else 'dump'
+
+        start = time.time()
+        if method == 'template':
+            name = timestamp_filename(
+                '{}_backup'.format(db['name'][:24])).replace('-', '_')
+            log.info('Cloning database %s to %s', db['name'], name)
+            self.psql('-c', 'CREATE DATABASE {} WITH TEMPLATE {} '
+                      'OWNER {};'.format(name, db['name'], db['user']),
+                      admin=True)
+        else:
+            self.check_client_version('pg_dump')
+            self.check_client_version('pg_restore')
+            name = timestamp_filename(
+                'omero-database-%s' % db['name'], 'pgdir')
+            log.info('Dumping database to %s', name)
+            self.pgdump('-Fd', '-j', str(os.cpu_count() or 1), '-f', name)
+        backup = {
+            'method': method,
+            'name': name,
+            'seconds': time.time() - start,
+        }
+        self.out('Backup {} {} completed in {}'.format(
+            method, name, format_seconds(backup['seconds'])))
+        return backup
+
+    def can_clone_database(self):
+        """
+        Check whether the database can be safely cloned: there must be no
+        other sessions, and the PostgreSQL data directory must be local
+        with enough free space
+        """
+        db, env = self.get_db_args_env()
+        sessions, size = self.psql('-c', (
+            "SELECT count(*), pg_database_size('{0}') FROM pg_stat_activity "
+            "WHERE datname = '{0}';").format(db['name']),
+            admin=True).strip().split('|')
+        if int(sessions):
+            log.info('Not cloning database, %s other sessions', sessions)
+            return False
+        try:
+            datadir = self.external.get_config().get('postgres.data.dir')
+        except Exception as e:
+            log.warning('config.xml not found: %s', e)
+            datadir = None
+        if not datadir or not os.path.isdir(datadir):
+            log.info('Not cloning database, unable to check free space')
+            return False
+        free = shutil.disk_usage(datadir).free
+        if free < BACKUP_DISK_FACTOR * int(size):
+            log.info('Not cloning database, %d bytes free, database is %s '
+                     'bytes', free, size)
+            return False
+        return True
+
+    def restore_backup(self, backup):
+        """
+        Replace the database with a backup from backup_database
+        """
+        db, env = self.get_db_args_env()
+        start = time.time()
+        self.invalidate('restore')
+        self.drop_database(db['name'])
+        if backup['method'] == 'template':
+            self.psql('-c', 'ALTER DATABASE {} RENAME TO {};'.format(
+                backup['name'], db['name']), admin=True)
+        else:
+            self.psql('-c', 'CREATE DATABASE {} WITH OWNER {};'.format(
+                db['name'], db['user']), admin=True)
+            self.pgrestore('-j', str(os.cpu_count() or 1), backup['name'])
+        self.out('Restored database from {} in {}'.format(
+            backup['name'], format_seconds(time.time() - start)))
+
+    def drop_database(self, name):
+        log.info('Dropping database %s', name)
+        self.psql('-c', 'DROP DATABASE {};'.format(name), admin=True)
+        self.invalidate('drop database')
+
+    def upgrade_scripts(self, ugpath):
+        """
+        Run a list of upgrade scripts, optionally reporting progress
+        """
+        progress = None
+        if getattr(self.args, 'progress', False) or getattr(
+                self.args, 'progress_file', None):
+            progress = UpgradeProgress(
+                ugpath, getattr(self.args, 'progress_file', None), self.out)
+        settings = self.get_upgrade_settings()
+        try:
+            for n, upgradesql in enumerate(ugpath):
                 log.info('Upgrading database using %s', upgradesql)
-                self.psql('-f', upgradesql)
+                if progress:
+                    progress.script_started(n)
+                    self.psql_with_progress(progress, upgradesql, settings)
+                    progress.script_finished(n)
+                else:
+                    self.psql('-f', upgradesql, settings=settings)
+        finally:
+            self.invalidate('upgrade')
+
+    def get_upgrade_settings(self):
+        """
+        Get the session settings for the upgrade scripts from
+        --upgrade-memory and --upgrade-parallel or the
+        postgres.upgrade.memory and postgres.upgrade.parallel properties.
+        If PostgreSQL is managed unset values are sized from the resources
+        of this host.
+        """
+        try:
+            cfgmap = self.external.get_config()
+        except Exception as e:
+            log.warning('config.xml not found: %s', e)
+            cfgmap = {}
+        memory = getattr(self.args, 'upgrade_memory', None)
+        if memory is None:
+            memory = cfgmap.get('postgres.upgrade.memory')
+        parallel = getattr(self.args, 'upgrade_parallel', None)
+        if parallel is None:
+            parallel = cfgmap.get('postgres.upgrade.parallel')
+        try:
+            if memory is not None:
+                memory = parse_memory(memory)
+            if parallel is not None:
+                parallel = int(parallel)
+        except ValueError as e:
+            raise Stop(70, 'Invalid upgrade setting: {}'.format(e))
+
+        if cfgmap.get('postgres.data.dir') and (
+                memory is None or parallel is None):
+            automemory, autoparallel = auto_tuning(*host_resources())
+            if memory is None:
+                memory = automemory
+            if parallel is None:
+                parallel = autoparallel
+        # max_parallel_maintenance_workers was added in PostgreSQL 11
+        if parallel is not None and self.get_server_version_num() < 110000:
+            parallel = None
+
+        settings = upgrade_settings(memory, parallel)
+        if settings:
+            log.info('Upgrade session settings: %s',
+                     session_options(settings))
+        return settings
+
+    def psql_with_progress(self, progress, sqlfile, settings=None):
+        """
+        Run a SQL file whilst polling pg_stat_activity in a separate
+        session to find the statement being run
+        :param settings: Session settings for running the SQL file
+        """
+        appname = 'omero-setup-upgrade-{}'.format(os.getpid())
+        progresscols = 'NULL, NULL, NULL, NULL, NULL'
+        progressjoin = ''
+        if self.get_server_version_num() >= 120000:
+            progresscols = ('p.phase, p.blocks_done, p.blocks_total, '
+                            'p.tuples_done, p.tuples_total')
+            progressjoin = (' LEFT JOIN pg_stat_progress_create_index p '
+                            'ON p.pid = a.pid')
+        # The query may contain newlines and separators so encode it
+        q = ("SELECT {}, translate(encode(convert_to(a.query, 'UTF8'), "
+             "'base64'), E'\\n', '') FROM pg_stat_activity a{} "
+             "WHERE a.application_name = '{}' AND a.state = 'active'".format(
+                 progresscols, progressjoin, appname))
+
+        stop = threading.Event()
+
+        def monitor():
+            while not stop.wait(PROGRESS_INTERVAL):
+                try:
+                    rows = self.psql('-c', q).splitlines()
+                except RunException as e:
+                    log.debug('Progress query failed: %s', e)
+                    continue
+                for row in rows:
+                    if not row:
+                        continue
+                    phase, bdone, btotal, tdone, ttotal, query = row.split(
+                        '|')
+                    index_progress = None
+                    if phase:
+                        index_progress = {
+                            'phase': phase,
+                            'blocks_done': int(bdone or 0),
+                            'blocks_total': int(btotal or 0),
+                            'tuples_done': int(tdone or 0),
+                            'tuples_total': int(ttotal or 0),
+                        }
+                    progress.update(
+                        b64decode(query).decode('utf-8', errors='replace'),
+                        index_progress)
+
+        thread = threading.Thread(target=monitor, daemon=True)
+        thread.start()
+        try:
+            self.psql('-f', sqlfile, appname=appname, settings=settings)
+        finally:
+            stop.set()
+            thread.join()
+
+    def get_server_version_num(self):
+        """
+        Get the PostgreSQL server_version_num
+        """
+        return self.memoize('server_version_num', lambda: int(
+            self.psql('-c', 'SHOW server_version_num').strip()))
+
+    def get_connection_limits(self):
+        """
+        Get the PostgreSQL max_connections and the number of connections
+        reserved for superusers and, on PostgreSQL 16+, reserved_connections
+        roles
+        :return: (max_connections, reserved)
+        """
+        q = ("SELECT current_setting('max_connections'), "
+             "current_setting('superuser_reserved_connections')::int + "
+             "coalesce(current_setting('reserved_connections', true)::int, "
+             "0)")
+        out = self.memoize('connection_limits', lambda: self.psql(
+            '-c', q, connect_timeout=getattr(
+                self.args, 'connect_timeout', None)).strip())
+        max_connections, reserved = out.split('|')
+        return int(max_connections), int(reserved)
+
+    def connection_report(self):
+        """
+        Check max_connections of the server leaves room for OMERO.server's
+        connection pools and this plugin
+        :return: (report, headroom), see format_connection_report
+        """
+        cfgmap = self.external.get_config(raise_missing=False)
+        poolsize = cfgmap.get('omero.db.poolsize') or DEFAULT_OMERO_POOLSIZE
+        sizes = None
+        if cfgmap.get('postgres.pooler.dir'):
+            memory, cpus = host_resources()
+            sizes = pool_sizes(poolsize, cpus)
+        max_connections, reserved = self.get_connection_limits()
+        headroom = connection_headroom(
+            poolsize, max_connections, reserved, sizes)
+        if headroom < 0:
+            log.warning(
+                'max_connections %d is too low for omero.db.poolsize %s, '
+                'OMERO.server connections may be refused',
+                max_connections, poolsize)
+        elif headroom < ADMIN_CONNECTIONS:
+            log.warning('Only %d PostgreSQL connections are available in '
+                        'addition to OMERO.server', headroom)
+        return format_connection_report(
+            poolsize, max_connections, reserved, sizes), headroom
+
+    def estimate_upgrade(self, ugpath):
+        """
+        Estimate the duration and impact of running the upgrade scripts
+        using the current database table statistics
+        """
+        stats, server_version_num = self.get_table_stats()
+        return estimate_upgrade(ugpath, stats, server_version_num)
+
+    def get_table_stats(self):
+        """
+        Get the estimated number of rows and sizes of all tables in the
+        current schema, and the PostgreSQL server_version_num
+        """
+        q = ("SELECT c.relname, c.reltuples::bigint, "
+             "pg_relation_size(c.oid), pg_total_relation_size(c.oid) "
+             "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+             "WHERE c.relkind = 'r' AND n.nspname = current_schema() "
+             "UNION ALL SELECT '', "
+             "current_setting('server_version_num')::bigint, 0, 0")
+        stats = {}
+        server_version_num = None
+        for row in self.psql('-c', q).splitlines():
+            if not row:
+                continue
+            name, rows, size, totalsize = row.split('|')
+            if name:
+                stats[name] = {
+                    'rows': max(int(rows), 0),
+                    'size': int(size),
+                    'totalsize': int(totalsize),
+                }
+            else:
+                server_version_num = int(rows)
+        return stats, server_version_num
+
+    def maintain(self, jobs=None):
+        """
+        Refresh the planner statistics of all tables in parallel, in stages
+        of increasing statistics targets so that the most changed tables
+        have usable statistics quickly. Optionally vacuum in the last stage.
+        """
+        jobs = jobs or getattr(self.args, 'jobs', None) or os.cpu_count()
+        vacuum = getattr(self.args, 'vacuum', False)
+        tables = order_tables(parse_table_activity(
+            self.psql('-c', TABLE_ACTIVITY_QUERY)))
+        if self.args.dry_run:
+            self.out(*('{}\t{}'.format(t['name'], t['modified'])
+                       for t in tables))
+            return
+
+        def process(table, target, vacuum):
+            start = time.time()
+            args = []
+            for command in maintenance_commands(table['name'], target, vacuum):
+                args += ['-c', command]
+            self.psql(*args)
+            return time.time() - start
+
+        start = time.time()
+        results = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for n, target in enumerate(ANALYZE_STAGES):
+                last = n == len(ANALYZE_STAGES) - 1
+                if target is None:
+                    label = '{}/{} {}'.format(
+                        n + 1, len(ANALYZE_STAGES),
+                        'vacuum analyze' if vacuum else 'analyze')
+                else:
+                    label = '{}/{} analyze statistics target {}'.format(
+                        n + 1, len(ANALYZE_STAGES), target)
+                futures = [executor.submit(
+                    process, table, target, vacuum and last)
+                    for table in tables]
+                for table, future in zip(tables, futures):
+                    results.append((label, table, future.result()))
+        self.out(*format_maintenance_report(results))
+        self.out('Maintenance of {} tables completed in {}'.format(
+            len(tables), format_seconds(time.time() - start)))
 
     def justdoit(self):
         """
@@ -248,6 +912,8 @@ class DbAdmin(object):
         and up-to-date
         """
         status = self.upgrade(check=True)
+        if status in (DB_UNREACHABLE,):
+            raise Stop(DB_UNREACHABLE, 'Database server unreachable')
         if status in (DB_NO_CONNECTION,):
             self.create()
 
@@ -260,9 +926,9 @@ class DbAdmin(object):
     def create(self):
         db, env = self.get_db_args_env()
 
-        userexists = self.psql(
+        userexists = self.memoize(('role', db['user']), lambda: self.psql(
             '-c', "SELECT 1 FROM pg_roles WHERE rolname='{}';".format(
-                db['user']), admin=True)
+                db['user']), admin=True))
         if userexists.strip() == '1':
             log.info('Database user exists: %s', db['user'])
         else:
@@ -270,10 +936,11 @@ class DbAdmin(object):
             if not self.args.dry_run:
                 self.psql('-c', "CREATE USER {} WITH PASSWORD '{}';".format(
                     db['user'], db['pass']), admin=True)
+                self.invalidate('create user')
 
-        dbexists = self.psql(
+        dbexists = self.memoize(('database', db['name']), lambda: self.psql(
             '-c', "SELECT 1 FROM pg_database WHERE datname='{}';".format(
-                db['name']), admin=True)
+                db['name']), admin=True))
         if dbexists.strip() == '1':
             log.info('Database exists: %s', db['name'])
         else:
@@ -281,37 +948,127 @@ class DbAdmin(object):
             if not self.args.dry_run:
                 self.psql('-c', "CREATE DATABASE {} WITH OWNER {};".format(
                     db['name'], db['user']), admin=True)
+                self.invalidate('create database')
 
         if not self.args.dry_run:
             self.check_connection()
 
+    def status(self):
+        """
+        Report the state of the database and server setup for monitoring.
+        Everything from the database is fetched in a single query, other
+        checks are local.
+        """
+        status = {'up': False}
+        top = getattr(self.args, 'top', None) or STATUS_TOP_TABLES
+        # A scrape should fail rather than hang if the server is unreachable
+        timeout = getattr(self.args, 'connect_timeout', None)
+        if timeout is None:
+            timeout = CONNECT_TIMEOUT
+        try:
+            start = time.time()
+            out = self.psql('-c', STATUS_QUERY.format(top=int(top)),
+                            connect_timeout=timeout)
+            status['latency'] = time.time() - start
+            status.update(parse_status_query(out))
+            status['up'] = True
+        except RunException as e:
+            log.error(e)
+
+        M, versions = self.sql_version_matrix()
+        if versions:
+            status['latest'] = str(versions[-1])
+            if status.get('version'):
+                status['upgrade_needed'] = SchemaVersion(
+                    status['version']) < versions[-1]
+
+        cfgmap = self.external.get_config(raise_missing=False)
+        if cfgmap.get('postgres.data.dir'):
+            pgstatus = self.pgstatus(cfgmap)
+            status['postgres_running'] = pgstatus['running']
+            if pgstatus.get('uptime') is not None:
+                status['postgres_uptime'] = round(pgstatus['uptime'])
+        certdir = cfgmap.get('omero.glacier2.IceSSL.DefaultDir')
+        certfile = cfgmap.get('omero.glacier2.IceSSL.CAs')
+        if certdir and certfile and os.path.exists(
+                os.path.join(certdir, certfile)):
+            try:
+                notafter = get_backend().read_certificate(
+                    os.path.join(certdir, certfile))['notafter']
+                status['certificate_expiry'] = (
+                    notafter - datetime.utcnow()).total_seconds()
+            except (OSError, RunException, ValueError) as e:
+                log.warning('Unable to read certificate %s: %s',
+                            certfile, e)
+
+        db, env = self.get_db_args_env()
+        try:
+            dumps = list_dumps(
+                getattr(self.args, 'dump_dir', None) or '.', db['name'])
+        except OSError as e:
+            log.warning('Unable to list dumps: %s', e)
+            dumps = []
+        if dumps:
+            status['last_dump_age'] = (
+                datetime.now() - dumps[-1][0]).total_seconds()
+
+        if getattr(self.args, 'format', None) == 'prometheus':
+            self.out(*format_prometheus(status))
+        else:
+            self.out(json.dumps(status, sort_keys=True))
+        return status
+
     def get_current_db_version(self):
         q = ('SELECT currentversion, currentpatch FROM dbpatch '
              'ORDER BY id DESC LIMIT 1')
-        log.debug('Executing query: %s', q)
-        result = self.psql('-c', q)
-        # Ignore empty string
-        result = [r for r in result.split(os.linesep) if r]
-        if len(result) != 1:
-            raise Exception('Got %d rows, expected 1', len(result))
-        v = tuple(result[0].split('|'))
-        log.info('Current omero db version: %s', v)
-        return v
+
+        def fetch():
+            log.debug('Executing query: %s', q)
+            result = self.psql('-c', q)
+            # Ignore empty string
+            result = [r for r in result.split(os.linesep) if r]
+            if len(result) != 1:
+                raise Exception('Got %d rows, expected 1', len(result))
+            v = SchemaVersion.from_db(*result[0].split('|'))
+            log.info('Current omero db version: %s', v)
+            return v
+
+        return self.memoize('db_version', fetch)
 
     def dump(self):
         """
-        Dump the database using the postgres custom format
+        Dump the database using the postgres custom format, and optionally
+        delete old dumps
         """
+        dumpdir = getattr(self.args, 'dump_dir', None)
+        if getattr(self.args, 'list', False):
+            db, env = self.get_db_args_env()
+            self.out(*format_dump_index(dumpdir or '.', db['name']))
+            return
+
         self.check_connection()
         dumpfile = self.args.dumpfile
         if not dumpfile:
             db, env = self.get_db_args_env()
-            dumpfile = timestamp_filename(
-                'omero-database-%s' % db['name'], 'pgdump')
+            dumpfile = timestamp_filename(dump_basename(db['name']), 'pgdump')
+            if dumpdir:
+                dumpfile = os.path.join(dumpdir, dumpfile)
 
         log.info('Dumping database to %s', dumpfile)
+        self.check_client_version('pg_dump')
         if not self.args.dry_run:
+            start = time.time()
             self.pgdump('-Fc', '-f', dumpfile)
+            record_dump(dumpfile, time.time() - start)
+
+        keep = dict((k, getattr(self.args, k, None) or 0) for k in (
+            'keep_last', 'keep_daily', 'keep_weekly'))
+        if any(keep.values()):
+            db, env = self.get_db_args_env()
+            deleted = prune_dumps(
+                dumpdir or os.path.dirname(dumpfile) or '.', db['name'],
+                dry_run=self.args.dry_run, **keep)
+            log.info('Deleted %d old dumps', len(deleted))
 
     def get_config_with_defaults(self):
         if self.args.no_db_config:
@@ -343,6 +1100,12 @@ class DbAdmin(object):
         update_value('omero.db.user', 'dbuser', 'omero')
         update_value('omero.db.pass', 'dbpass', 'omero')
         update_value('postgres.admin.user', 'adminuser', 'postgres')
+        if cfgmap.get('postgres.socket.dir'):
+            created['postgres.socket.dir'] = cfgmap['postgres.socket.dir']
+        # If OMERO.server connects through a pooler omero.db.port is the
+        # pooler, this plugin connects to PostgreSQL directly
+        if cfgmap.get('postgres.port'):
+            created['omero.db.port'] = cfgmap['postgres.port']
 
         return created
 
@@ -359,6 +1122,11 @@ class DbAdmin(object):
             db[k] = cfg['omero.db.%s' % k]
         if not db['name']:
             raise Exception('Database name required')
+        # Prefer the Unix socket of a managed server if it's running
+        socketdir = cfg.get('postgres.socket.dir')
+        if socketdir and os.path.exists(os.path.join(
+                socketdir, '.s.PGSQL.{}'.format(db['port']))):
+            db['host'] = socketdir
 
         env = os.environ.copy()
         env['PGPASSWORD'] = db['pass']
@@ -370,19 +1138,22 @@ class DbAdmin(object):
                 env['PGPASSWORD'] = self.args.adminpass
         return db, env
 
-    def psql(self, *psqlargs, admin=False, version=False):
+    def psql(self, *psqlargs, admin=False, appname=None,
+             connect_timeout=None, settings=None):
         """
         Run a psql command
+        :param appname: Set the application_name of the database session
+        :param connect_timeout: Maximum seconds to wait for a connection
+        :param settings: Dictionary of settings for the database session
         """
-        if version:
-            stdout, stderr = run(
-                'psql', ['--version'], capturestd=True)
-            if stderr:
-                log.warning('stderr: %s', stderr)
-            log.debug('stdout: %s', stdout)
-            return stdout.decode()
-
         db, env = self.get_db_args_env(admin=admin)
+        if appname:
+            env['PGAPPNAME'] = appname
+        if connect_timeout:
+            env['PGCONNECT_TIMEOUT'] = str(connect_timeout)
+        if settings:
+            env['PGOPTIONS'] = ' '.join(filter(None, (
+                env.get('PGOPTIONS'), session_options(settings))))
 
         args = [
             '-v', 'ON_ERROR_STOP=on',
@@ -408,8 +1179,8 @@ class DbAdmin(object):
         """
         db, env = self.get_db_args_env()
 
-        args = ['-d', db['name'], '-h', db['host'], '-U', db['user'], '-w'
-                ] + list(pgdumpargs)
+        args = ['-d', db['name'], '-h', db['host'], '-p', db['port'],
+                '-U', db['user'], '-w'] + list(pgdumpargs)
         stdout, stderr = run(
             'pg_dump', args, capturestd=True, env=env)
         if stderr:
@@ -417,6 +1188,21 @@ class DbAdmin(object):
         log.debug('stdout: %s', stdout)
         return stdout.decode()
 
+    def pgrestore(self, *pgrestoreargs):
+        """
+        Run a pg_restore command
+        """
+        db, env = self.get_db_args_env()
+
+        args = ['-d', db['name'], '-h', db['host'], '-p', db['port'],
+                '-U', db['user'], '-w'] + list(pgrestoreargs)
+        stdout, stderr = run(
+            'pg_restore', args, capturestd=True, env=env)
+        if stderr:
+            log.warning('stderr: %s', stderr)
+        log.debug('stdout: %s', stdout)
+        return stdout.decode()
+
     # PostgreSQL management
 
     def get_and_check_config(self):
@@ -442,28 +1228,368 @@ class DbAdmin(object):
 
     def pgstart(self):
         cfg = self.get_and_check_config()
-        if self.pgisrunning():
+        if self.pgisrunning(cfg):
             log.info('PostgreSQL server already running, restarting')
             cmd = 'restart'
         else:
             log.info('Starting PostgreSQL server')
             cmd = 'start'
         logfile = os.path.join(cfg['postgres.data.dir'], 'postgres.log')
+        options = '-p {}'.format(
+            cfg.get('postgres.port') or cfg['omero.db.port'])
+        socketdir = cfg.get('postgres.socket.dir')
+        if socketdir:
+            os.makedirs(socketdir, mode=0o700, exist_ok=True)
+            options += ' -k "{}"'.format(socketdir)
+        try:
+            if cfg.get('postgres.max_connections'):
+                options += ' -c max_connections={}'.format(
+                    int(cfg['postgres.max_connections']))
+            if cfg.get('postgres.shared_buffers'):
+                options += ' -c shared_buffers={}'.format(format_memory(
+                    parse_memory(cfg['postgres.shared_buffers'])))
+        except ValueError as e:
+            raise Stop(70, 'Invalid PostgreSQL setting: {}'.format(e))
         self.pg_ctl(
             cmd,
             '--log={}'.format(logfile),
-            '-o', '-p {}'.format(cfg['omero.db.port'])
+            '-o', options,
+            cfg=cfg
         )
+        if cfg.get('postgres.pooler.dir'):
+            self.poolerstart(cfg)
 
     def pgstop(self):
-        if not self.pgisrunning():
+        """
+        Run a checkpoint then stop the local PostgreSQL server, so most
+        dirty buffers are written whilst the server is still available and
+        the shutdown checkpoint is short
+        """
+        cfg = self.get_and_check_config()
+        if cfg.get('postgres.pooler.dir'):
+            self.poolerstop(cfg)
+        if not self.pgisrunning(cfg):
             log.info('PostgreSQL server already stopped')
-        else:
-            log.info('Stopping PostgreSQL server')
-            self.pg_ctl('stop')
+            return
+        # Don't let a wedged server block the stop
+        timeout = getattr(self.args, 'timeout', None) or CHECKPOINT_TIMEOUT
+        start = time.time()
+        try:
+            self.psql('-c', 'CHECKPOINT', admin=True,
+                      connect_timeout=CONNECT_TIMEOUT,
+                      settings={'statement_timeout': '{}s'.format(timeout)})
+            self.out('Checkpoint completed in {}'.format(
+                format_seconds(time.time() - start)))
+        except RunException as e:
+            log.warning('Checkpoint failed, stopping anyway: %s', e)
+
+        log.info('Stopping PostgreSQL server')
+        args = ['stop', '--mode={}'.format(
+            getattr(self.args, 'mode', None) or 'fast')]
+        if getattr(self.args, 'timeout', None):
+            args.append('--timeout={}'.format(self.args.timeout))
+        start = time.time()
+        self.pg_ctl(*args, cfg=cfg)
+        self.out('PostgreSQL stopped in {}'.format(
+            format_seconds(time.time() - start)))
+
+    def write_pooler_config(self, cfg):
+        """
+        Write the PgBouncer configuration and auth files for the OMERO
+        database. Pool sizes are based on omero.db.poolsize and the number
+        of CPUs.
+        :return: The path to the configuration file
+        """
+        poolerdir = cfg['postgres.pooler.dir']
+        os.makedirs(poolerdir, mode=0o700, exist_ok=True)
+        # The auth file contains the password so create it private
+        userlist = os.path.join(poolerdir, POOLER_USERLIST)
+        fd = os.open(userlist, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(format_userlist(
+                {cfg['omero.db.user']: cfg['omero.db.pass']}))
+
+        memory, cpus = host_resources()
+        sizes = pool_sizes(
+            cfg.get('omero.db.poolsize') or DEFAULT_OMERO_POOLSIZE, cpus)
+        log.info('PgBouncer pool sizes: %s', sizes)
+        ini = os.path.join(poolerdir, POOLER_INI)
+        with open(ini, 'w') as f:
+            f.write(format_pgbouncer_ini(
+                poolerdir,
+                cfg.get('postgres.pooler.port') or DEFAULT_POOLER_PORT,
+                cfg['omero.db.name'],
+                cfg.get('postgres.socket.dir') or cfg['omero.db.host'],
+                cfg.get('postgres.port') or cfg['omero.db.port'],
+                sizes))
+        return ini
+
+    def pooler_pid(self, cfg):
+        """
+        Get the PID of the running PgBouncer, or None
+        """
+        pidfile = os.path.join(cfg['postgres.pooler.dir'], POOLER_PIDFILE)
+        try:
+            with open(pidfile) as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+        return pid if process_exists(pid) else None
 
-    def pg_ctl(self, *args, capturestd=False, stop_error=True):
+    def poolerstart(self, cfg):
+        """
+        Start PgBouncer, or reload its configuration if it's running
+        """
+        ini = self.write_pooler_config(cfg)
+        pid = self.pooler_pid(cfg)
+        if pid:
+            log.info('Reloading PgBouncer configuration')
+            os.kill(pid, signal.SIGHUP)
+            return
+        if not self.toolchain.get('pgbouncer'):
+            raise Stop(60, 'pgbouncer not found')
+        log.info('Starting PgBouncer')
+        try:
+            run('pgbouncer', ['-d', ini])
+        except RunException as e:
+            log.fatal(e)
+            raise Stop(61, 'Failed to start PgBouncer')
+
+    def poolerstop(self, cfg):
+        """
+        Stop PgBouncer after the transactions in progress have finished
+        """
+        pid = self.pooler_pid(cfg)
+        if not pid:
+            log.info('PgBouncer already stopped')
+            return
+        log.info('Stopping PgBouncer')
+        os.kill(pid, signal.SIGINT)
+        deadline = time.time() + POOLER_STOP_TIMEOUT
+        while process_exists(pid):
+            if time.time() > deadline:
+                raise Stop(61, 'PgBouncer did not stop within {} s'.format(
+                    POOLER_STOP_TIMEOUT))
+            time.sleep(0.1)
+
+    def backup(self):
+        """
+        Take, list or restore physical base backups of the local PostgreSQL
+        server, or enable WAL archiving for point-in-time recovery
+        """
         cfg = self.get_and_check_config()
+        backupdir = self.args.backup_dir
+        if not backupdir:
+            if not cfg.get('omero.data.dir'):
+                raise Stop(50, 'omero.data.dir or --backup-dir required')
+            backupdir = os.path.join(cfg['omero.data.dir'], 'pgbackup')
+        basedir, waldir = get_backup_dirs(os.path.abspath(backupdir))
+
+        if self.args.list:
+            for b in read_index(basedir):
+                self.out('{}\t{}\t{}\t{}\t{}'.format(
+                    b['label'], b['type'], b['time'], b['compress'],
+                    format_bytes(b['size'])))
+        elif self.args.restore:
+            self.restore_base_backup(cfg, basedir, waldir)
+        elif self.args.archive_wal:
+            self.enable_wal_archive(waldir)
+        else:
+            self.take_base_backup(basedir, waldir)
+
+    def take_base_backup(self, basedir, waldir):
+        backups = read_index(basedir)
+        backuptype = self.args.type
+        parent = choose_parent(backups, backuptype)
+        if backuptype != 'full' and not parent:
+            log.warning('No previous backup found, taking a full backup')
+            backuptype = 'full'
+
+        label = timestamp_filename(backuptype)
+        path = os.path.join(basedir, label)
+        args = ['-D', path, '-X', 'stream', '--checkpoint=fast', '-l', label]
+        if self.args.compress == 'none':
+            args.append('-Fp')
+        else:
+            args += ['-Ft', '--compress=client-{}'.format(self.args.compress)]
+        if parent:
+            args.append('--incremental={}'.format(os.path.join(
+                basedir, parent['label'], 'backup_manifest')))
+
+        log.info('Taking %s backup %s', backuptype, path)
+        self.check_client_version('pg_basebackup')
+        if self.args.dry_run:
+            return
+        os.makedirs(basedir, exist_ok=True)
+        start = time.time()
+        self.pgbasebackup(*args)
+        backup = {
+            'label': label,
+            'type': backuptype,
+            'parent': parent['label'] if parent else None,
+            'time': datetime.now().astimezone().isoformat(timespec='seconds'),
+            'compress': self.args.compress,
+            'start_wal': read_manifest_start_wal(path),
+            'size': directory_size(path),
+        }
+        backups.append(backup)
+        write_index(basedir, backups)
+        self.out('Backup {} completed in {}, {}'.format(
+            label, format_seconds(time.time() - start),
+            format_bytes(backup['size'])))
+
+        if self.args.keep_full:
+            self.expire_base_backups(basedir, waldir, backups)
+
+    def expire_base_backups(self, basedir, waldir, backups):
+        """
+        Delete backups and archived WAL that are no longer needed to restore
+        the latest --keep-full full backups and the backups based on them
+        """
+        expired = select_expired(backups, self.args.keep_full)
+        backups = [b for b in backups if b not in expired]
+        write_index(basedir, backups)
+        for b in expired:
+            log.info('Deleting expired backup %s', b['label'])
+            shutil.rmtree(os.path.join(basedir, b['label']))
+        if backups and os.path.isdir(waldir):
+            # pg_archivecleanup ignores the timeline when comparing segments
+            oldest = min(backups, key=lambda b: b['start_wal'][8:])
+            self.pgtool('pg_archivecleanup', waldir, oldest['start_wal'])
+
+    def enable_wal_archive(self, waldir):
+        """
+        Archive WAL to the backup directory for point-in-time recovery, and
+        enable WAL summaries required for incremental backups
+        """
+        settings = [
+            ('archive_mode', 'on'),
+            ('archive_command',
+             'test ! -f "{0}/%f" && cp "%p" "{0}/%f"'.format(waldir)),
+        ]
+        if self.get_server_version_num() >= 170000:
+            settings.append(('summarize_wal', 'on'))
+        os.makedirs(waldir, exist_ok=True)
+        for name, value in settings:
+            self.psql('-c', "ALTER SYSTEM SET {} = '{}';".format(
+                name, value.replace("'", "''")), admin=True)
+        self.out('WAL archiving to {} enabled, restart PostgreSQL with '
+                 'omero setup pgstart'.format(waldir))
+
+    def restore_base_backup(self, cfg, basedir, waldir):
+        """
+        Replace the PostgreSQL data directory with a base backup, combining
+        incremental backups and replaying archived WAL up to --target-time
+        if given. The previous data directory is kept.
+        """
+        if self.pgisrunning():
+            raise Stop(51, 'Stop PostgreSQL before restoring a backup')
+        backups = read_index(basedir)
+        target = None
+        if self.args.target_time:
+            try:
+                target = parse_time(self.args.target_time).astimezone()
+            except ValueError:
+                raise Stop(54, 'Invalid --target-time {}, use an ISO 8601 '
+                           'time such as 2026-10-01T12:00:00'.format(
+                               self.args.target_time))
+            if not os.path.isdir(waldir):
+                raise Stop(53, 'Point-in-time recovery requires archived WAL '
+                           'in {}'.format(waldir))
+        if self.args.restore == 'latest':
+            backup = select_restore_backup(backups, target)
+            if not backup:
+                raise Stop(52, 'No backup found')
+        else:
+            try:
+                backup = find_backup(backups, self.args.restore)
+            except KeyError as e:
+                raise Stop(52, str(e))
+        chain = backup_chain(backups, backup['label'])
+        log.info('Restoring %s', ' '.join(b['label'] for b in chain))
+
+        datadir = os.path.abspath(cfg['postgres.data.dir'])
+        staging = datadir + '.restore'
+        restored = os.path.join(staging, 'pgdata')
+        if os.path.exists(staging):
+            raise Stop(55, '{} exists, a previous restore may have been '
+                       'interrupted. Check and remove it.'.format(staging))
+        if self.args.dry_run:
+            return
+        start = time.time()
+        os.makedirs(staging)
+        dirs = []
+        for b in chain:
+            path = os.path.join(basedir, b['label'])
+            if b['compress'] != 'none':
+                extracted = os.path.join(staging, b['label'])
+                self.extract_base_backup(path, extracted, b['compress'])
+                path = extracted
+            dirs.append(path)
+        if len(dirs) > 1:
+            self.pgtool('pg_combinebackup', *dirs, '-o', restored)
+        elif chain[0]['compress'] != 'none':
+            os.rename(dirs[0], restored)
+        else:
+            shutil.copytree(dirs[0], restored)
+
+        if os.path.isdir(waldir):
+            with open(os.path.join(restored, 'postgresql.auto.conf'),
+                      'a') as f:
+                f.write("restore_command = 'cp \"{}/%f\" \"%p\"'\n".format(
+                    waldir))
+                f.write("recovery_target_time = '{}'\n".format(
+                    target.isoformat() if target else ''))
+                f.write("recovery_target_action = 'promote'\n")
+            open(os.path.join(restored, 'recovery.signal'), 'w').close()
+        os.chmod(restored, 0o700)
+
+        previous = None
+        if os.path.exists(datadir):
+            previous = timestamp_filename(datadir)
+            os.rename(datadir, previous)
+        os.rename(restored, datadir)
+        shutil.rmtree(staging)
+        self.out('Restored {} in {}'.format(
+            backup['label'], format_seconds(time.time() - start)))
+        if previous:
+            self.out('Previous data directory moved to {}'.format(previous))
+
+    def extract_base_backup(self, path, dest, compress):
+        """
+        Extract a tar format base backup so it can be restored or combined
+        """
+        program = {'gzip': 'gzip', 'lz4': 'lz4', 'zstd': 'zstd'}[compress]
+        os.makedirs(dest)
+        for name, target in (('base', dest),
+                             ('pg_wal', os.path.join(dest, 'pg_wal'))):
+            os.makedirs(target, exist_ok=True)
+            for tarfile in glob(os.path.join(path, name + '.tar*')):
+                self.pgtool('tar', '-I', program, '-xf', tarfile, '-C', target)
+        shutil.copy(os.path.join(path, 'backup_manifest'), dest)
+
+    def pgbasebackup(self, *args):
+        """
+        Run a pg_basebackup command as the PostgreSQL admin user
+        """
+        db, env = self.get_db_args_env(admin=True)
+        args = ['-h', db['host'], '-p', db['port'], '-U', db['user'],
+                '-w'] + list(args)
+        return self.pgtool('pg_basebackup', *args, env=env)
+
+    def pgtool(self, exe, *args, env=None):
+        """
+        Run a PostgreSQL client program or other external command
+        """
+        stdout, stderr = run(exe, list(args), capturestd=True, env=env)
+        if stderr:
+            log.warning('stderr: %s', stderr)
+        log.debug('stdout: %s', stdout)
+        return stdout.decode()
+
+    def pg_ctl(self, *args, capturestd=False, stop_error=True, cfg=None):
+        if cfg is None:
+            cfg = self.get_and_check_config()
         pgdata = '--pgdata={}'.format(cfg['postgres.data.dir'])
         try:
             stdout, stderr = run(
@@ -480,13 +1606,28 @@ class DbAdmin(object):
             log.debug('stdout: %s', stdout)
             return stdout.decode()
 
-    def pgisrunning(self):
+    def pgstatus(self, cfg=None):
+        """
+        Get the state of the managed PostgreSQL server from postmaster.pid,
+        falling back to pg_ctl status if it can't be read
+        :return: A dictionary, see read_postmaster_status
+        """
+        if cfg is None:
+            cfg = self.get_and_check_config()
+        datadir = cfg['postgres.data.dir']
+        try:
+            return read_postmaster_status(datadir)
+        except PidFileUnreadable as e:
+            log.debug('Using pg_ctl status: %s', e)
         # Exit code: 0=>running, 3=>not running
         try:
-            self.pg_ctl('status', capturestd=True, stop_error=False)
-            return True
+            self.pg_ctl('status', capturestd=True, stop_error=False, cfg=cfg)
+            return {'running': True, 'datadir': datadir}
         except RunException as e:
             if e.r == 3:
-                return False
+                return {'running': False, 'datadir': datadir}
             else:
                 raise
+
+    def pgisrunning(self, cfg=None):
+        return self.pgstatus(cfg)['running']
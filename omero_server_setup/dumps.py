@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Index and rotation of database dumps
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+
+from .formatting import (
+    format_bytes,
+    format_seconds,
+)
+
+log = logging.getLogger(__name__)
+
+# Index of dumps in a dump directory
+DUMP_INDEX = 'omero-database-dumps.json'
+
+# Timestamp format used by timestamp_filename
+TIMESTAMP_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+_DUMP_REGEXP = r'^{}-(\d{{8}}-\d{{6}}-\d{{6}})\.pgdump$'
+
+
+def dump_basename(dbname):
+    return 'omero-database-%s' % dbname
+
+
+def parse_dump_timestamp(filename, dbname):
+    """
+    Get the time a dump was started from its filename
+    :return: A datetime, or None if the filename doesn't match
+    """
+    m = re.match(_DUMP_REGEXP.format(re.escape(dump_basename(dbname))),
+                 os.path.basename(filename))
+    if not m:
+        return None
+    return datetime.strptime(m.group(1), TIMESTAMP_FORMAT)
+
+
+def file_sha256(filename, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_dump_index(dumpdir):
+    """
+    Read the index of dumps, a dictionary of filename: entry
+    """
+    try:
+        with open(os.path.join(dumpdir, DUMP_INDEX)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_dump_index(dumpdir, index):
+    indexfile = os.path.join(dumpdir, DUMP_INDEX)
+    with open(indexfile + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(indexfile + '.tmp', indexfile)
+
+
+def record_dump(dumpfile, seconds):
+    """
+    Add a completed dump to the index in its directory, including its size
+    and checksum so that listing dumps doesn't need to read them
+    """
+    dumpdir = os.path.dirname(dumpfile) or '.'
+    entry = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'seconds': seconds,
+        'size': os.path.getsize(dumpfile),
+        'sha256': file_sha256(dumpfile),
+    }
+    index = read_dump_index(dumpdir)
+    index[os.path.basename(dumpfile)] = entry
+    write_dump_index(dumpdir, index)
+    return entry
+
+
+def list_dumps(dumpdir, dbname):
+    """
+    Find the timestamped dumps of a database
+    :return: A list of (datetime, filename) sorted oldest first
+    """
+    dumps = []
+    for f in os.listdir(dumpdir):
+        t = parse_dump_timestamp(f, dbname)
+        if t:
+            dumps.append((t, f))
+    return sorted(dumps)
+
+
+def select_dumps_to_keep(dumps, keep_last=0, keep_daily=0, keep_weekly=0):
+    """
+    Choose the dumps to keep: the newest keep_last dumps, and the newest
+    dump of each of the latest keep_daily days and keep_weekly ISO weeks
+    that have a dump
+    :param dumps: A list of (datetime, filename) sorted oldest first
+    :return: A set of filenames
+    """
+    newest = list(reversed(dumps))
+    keep = set(f for t, f in newest[:keep_last])
+    for n, period in (
+            (keep_daily, lambda t: t.date()),
+            (keep_weekly, lambda t: t.isocalendar()[:2])):
+        seen = set()
+        for t, f in newest:
+            if len(seen) >= n:
+                break
+            p = period(t)
+            if p not in seen:
+                seen.add(p)
+                keep.add(f)
+    return keep
+
+
+def prune_dumps(dumpdir, dbname, keep_last=0, keep_daily=0, keep_weekly=0,
+                dry_run=False, jobs=None):
+    """
+    Delete dumps that aren't selected by the retention policy. The newest
+    dump that completed successfully is always kept, as are dumps with
+    names that don't contain a timestamp.
+    :return: The list of deleted filenames
+    """
+    dumps = list_dumps(dumpdir, dbname)
+    keep = select_dumps_to_keep(dumps, keep_last, keep_daily, keep_weekly)
+    index = read_dump_index(dumpdir)
+    for t, f in reversed(dumps):
+        entry = index.get(f)
+        if entry and entry['size'] == os.path.getsize(
+                os.path.join(dumpdir, f)):
+            keep.add(f)
+            break
+    else:
+        log.warning('No completed dumps found in index, keeping all dumps')
+        return []
+
+    delete = [f for t, f in dumps if f not in keep]
+    for f in delete:
+        log.info('Deleting dump %s', f)
+    if dry_run or not delete:
+        return delete
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(
+            lambda f: os.remove(os.path.join(dumpdir, f)), delete))
+    for f in delete:
+        index.pop(f, None)
+    write_dump_index(dumpdir, index)
+    return delete
+
+
+def format_dump_index(dumpdir, dbname):
+    """
+    Describe the dumps of a database using the index
+    """
+    lines = []
+    index = read_dump_index(dumpdir)
+    for t, f in list_dumps(dumpdir, dbname):
+        entry = index.get(f)
+        if entry:
+            lines.append('{}\t{}\t{}\t{}'.format(
+                f, format_bytes(entry['size']),
+                format_seconds(entry['seconds']), entry['sha256']))
+        else:
+            lines.append('{}\t-\t-\t-'.format(f))
+    return lines
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Estimate the duration and impact of OMERO database upgrade scripts
+"""
+
+from collections import namedtuple
+import logging
+import os
+import re
+
+from .formatting import (
+    format_bytes,
+    format_seconds,
+)
+
+log = logging.getLogger(__name__)
+
+# Rough PostgreSQL throughput, used to turn relation sizes into durations.
+# These are deliberately conservative figures for a single backend process.
+SCAN_BYTES_PER_SECOND = 200e6
+REWRITE_BYTES_PER_SECOND = 50e6
+INDEX_BYTES_PER_SECOND = 40e6
+UPDATE_BYTES_PER_SECOND = 30e6
+STATEMENT_OVERHEAD_SECONDS = 0.001
+# Approximate size of an index entry
+INDEX_BYTES_PER_ROW = 40
+
+# Kinds of statement, in increasing order of cost
+KIND_OTHER = 'other'
+KIND_ALTER = 'alter'
+KIND_SCAN = 'scan'
+KIND_UPDATE = 'update'
+KIND_INDEX = 'index'
+KIND_REWRITE = 'rewrite'
+
+LOCK_LEVELS = (
+    'ACCESS SHARE',
+    'ROW SHARE',
+    'ROW EXCLUSIVE',
+    'SHARE UPDATE EXCLUSIVE',
+    'SHARE',
+    'SHARE ROW EXCLUSIVE',
+    'EXCLUSIVE',
+    'ACCESS EXCLUSIVE',
+)
+
+Statement = namedtuple('Statement', ['text', 'line', 'start', 'end'])
+"""
+A SQL statement from a script, line is the 1-based line number of the start
+of the statement, start and end are byte offsets in the script
+"""
+
+Classification = namedtuple('Classification', ['kind', 'table', 'lock'])
+
+_IDENT = r'((?:"[^"]+"|[\w$]+)(?:\.(?:"[^"]+"|[\w$]+))?)'
+
+_CLASSIFIERS = [(re.compile(r, re.IGNORECASE | re.DOTALL), f) for (r, f) in (
+    (r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s.*?\bON\s+(?:ONLY\s+)?'
+     + _IDENT, (KIND_INDEX, 'SHARE UPDATE EXCLUSIVE')),
+    (r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s.*?\bON\s+(?:ONLY\s+)?' + _IDENT,
+     (KIND_INDEX, 'SHARE')),
+    (r'^ALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?' + _IDENT +
+     r'\s+(.*)$', None),
+    (r'^UPDATE\s+(?:ONLY\s+)?' + _IDENT + r'\s+(.*)$', None),
+    (r'^DELETE\s+FROM\s+(?:ONLY\s+)?' + _IDENT + r'\s*(.*)$', None),
+    (r'^INSERT\s+INTO\s.*?\bSELECT\b.*?\bFROM\s+(?:ONLY\s+)?' + _IDENT,
+     (KIND_SCAN, 'ROW EXCLUSIVE')),
+    (r'^(?:CLUSTER|VACUUM\s+FULL)\s+(?:VERBOSE\s+)?' + _IDENT,
+     (KIND_REWRITE, 'ACCESS EXCLUSIVE')),
+    (r'^(?:TRUNCATE|DROP\s+TABLE)\s+(?:TABLE\s+)?(?:IF\s+EXISTS\s+)?' +
+     _IDENT, (KIND_ALTER, 'ACCESS EXCLUSIVE')),
+)]
+
+_ALTER_ACTIONS = [(re.compile(r, re.IGNORECASE | re.DOTALL), c) for (r, c) in (
+    (r'\bALTER\s+(?:COLUMN\s+)?\S+\s+(?:SET\s+DATA\s+)?TYPE\b',
+     (KIND_REWRITE, 'ACCESS EXCLUSIVE')),
+    (r'\bSET\s+TABLESPACE\b', (KIND_REWRITE, 'ACCESS EXCLUSIVE')),
+    (r'\bADD\s+(?:CONSTRAINT\s+\S+\s+)?(?:PRIMARY\s+KEY|UNIQUE)\b',
+     (KIND_INDEX, 'ACCESS EXCLUSIVE')),
+    (r'\bADD\s+(?:CONSTRAINT\s+\S+\s+)?FOREIGN\s+KEY\b',
+     (KIND_SCAN, 'SHARE ROW EXCLUSIVE')),
+    (r'\bADD\s+(?:CONSTRAINT\s+\S+\s+)?CHECK\b',
+     (KIND_SCAN, 'ACCESS EXCLUSIVE')),
+    (r'\bSET\s+NOT\s+NULL\b', (KIND_SCAN, 'ACCESS EXCLUSIVE')),
+)]
+
+# Adding a column with a default rewrites the table before PostgreSQL 11,
+# and afterwards only if the default is volatile (assume any function is)
+_ADD_DEFAULT = re.compile(
+    r'\bADD\s+(?:COLUMN\s+)?\S+\s.*\bDEFAULT\b(.*)', re.IGNORECASE)
+
+
+_SQL_TOKEN = re.compile(r"""
+    --[^\n]*                       # Line comment
+  | /\*.*?\*/                      # Block comment
+  | '(?:[^']|'')*'                  # String
+  | "(?:[^"]|"")*"                  # Quoted identifier
+  | \$([A-Za-z_]*)\$.*?\$\1\$        # Dollar-quoted string
+  | [^;'"$\-/\s\\]+                # Anything else
+  | \s+
+  | .
+""", re.DOTALL | re.VERBOSE)
+
+
+def split_sql_statements(sql):
+    """
+    Split a SQL script into statements, handling quoted strings and
+    identifiers, comments, dollar-quoted strings, and psql meta-commands.
+    Returns a list of Statement.
+    """
+    statements = []
+    n = len(sql)
+    pos = 0
+    line = 1
+    start = None
+    startline = None
+    # Byte offsets are calculated incrementally to handle multi-byte
+    # characters without repeatedly encoding the script
+    offsets = [0, 0]
+
+    def byteoffset(i):
+        offsets[1] += len(sql[offsets[0]:i].encode())
+        offsets[0] = i
+        return offsets[1]
+
+    def add(end):
+        text = sql[start:end].strip()
+        if text:
+            statements.append(Statement(
+                text, startline, byteoffset(start), byteoffset(end)))
+
+    while pos < n:
+        m = _SQL_TOKEN.match(sql, pos)
+        token = m.group()
+        if start is None and not (
+                token.isspace() or token.startswith(('--', '/*', ';'))):
+            start = pos
+            startline = line
+            if token == '\\':
+                # psql meta-command, ends at the end of the line
+                end = sql.find('\n', pos)
+                end = n if end < 0 else end
+                add(end)
+                start = None
+                pos = end
+                continue
+        if token == ';' and start is not None:
+            add(pos)
+            start = None
+        line += token.count('\n')
+        pos = m.end()
+    if start is not None:
+        add(n)
+    return statements
+
+
+def _table_name(ident):
+    name = ident.rsplit('.', 1)[-1]
+    if name.startswith('"'):
+        return name.strip('"')
+    return name.lower()
+
+
+def classify_statement(text, server_version_num=None):
+    """
+    Statically classify a SQL statement by the kind of work it does, the
+    table it affects, and the lock it takes
+    :param server_version_num: PostgreSQL server_version_num, if None assume
+           the oldest supported version
+    """
+    normalised = ' '.join(text.split())
+    for regexp, classification in _CLASSIFIERS:
+        m = regexp.match(normalised)
+        if not m:
+            continue
+        table = _table_name(m.group(1))
+        if classification:
+            return Classification(classification[0], table, classification[1])
+        rest = m.group(2)
+        verb = normalised.split(None, 1)[0].upper()
+        if verb == 'ALTER':
+            for actionre, c in _ALTER_ACTIONS:
+                if actionre.search(rest):
+                    return Classification(c[0], table, c[1])
+            m = _ADD_DEFAULT.search(rest)
+            if m and (not server_version_num or server_version_num < 110000
+                      or re.search(r'\w\s*\(', m.group(1))):
+                return Classification(KIND_REWRITE, table, 'ACCESS EXCLUSIVE')
+            return Classification(KIND_ALTER, table, 'ACCESS EXCLUSIVE')
+        # UPDATE or DELETE, a full-table update rewrites every row
+        if re.search(r'\bWHERE\b', rest, re.IGNORECASE):
+            return Classification(KIND_SCAN, table, 'ROW EXCLUSIVE')
+        return Classification(KIND_UPDATE, table, 'ROW EXCLUSIVE')
+    return Classification(KIND_OTHER, None, None)
+
+
+def estimate_statement(classification, stats):
+    """
+    Estimate the duration in seconds and additional disk space in bytes
+    required for a classified statement
+    :param stats: A dictionary of table name to a dictionary of rows,
+           size (table only) and totalsize (including indexes and toast)
+    """
+    seconds = STATEMENT_OVERHEAD_SECONDS
+    disk = 0
+    table = stats.get(classification.table)
+    if not table:
+        return seconds, disk
+    kind = classification.kind
+    if kind == KIND_REWRITE:
+        seconds += table['totalsize'] / REWRITE_BYTES_PER_SECOND
+        disk = table['totalsize']
+    elif kind == KIND_INDEX:
+        seconds += table['size'] / INDEX_BYTES_PER_SECOND
+        disk = table['rows'] * INDEX_BYTES_PER_ROW
+    elif kind == KIND_UPDATE:
+        seconds += table['totalsize'] / UPDATE_BYTES_PER_SECOND
+        disk = table['totalsize']
+    elif kind == KIND_SCAN:
+        seconds += table['size'] / SCAN_BYTES_PER_SECOND
+    return seconds, disk
+
+
+def estimate_upgrade(scripts, stats, server_version_num=None, top=10):
+    """
+    Estimate the impact of running a list of upgrade scripts.
+    :param scripts: A list of SQL script paths in the order they will be run
+    :param stats: A dictionary of table statistics, see estimate_statement
+    :param server_version_num: PostgreSQL server_version_num
+    :param top: Number of heaviest statements to report
+    :return: A dictionary describing the upgrade
+    """
+    report = {
+        'seconds': 0,
+        'disk': 0,
+        'scripts': [],
+        'heaviest': [],
+        'locks': {},
+    }
+    statements = []
+    for script in scripts:
+        with open(script, encoding='utf-8', errors='replace') as f:
+            sql = f.read()
+        scriptseconds = 0
+        # Each script is run in a single transaction so rewritten tables
+        # aren't freed until the end of the script
+        scriptdisk = 0
+        for stmt in split_sql_statements(sql):
+            c = classify_statement(stmt.text, server_version_num)
+            seconds, disk = estimate_statement(c, stats)
+            scriptseconds += seconds
+            scriptdisk += disk
+            if c.lock:
+                current = report['locks'].get(c.table)
+                if current is None or (
+                        LOCK_LEVELS.index(c.lock) >
+                        LOCK_LEVELS.index(current)):
+                    report['locks'][c.table] = c.lock
+            statements.append({
+                'script': os.path.basename(script),
+                'line': stmt.line,
+                'kind': c.kind,
+                'table': c.table,
+                'lock': c.lock,
+                'seconds': seconds,
+                'disk': disk,
+                'text': stmt.text,
+            })
+        report['scripts'].append({
+            'script': script,
+            'seconds': scriptseconds,
+            'disk': scriptdisk,
+        })
+        report['seconds'] += scriptseconds
+        report['disk'] = max(report['disk'], scriptdisk)
+    report['heaviest'] = sorted(
+        (s for s in statements if s['kind'] != KIND_OTHER),
+        key=lambda s: s['seconds'], reverse=True)[:top]
+    return report
+
+
+def format_estimate(report):
+    """
+    Format an upgrade estimate as a list of lines
+    """
+    lines = [
+        'Estimated duration: {}'.format(format_seconds(report['seconds'])),
+        'Estimated additional disk space: {}'.format(
+            format_bytes(report['disk'])),
+        '',
+        'Scripts:',
+    ]
+    for s in report['scripts']:
+        lines.append('  {}  {}  {}'.format(
+            format_seconds(s['seconds']), format_bytes(s['disk']),
+            s['script']))
+    lines += ['', 'Heaviest statements:']
+    for s in report['heaviest']:
+        text = ' '.join(s['text'].split())
+        if len(text) > 60:
+            text = text[:57] + '...'
+        lines.append('  {}  {}:{}  {} {} [{}]  {}'.format(
+            format_seconds(s['seconds']), s['script'], s['line'], s['kind'],
+            s['table'], s['lock'], text))
+    lines += ['', 'Locks:']
+    for table, lock in sorted(report['locks'].items(), key=lambda tl: (
+            -LOCK_LEVELS.index(tl[1]), tl[0])):
+        lines.append('  {}  {}'.format(lock, table))
+    return lines
@@ -87,6 +87,21 @@ def run(exe, args, capturestd=False, env=None):
     return stdout, stderr
 
 
+def get_config_diff(old, new):
+    """
+    Compare two dictionaries of config properties, returns a dictionary of
+    keys in new whose values differ from old mapped to (old, new) tuples,
+    where old is None if the key is missing
+    """
+    diff = {}
+    for k, v in new.items():
+        if k not in old:
+            diff[k] = (None, v)
+        elif old[k] != v:
+            diff[k] = (old[k], v)
+    return diff
+
+
 class External(object):
     """
     Manages the execution of shell and OMERO CLI commands
@@ -103,12 +118,23 @@ class External(object):
             self.dir = os.path.abspath(dir)
         self.cli = CLI()
         self.cli.loadplugins()
+        self._config = None
+        self._config_key = None
 
     def get_config(self, raise_missing=True):
         """
-        Returns a dictionary of all OMERO config properties
+        Returns a dictionary of all OMERO config properties.
+        config.xml is only read again if it or the active profile change.
         """
         configxml = os.path.join(self.dir, 'etc', 'grid', 'config.xml')
+        try:
+            st = os.stat(configxml)
+            key = (st.st_mtime_ns, st.st_size, os.getenv('OMERO_CONFIG'))
+        except OSError:
+            key = None
+        if key and key == self._config_key:
+            log.debug('Using cached config.xml')
+            return dict(self._config)
         try:
             configobj = ConfigXml(configxml, read_only=True)
         except Exception as e:
@@ -118,13 +144,39 @@ class External(object):
             return {}
         cfgdict = configobj.as_map()
         configobj.close()
-        return cfgdict
+        self._config = cfgdict
+        self._config_key = key
+        return dict(cfgdict)
+
+    def update_config(self, newcfg, current=None):
+        """
+        Update OMERO config properties that differ from the current
+        configuration.
+        config.xml is only opened for writing if there are changes, and all
+        changes are made whilst holding a single lock.
+        :param newcfg: A dictionary of config properties
+        :param current: The current config properties, if None these are
+               read from config.xml
+        :return: A dictionary of changed keys mapped to (old, new) tuples,
+                 where old is None for new keys
+        """
+        if current is None:
+            current = self.get_config(raise_missing=False)
+        if not get_config_diff(current, newcfg):
+            log.info('No configuration changes')
+            return {}
 
-    def update_config(self, newcfg):
         cfg = ConfigXml(os.path.join(self.dir, 'etc', 'grid', 'config.xml'))
-        for k, v in newcfg.items():
-            cfg[k] = v
-        cfg.close()
+        self._config_key = None
+        try:
+            # config.xml may have changed before the lock was obtained
+            diff = get_config_diff(cfg.as_map(), newcfg)
+            for k, (old, new) in diff.items():
+                log.debug('Setting %s=%s', k, new)
+                cfg[k] = new
+        finally:
+            cfg.close()
+        return diff
 
     def omero_cli(self, command):
         """
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Format sizes and durations for reports
+"""
+
+
+def format_bytes(n):
+    """
+    Format a size in bytes using the largest unit below 1024
+    """
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(n) < 1024:
+            return '{:.0f} {}'.format(n, unit)
+        n /= 1024.0
+    return '{:.1f} TB'.format(n)
+
+
+def format_seconds(s):
+    """
+    Format a duration in seconds, as H:MM:SS if a minute or more
+    """
+    if s < 60:
+        return '{:.1f} s'.format(s)
+    m, s = divmod(int(s), 60)
+    h, m = divmod(m, 60)
+    return '{:d}:{:02d}:{:02d}'.format(h, m, s)
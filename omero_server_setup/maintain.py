@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Refresh planner statistics and vacuum OMERO tables
+"""
+
+from .formatting import (
+    format_bytes,
+    format_seconds,
+)
+
+# Size, changes since the last analyze and dead rows of each table
+TABLE_ACTIVITY_QUERY = (
+    "SELECT relname, pg_total_relation_size(relid), n_mod_since_analyze, "
+    "n_dead_tup FROM pg_stat_user_tables WHERE schemaname = current_schema()")
+
+# Statistics targets for each ANALYZE stage, as in
+# vacuumdb --analyze-in-stages: minimal statistics are available quickly,
+# None uses the server default for the final stage
+ANALYZE_STAGES = (1, 10, None)
+
+
+def parse_table_activity(out):
+    tables = []
+    for row in out.splitlines():
+        if not row:
+            continue
+        name, size, modified, dead = row.split('|')
+        tables.append({
+            'name': name,
+            'size': int(size),
+            'modified': int(modified),
+            'dead': int(dead),
+        })
+    return tables
+
+
+def order_tables(tables):
+    """
+    Order tables so that those with the most changes since they were last
+    analyzed are done first, largest first if equal so that parallel jobs
+    finish at similar times
+    """
+    return sorted(tables, key=lambda t: (-t['modified'], -t['size'],
+                                         t['name']))
+
+
+def maintenance_commands(table, target, vacuum=False):
+    """
+    Get the SQL commands for one table and stage. These must be run as
+    separate commands since VACUUM can't run inside a transaction.
+    :param target: The statistics target, or None for the server default
+    :param vacuum: Use VACUUM ANALYZE instead of ANALYZE
+    """
+    commands = []
+    if target is not None:
+        commands.append('SET default_statistics_target = {};'.format(target))
+    commands.append('{} "{}";'.format(
+        'VACUUM (ANALYZE)' if vacuum else 'ANALYZE',
+        table.replace('"', '""')))
+    return commands
+
+
+def format_maintenance_report(results):
+    """
+    Describe the time taken for each table and stage
+    :param results: List of (stage description, table, seconds)
+    """
+    lines = []
+    stages = []
+    for stage, table, seconds in results:
+        if stage not in stages:
+            stages.append(stage)
+            lines.append('Stage {}:'.format(stage))
+        lines.append('  {:<40} {:>8} {}'.format(
+            table['name'], format_seconds(seconds),
+            format_bytes(table['size'])))
+    return lines
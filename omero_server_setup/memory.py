@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Divide the host memory between a managed PostgreSQL server and the
+OMERO.server JVMs
+"""
+
+from .tuning import _clamp
+
+# Weights of the JVM roles, the OMERO.server default percentages
+JVM_ROLES = (
+    ('blitz', 15),
+    ('indexer', 10),
+    ('pixeldata', 15),
+)
+
+# OMERO.server roles with JVM settings, settings for other roles are
+# ignored
+OMERO_JVM_ROLES = ('blitz', 'indexer', 'pixeldata', 'repository')
+
+JVMCFG_PREFIX = 'omero.jvmcfg.'
+
+# Memory left for the operating system and other processes in kB, the
+# larger of a minimum and a fraction of the total
+SYSTEM_MEMORY_MIN = 1024 ** 2
+SYSTEM_MEMORY_DIVISOR = 10
+
+# A managed PostgreSQL server gets a quarter of the memory, half of which
+# is used for shared_buffers and the rest for connections and the page cache
+POSTGRES_MEMORY_DIVISOR = 4
+SHARED_BUFFERS_MIN = 128 * 1024
+SHARED_BUFFERS_MAX = 16 * 1024 ** 2
+
+# The JVM heaps get half of OMERO's share, the rest is for JVM overheads
+# and caching image files. Heaps above 31GB can't use compressed pointers.
+HEAP_DIVISOR = 2
+HEAP_MIN = 512 * 1024
+HEAP_MAX = 31 * 1024 ** 2
+
+
+def format_heap_size(kb):
+    """
+    Format a size in kB as a JVM -Xmx value
+    """
+    return '{}m'.format(kb // 1024)
+
+
+def unconfigured_jvm_roles(cfgmap):
+    """
+    Get the JVM roles without any memory settings. OMERO's settings are
+    omero.jvmcfg.<setting> for all roles and
+    omero.jvmcfg.<setting>.<role> for one role.
+    :return: A list of roles from JVM_ROLES, empty if a setting for all
+             roles is configured
+    """
+    configured = set()
+    for key in cfgmap:
+        if not key.startswith(JVMCFG_PREFIX):
+            continue
+        role = key.rsplit('.', 1)[-1]
+        if role not in OMERO_JVM_ROLES:
+            return []
+        configured.add(role)
+    return [role for role, weight in JVM_ROLES if role not in configured]
+
+
+def allocate_memory(memory, manage_postgres):
+    """
+    Divide the memory of a host running OMERO.server
+    :param memory: Memory in kB
+    :param manage_postgres: True if PostgreSQL runs on this host
+    :return: A dictionary of postgres and the JVM roles to memory in kB,
+             and shared_buffers in kB if manage_postgres. The sum may
+             exceed the available memory on a small host.
+    """
+    system = max(SYSTEM_MEMORY_MIN, memory // SYSTEM_MEMORY_DIVISOR)
+    available = max(0, memory - system)
+    allocation = {}
+    if manage_postgres:
+        postgres = available // POSTGRES_MEMORY_DIVISOR
+        allocation['postgres'] = postgres
+        allocation['shared_buffers'] = _clamp(
+            postgres // 2, SHARED_BUFFERS_MIN, SHARED_BUFFERS_MAX)
+        available -= postgres
+    heaps = available // HEAP_DIVISOR
+    total = sum(weight for role, weight in JVM_ROLES)
+    for role, weight in JVM_ROLES:
+        allocation[role] = _clamp(
+            heaps * weight // total, HEAP_MIN, HEAP_MAX)
+    return allocation
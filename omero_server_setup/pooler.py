@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Size the OMERO database connection pools and PostgreSQL max_connections,
+and configure PgBouncer as a transaction pooling connection pooler between
+OMERO.server and a managed PostgreSQL server
+"""
+
+import os
+
+# Default omero.db.poolsize of OMERO.server
+DEFAULT_OMERO_POOLSIZE = 10
+
+# OMERO.server processes with their own pool of omero.db.poolsize
+# connections: Blitz, Indexer and PixelData
+OMERO_DB_PROCESSES = 3
+
+# Connections left for this plugin, for example for parallel maintain,
+# dump or restore jobs
+ADMIN_CONNECTIONS = 10
+
+# PostgreSQL default max_connections and superuser_reserved_connections
+DEFAULT_MAX_CONNECTIONS = 100
+SUPERUSER_RESERVED_CONNECTIONS = 3
+
+DEFAULT_POOLER_PORT = '16432'
+
+POOLER_INI = 'pgbouncer.ini'
+POOLER_USERLIST = 'userlist.txt'
+POOLER_PIDFILE = 'pgbouncer.pid'
+POOLER_LOGFILE = 'pgbouncer.log'
+
+# Connections allowed in addition to OMERO.server's pool, for example for
+# a second server process during a restart
+CLIENT_CONNECTION_MARGIN = 20
+
+# Maximum seconds to wait for PgBouncer to stop
+POOLER_STOP_TIMEOUT = 60
+
+
+def recommended_pool_size(cpus, concurrency=None):
+    """
+    Get omero.db.poolsize. Without a pooler each connection is a PostgreSQL
+    backend, and throughput doesn't increase beyond a small multiple of the
+    number of cores.
+    :param cpus: Number of CPUs of this host. This is the PostgreSQL host
+           if PostgreSQL is managed, otherwise an approximation.
+    :param concurrency: Expected number of concurrent OMERO requests using
+           the database, default 2 * cpus + 1
+    """
+    if concurrency is None:
+        size = 2 * cpus + 1
+    else:
+        size = min(int(concurrency), 4 * cpus)
+    return max(DEFAULT_OMERO_POOLSIZE, size)
+
+
+def server_connections(omero_poolsize, sizes=None):
+    """
+    Get the number of PostgreSQL connections used by OMERO.server
+    :param sizes: PgBouncer pool sizes if used, see pool_sizes
+    """
+    if sizes:
+        return sizes['max_db_connections']
+    return int(omero_poolsize) * OMERO_DB_PROCESSES
+
+
+def required_max_connections(omero_poolsize, sizes=None):
+    """
+    Get the max_connections needed for OMERO.server, this plugin and the
+    superuser reserved connections, at least the PostgreSQL default
+    :param sizes: PgBouncer pool sizes if used, see pool_sizes
+    """
+    return max(DEFAULT_MAX_CONNECTIONS, server_connections(
+        omero_poolsize, sizes) + ADMIN_CONNECTIONS +
+        SUPERUSER_RESERVED_CONNECTIONS)
+
+
+def connection_headroom(omero_poolsize, max_connections, reserved,
+                        sizes=None):
+    """
+    Get the number of connections available to other clients including
+    this plugin once OMERO.server's pools are full, negative if PostgreSQL
+    will refuse OMERO.server connections
+    :param reserved: Connections reserved for superusers
+    :param sizes: PgBouncer pool sizes if used, see pool_sizes
+    """
+    return (int(max_connections) - int(reserved) -
+            server_connections(omero_poolsize, sizes))
+
+
+def format_connection_report(omero_poolsize, max_connections, reserved,
+                             sizes=None):
+    """
+    Describe how the PostgreSQL connections are used
+    """
+    headroom = connection_headroom(
+        omero_poolsize, max_connections, reserved, sizes)
+    if sizes:
+        used = 'PgBouncer max_db_connections {}'.format(
+            sizes['max_db_connections'])
+    else:
+        used = 'omero.db.poolsize {} x {} processes'.format(
+            omero_poolsize, OMERO_DB_PROCESSES)
+    return 'Database connections: {}, max_connections {}, {} reserved, ' \
+        'headroom {}'.format(used, max_connections, reserved, headroom)
+
+
+def pool_sizes(omero_poolsize, cpus):
+    """
+    Size the pools. PostgreSQL throughput peaks at a small multiple of the
+    number of cores, so OMERO's client connections share fewer server
+    connections.
+    :param omero_poolsize: omero.db.poolsize
+    :param cpus: Number of CPUs of the PostgreSQL host
+    :return: A dictionary of PgBouncer settings
+    """
+    default_pool_size = max(2, min(int(omero_poolsize), 2 * cpus))
+    reserve_pool_size = max(1, default_pool_size // 4)
+    return {
+        'default_pool_size': default_pool_size,
+        'reserve_pool_size': reserve_pool_size,
+        'max_db_connections': default_pool_size + reserve_pool_size,
+        'max_client_conn': int(omero_poolsize) * OMERO_DB_PROCESSES +
+        CLIENT_CONNECTION_MARGIN,
+    }
+
+
+def _quote(value):
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def format_userlist(users):
+    """
+    Format a PgBouncer auth_file
+    :param users: A dictionary of user: password
+    """
+    return ''.join('{} {}\n'.format(_quote(u), _quote(p))
+                   for u, p in sorted(users.items()))
+
+
+def format_pgbouncer_ini(poolerdir, port, dbname, pghost, pgport, sizes):
+    """
+    Format a PgBouncer configuration file for a single database
+    :param poolerdir: Directory for the configuration, auth, PID and log
+           files
+    :param port: The TCP port PgBouncer listens on
+    :param pghost: PostgreSQL host or Unix socket directory
+    :param pgport: PostgreSQL port
+    :param sizes: Pool sizes, see pool_sizes
+    """
+    lines = [
+        '[databases]',
+        '{} = host={} port={} dbname={}'.format(dbname, pghost, pgport,
+                                                dbname),
+        '',
+        '[pgbouncer]',
+        'listen_addr = 127.0.0.1',
+        'listen_port = {}'.format(port),
+        'unix_socket_dir =',
+        'pool_mode = transaction',
+        'auth_type = scram-sha-256',
+        'auth_file = {}'.format(os.path.join(poolerdir, POOLER_USERLIST)),
+        'pidfile = {}'.format(os.path.join(poolerdir, POOLER_PIDFILE)),
+        'logfile = {}'.format(os.path.join(poolerdir, POOLER_LOGFILE)),
+        # Set by the PostgreSQL JDBC driver
+        'ignore_startup_parameters = extra_float_digits',
+        # Allow prepared statements in transaction mode, PgBouncer 1.21+
+        'max_prepared_statements = 200',
+    ]
+    lines += ['{} = {}'.format(k, v) for k, v in sorted(sizes.items())]
+    return '\n'.join(lines) + '\n'
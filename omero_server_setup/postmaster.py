@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check whether a local PostgreSQL server is running from its postmaster.pid
+file, without running pg_ctl
+"""
+
+import errno
+import os
+import socket
+import time
+
+PIDFILE = 'postmaster.pid'
+
+# pg_ctl stop modes: smart waits for clients to disconnect, fast disconnects
+# them, immediate aborts without a shutdown checkpoint
+STOP_MODES = ('smart', 'fast', 'immediate')
+
+# Allowed difference between the start time in postmaster.pid and the start
+# time of the process, to detect a stale file whose PID has been reused
+START_TIME_TOLERANCE = 5
+
+# Time to wait when checking the server is listening on a TCP port
+LISTEN_TIMEOUT = 1
+
+
+class PidFileUnreadable(Exception):
+    """
+    postmaster.pid exists but can't be read, for example if the data
+    directory belongs to another user
+    """
+
+
+def parse_pidfile(text):
+    """
+    Parse the contents of postmaster.pid. The first lines are the PID, data
+    directory, start time, port, socket directory, listen address, shared
+    memory key and server state. Older servers omit the later lines.
+    :return: A dictionary, missing values are None
+    """
+    lines = text.splitlines()
+
+    def line(n, convert=str):
+        try:
+            value = lines[n].strip()
+        except IndexError:
+            return None
+        if not value:
+            return None
+        try:
+            return convert(value)
+        except ValueError:
+            return None
+
+    return {
+        'pid': line(0, int),
+        'datadir': line(1),
+        'start': line(2, int),
+        'port': line(3, int),
+        'socketdir': line(4),
+        'listen': line(5),
+        'state': line(7),
+    }
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means the process exists but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def process_start_time(pid):
+    """
+    Get the start time of a process as a UNIX timestamp from /proc
+    :return: The start time, or None if unavailable
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # The command name may contain spaces so split after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/stat') as f:
+            btime = next(int(line.split()[1]) for line in f
+                         if line.startswith('btime '))
+        ticks = os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError, StopIteration):
+        return None
+    # starttime is field 22, the first two fields have been removed
+    return btime + int(fields[19]) / ticks
+
+
+def is_listening(pidinfo, timeout=LISTEN_TIMEOUT):
+    """
+    Check the server is accepting connections on its Unix socket, or if it
+    doesn't have one on its TCP port
+    """
+    port = pidinfo['port']
+    if not port:
+        return False
+    if pidinfo['socketdir']:
+        return os.path.exists(os.path.join(
+            pidinfo['socketdir'], '.s.PGSQL.{}'.format(port)))
+    host = pidinfo['listen'] or 'localhost'
+    if host in ('*', '0.0.0.0', '::'):
+        host = 'localhost'
+    try:
+        with socket.create_connection((host.split(',')[0], port), timeout):
+            return True
+    except OSError:
+        return False
+
+
+def read_postmaster_status(datadir, now=None):
+    """
+    Get the state of the server using a data directory
+    :return: A dictionary of running, pid, port, start, uptime, datadir,
+             socketdir, state and listening. If the server isn't running,
+             including if postmaster.pid is stale, only running and datadir
+             are set.
+    :raise PidFileUnreadable: if postmaster.pid can't be read
+    """
+    status = {'running': False, 'datadir': datadir}
+    try:
+        with open(os.path.join(datadir, PIDFILE)) as f:
+            text = f.read()
+    except FileNotFoundError:
+        return status
+    except OSError as e:
+        raise PidFileUnreadable(str(e))
+
+    pidinfo = parse_pidfile(text)
+    pid = pidinfo['pid']
+    if not pid or not process_exists(pid):
+        return status
+    started = process_start_time(pid)
+    if (started is not None and pidinfo['start'] is not None and
+            abs(started - pidinfo['start']) > START_TIME_TOLERANCE):
+        return status
+
+    if now is None:
+        now = time.time()
+    status.update({
+        'running': True,
+        'pid': pid,
+        'port': pidinfo['port'],
+        'start': pidinfo['start'],
+        'uptime': now - pidinfo['start'] if pidinfo['start'] else None,
+        'socketdir': pidinfo['socketdir'],
+        'state': pidinfo['state'],
+        'listening': is_listening(pidinfo),
+    })
+    return status
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Report the progress of long-running upgrade scripts
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+from .estimate import split_sql_statements
+from .formatting import format_seconds
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks of the upgrade session
+PROGRESS_INTERVAL = 2
+
+# Number of characters used to match a running query to a statement
+MATCH_LENGTH = 200
+
+_COMMENT = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+
+
+def normalise_query(text):
+    """
+    Remove comments and collapse whitespace so that a query reported by
+    pg_stat_activity can be compared with a statement from a script
+    """
+    return ' '.join(_COMMENT.sub(' ', text).split()).rstrip(';').strip()
+
+
+def match_statement(normalised, query, start=0):
+    """
+    Find the index of the statement being run
+    :param normalised: List of normalised statements from the script
+    :param query: The running query
+    :param start: Search from this statement onwards, since statements are
+           run in order
+    :return: The index of the statement, or None if not found
+    """
+    q = normalise_query(query)[:MATCH_LENGTH]
+    if not q:
+        return None
+    for i in range(start, len(normalised)):
+        if normalised[i][:MATCH_LENGTH] == q:
+            return i
+    return None
+
+
+class UpgradeProgress(object):
+    """
+    Track the progress of a list of upgrade scripts, and report it to the
+    terminal and optionally as JSON lines to a status file
+    """
+
+    def __init__(self, scripts, statusfile=None, out=print):
+        self.scripts = scripts
+        self.statusfile = statusfile
+        self.out = out
+        self.statements = []
+        self.normalised = []
+        self.sizes = []
+        for script in scripts:
+            with open(script, encoding='utf-8', errors='replace') as f:
+                sql = f.read()
+            stmts = split_sql_statements(sql)
+            self.statements.append(stmts)
+            self.normalised.append([normalise_query(s.text) for s in stmts])
+            self.sizes.append(len(sql.encode()))
+        self.totalbytes = sum(self.sizes)
+        self.start = time.time()
+        self.script = 0
+        self.current = 0
+
+    def script_started(self, script):
+        self.script = script
+        self.current = 0
+        self.report(None)
+
+    def update(self, query, index_progress=None):
+        """
+        Update the progress using the query currently being run
+        :param query: The current query of the upgrade session
+        :param index_progress: Optional dictionary of phase, blocks_done,
+               blocks_total, tuples_done and tuples_total from
+               pg_stat_progress_create_index
+        """
+        i = match_statement(
+            self.normalised[self.script], query, self.current)
+        if i is not None:
+            self.current = i
+        else:
+            log.debug('Unable to match query: %s', query)
+        self.report(self.statements[self.script][self.current],
+                    index_progress)
+
+    def script_finished(self, script):
+        self.script = script
+        self.current = len(self.statements[script])
+        self.report(None)
+
+    def status(self, statement, index_progress=None):
+        """
+        Get a dictionary describing the current progress
+        """
+        done = sum(self.sizes[:self.script])
+        if statement:
+            done += statement.start
+        elif self.current:
+            done += self.sizes[self.script]
+        elapsed = time.time() - self.start
+        eta = None
+        if done and elapsed:
+            eta = (self.totalbytes - done) * elapsed / done
+        return {
+            'time': time.time(),
+            'script': self.scripts[self.script],
+            'scriptnumber': self.script + 1,
+            'scripts': len(self.scripts),
+            'statement': self.current + (1 if statement else 0),
+            'statements': len(self.statements[self.script]),
+            'line': statement.line if statement else None,
+            'text': statement.text if statement else None,
+            'percent': 100.0 * done / self.totalbytes if self.totalbytes
+            else 100.0,
+            'elapsed': elapsed,
+            'eta': eta,
+            'index': index_progress,
+        }
+
+    def report(self, statement, index_progress=None):
+        status = self.status(statement, index_progress)
+        line = '[{}/{}] {} statement {}/{} {:.0f}% elapsed {}'.format(
+            status['scriptnumber'], status['scripts'],
+            os.path.basename(status['script']), status['statement'],
+            status['statements'], status['percent'],
+            format_seconds(status['elapsed']))
+        if status['eta'] is not None:
+            line += ' ETA {}'.format(format_seconds(status['eta']))
+        if status['text']:
+            text = ' '.join(status['text'].split())
+            if len(text) > 60:
+                text = text[:57] + '...'
+            line += ': ' + text
+        if index_progress:
+            line += ' [{}'.format(index_progress['phase'])
+            if index_progress.get('blocks_total'):
+                line += ' {:.0f}%'.format(
+                    100.0 * index_progress['blocks_done'] /
+                    index_progress['blocks_total'])
+            elif index_progress.get('tuples_total'):
+                line += ' {:.0f}%'.format(
+                    100.0 * index_progress['tuples_done'] /
+                    index_progress['tuples_total'])
+            line += ']'
+        self.out(line)
+        if self.statusfile:
+            with open(self.statusfile, 'a') as f:
+                f.write(json.dumps(status, sort_keys=True) + '\n')
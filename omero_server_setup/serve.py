@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Run setup commands in a resident process listening on a Unix socket, so
+that repeated calls don't pay for starting Python and loading OMERO.
+
+The daemon is started with omero setup serve. Commands are sent to it with
+python -m omero_server_setup.serve COMMAND [ARGS...], which runs
+omero setup COMMAND [ARGS...] instead if the daemon isn't running.
+Only the standard library is imported here so that the client is fast.
+"""
+
+from argparse import ArgumentParser, REMAINDER
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import traceback
+
+log = logging.getLogger(__name__)
+
+SOCKET_NAME = 'omero-setup.sock'
+
+# Commands that can be run by the daemon
+SERVE_COMMANDS = (
+    'certificates',
+    'check',
+    'create',
+    'dump',
+    'init',
+    'justdoit',
+    'maintain',
+    'status',
+    'upgrade',
+)
+
+# Seconds to wait when connecting to the daemon
+CONNECT_TIMEOUT = 2
+
+# Exit code if a command can't be run by the daemon
+SERVE_INVALID = 10
+# Exit code if the daemon fails after a command was sent
+SERVE_FAILED = 11
+# Exit code if the daemon isn't running and omero can't be found
+SERVE_NO_OMERO = 127
+
+
+class RequestError(Exception):
+    """
+    The daemon failed after a command was sent, the command may have run
+    """
+
+
+def get_socket_path(omerodir):
+    """
+    The daemon socket, $OMERO_SETUP_SOCKET or OMERODIR/var/omero-setup.sock
+    """
+    return os.getenv('OMERO_SETUP_SOCKET') or os.path.join(
+        omerodir, 'var', SOCKET_NAME)
+
+
+def request(path, argv, timeout=None):
+    """
+    Send a command to the daemon
+    :param argv: The arguments to omero setup
+    :param timeout: Seconds to wait for the command to finish, default
+           no limit
+    :return: A dictionary of rc, stdout and stderr
+    :raise OSError: if unable to connect to the daemon
+    :raise RequestError: if the daemon fails after the command was sent
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(CONNECT_TIMEOUT)
+        s.connect(path)
+        try:
+            s.settimeout(timeout)
+            s.sendall(json.dumps({'argv': list(argv)}).encode() + b'\n')
+            with s.makefile('rb') as f:
+                line = f.readline()
+            if not line:
+                raise RequestError('No response from {}'.format(path))
+            return json.loads(line.decode())
+        except (OSError, ValueError) as e:
+            raise RequestError('Request to {} failed: {}'.format(path, e))
+
+
+def is_running(path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(CONNECT_TIMEOUT)
+            s.connect(path)
+        return True
+    except OSError:
+        return False
+
+
+def handle_request(line, handler):
+    """
+    Run a command from a JSON request
+    :param handler: Function taking the arguments to omero setup and
+           returning (rc, stdout, stderr)
+    :return: A dictionary of rc, stdout and stderr, rc is 1 if the handler
+             raised an exception
+    """
+    try:
+        argv = json.loads(line.decode())['argv']
+        if not isinstance(argv, list) or not all(
+                isinstance(a, str) for a in argv):
+            raise ValueError('argv must be a list of strings')
+    except (ValueError, KeyError, TypeError) as e:
+        return {'rc': SERVE_INVALID, 'stdout': '',
+                'stderr': 'Invalid request: {}\n'.format(e)}
+    if not argv or argv[0] not in SERVE_COMMANDS:
+        return {'rc': SERVE_INVALID, 'stdout': '', 'stderr': (
+            'Command must be one of: {}\n'.format(', '.join(SERVE_COMMANDS)))}
+    try:
+        rc, stdout, stderr = handler(argv)
+    except Exception:
+        log.exception('Command %s failed', argv)
+        return {'rc': 1, 'stdout': '', 'stderr': traceback.format_exc()}
+    return {'rc': rc, 'stdout': stdout, 'stderr': stderr}
+
+
+def make_server(path, handler):
+    """
+    Create a server for commands received on a Unix socket. Commands are
+    run one at a time.
+    :param handler: See handle_request
+    """
+    if os.path.exists(path):
+        if is_running(path):
+            raise RuntimeError('Daemon already running on {}'.format(path))
+        log.info('Removing stale socket %s', path)
+        os.unlink(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            response = handle_request(line, handler)
+            log.info('Request %s exited with code %d', line.strip(),
+                     response['rc'])
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    # Only the owner can connect
+    umask = os.umask(0o177)
+    try:
+        return socketserver.UnixStreamServer(path, RequestHandler)
+    finally:
+        os.umask(umask)
+
+
+def serve(path, handler):
+    """
+    Run commands received on a Unix socket until interrupted
+    :param handler: See handle_request
+    """
+    server = make_server(path, handler)
+    log.info('Listening on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def run_local(argv):
+    """
+    Run omero setup in a new process
+    """
+    omero = shutil.which('omero')
+    if not omero:
+        print('Setup daemon not running and omero not found',
+              file=sys.stderr)
+        return SERVE_NO_OMERO
+    return subprocess.call([omero, 'setup'] + list(argv))
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=(
+        'Run an omero setup command using the setup daemon if it is '
+        'running, otherwise run omero setup'))
+    parser.add_argument(
+        '--omerodir', default=os.getenv('OMERODIR'),
+        help='OMERO.server directory, default $OMERODIR')
+    parser.add_argument(
+        '--socket', default=None, help=(
+            'Daemon socket, default $OMERO_SETUP_SOCKET or '
+            'OMERODIR/var/{}'.format(SOCKET_NAME)))
+    parser.add_argument(
+        'command', nargs=REMAINDER, help='omero setup command and arguments')
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error('command required')
+    path = args.socket
+    if not path:
+        if not args.omerodir:
+            parser.error('OMERODIR not set')
+        path = get_socket_path(args.omerodir)
+
+    if args.command[0] not in SERVE_COMMANDS:
+        return run_local(args.command)
+    # Only run the command locally if it wasn't sent to the daemon
+    try:
+        response = request(path, args.command)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return run_local(args.command)
+    except (OSError, RequestError) as e:
+        print('Setup daemon failed: {}'.format(e), file=sys.stderr)
+        return SERVE_FAILED
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['rc']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
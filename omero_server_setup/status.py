@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Collect and format the state of an OMERO server setup for monitoring
+"""
+
+import json
+
+STATUS_FORMATS = ('json', 'prometheus')
+
+# Number of tables reported by size
+STATUS_TOP_TABLES = 10
+
+# Everything from the database in a single query. dbpatch is queried by
+# query_to_xml so that the query also works on an uninitialised database.
+STATUS_QUERY = """SELECT json_build_object(
+'version', CASE WHEN to_regclass('dbpatch') IS NOT NULL THEN
+    (xpath('/table/row/v/text()', query_to_xml(
+        'SELECT currentversion || ''__'' || currentpatch AS v FROM dbpatch '
+        'ORDER BY id DESC LIMIT 1', false, false, '')))[1]::text END,
+'size', pg_database_size(current_database()),
+'tables', (SELECT coalesce(json_agg(t), '[]') FROM (
+    SELECT c.relname AS name, pg_total_relation_size(c.oid) AS size
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND n.nspname = current_schema()
+    ORDER BY 2 DESC LIMIT {top}) t));"""
+
+# Name, type, help and status key of each metric
+METRICS = (
+    ('database_up', 'gauge',
+     'Whether the OMERO database could be queried', 'up'),
+    ('database_latency_seconds', 'gauge',
+     'Time taken to run the status query', 'latency'),
+    ('database_upgrade_needed', 'gauge',
+     'Whether the database schema is older than the latest upgrade script',
+     'upgrade_needed'),
+    ('database_size_bytes', 'gauge', 'Size of the OMERO database', 'size'),
+    ('postgres_running', 'gauge',
+     'Whether the managed PostgreSQL server is running', 'postgres_running'),
+    ('postgres_uptime_seconds', 'gauge',
+     'Seconds since the managed PostgreSQL server started',
+     'postgres_uptime'),
+    ('certificate_expiry_seconds', 'gauge',
+     'Seconds until the server certificate expires', 'certificate_expiry'),
+    ('last_dump_age_seconds', 'gauge',
+     'Seconds since the latest database dump was started', 'last_dump_age'),
+)
+
+PREFIX = 'omero_setup_'
+
+
+def parse_status_query(out):
+    """
+    Parse the output of STATUS_QUERY
+    """
+    result = json.loads(out)
+    return {
+        'version': result['version'],
+        'size': result['size'],
+        'tables': dict((t['name'], t['size']) for t in result['tables']),
+    }
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _sample(name, value, labels=None):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, _label(v))
+                               for k, v in sorted(labels.items())) + '}'
+    if isinstance(value, bool):
+        value = int(value)
+    return '{}{} {}'.format(PREFIX, name, value)
+
+
+def format_prometheus(status):
+    """
+    Format a status dictionary in the Prometheus text exposition format.
+    Metrics with no value are omitted.
+    """
+    lines = []
+
+    def metric(name, mtype, helptext, samples):
+        if not samples:
+            return
+        lines.append('# HELP {}{} {}'.format(PREFIX, name, helptext))
+        lines.append('# TYPE {}{} {}'.format(PREFIX, name, mtype))
+        lines.extend(samples)
+
+    for name, mtype, helptext, key in METRICS:
+        if status.get(key) is not None:
+            metric(name, mtype, helptext, [_sample(name, status[key])])
+    metric('database_info', 'gauge',
+           'Current and latest database schema versions',
+           [_sample('database_info', 1, {
+               'version': status.get('version') or '',
+               'latest': status.get('latest') or ''})])
+    metric('table_size_bytes', 'gauge',
+           'Size of the largest tables including indexes', [
+               _sample('table_size_bytes', size, {'table': table})
+               for table, size in sorted(status.get('tables', {}).items())])
+    return lines
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Find the external programs used by this plugin and their versions
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+log = logging.getLogger(__name__)
+
+TOOLS = (
+    'openssl',
+    'pg_basebackup',
+    'pg_ctl',
+    'pg_dump',
+    'pg_restore',
+    'pgbouncer',
+    'psql',
+)
+
+
+def get_cache_file():
+    cachedir = os.getenv('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'omero-server-setup', 'toolchain.json')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _cache_key(path):
+    """
+    The PATH directories and their modification times, which change if a
+    program is added to or removed from a directory
+    """
+    return [[d, _mtime(d)] for d in path.split(os.pathsep) if d]
+
+
+def parse_version(out):
+    """
+    Get the version from the output of a --version command, for example
+    psql (PostgreSQL) 16.2 or OpenSSL 3.0.2 15 Mar 2022
+    """
+    m = re.search(r'(\d+(?:\.\d+)*)', out)
+    return m.group(1) if m else None
+
+
+def version_num(version):
+    """
+    Convert a PostgreSQL version to the form of server_version_num with
+    the minor version removed, for example 16.2 -> 160000, 9.6.3 -> 90600
+    """
+    parts = [int(p) for p in version.split('.')] + [0]
+    if parts[0] >= 10:
+        return parts[0] * 10000
+    return parts[0] * 10000 + parts[1] * 100
+
+
+def _discover(tool):
+    path = shutil.which(tool)
+    if not path:
+        return None
+    args = ['version'] if tool == 'openssl' else ['--version']
+    try:
+        out = subprocess.run(
+            [path] + args, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT).stdout.decode(errors='replace')
+    except OSError as e:
+        log.warning('Unable to run %s: %s', path, e)
+        return None
+    return {
+        'path': path,
+        'bindir': os.path.dirname(path),
+        'mtime': _mtime(path),
+        'version': parse_version(out),
+    }
+
+
+def discover_toolchain(cachefile=None, tools=TOOLS):
+    """
+    Find the paths and versions of external programs. Results are cached,
+    and are rediscovered if PATH, the modification time of any directory in
+    it or of any of the programs change.
+    :return: A dictionary of tool: None if not found, or a dictionary of
+             path, bindir, mtime and version
+    """
+    if cachefile is None:
+        cachefile = get_cache_file()
+    key = _cache_key(os.getenv('PATH', os.defpath))
+    try:
+        with open(cachefile) as f:
+            cached = json.load(f)
+        if cached['key'] == key and set(tools) <= set(cached['tools']) and all(
+                t is None or _mtime(t['path']) == t['mtime']
+                for t in cached['tools'].values()):
+            log.debug('Using cached toolchain %s', cachefile)
+            return cached['tools']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.debug('Toolchain cache %s not used: %s', cachefile, e)
+
+    toolchain = dict((tool, _discover(tool)) for tool in tools)
+    tmpfile = None
+    try:
+        cachedir = os.path.dirname(cachefile)
+        os.makedirs(cachedir, exist_ok=True)
+        # A unique temporary file so concurrent processes don't conflict
+        with tempfile.NamedTemporaryFile(
+                'w', dir=cachedir, prefix='.toolchain-', suffix='.tmp',
+                delete=False) as f:
+            tmpfile = f.name
+            json.dump({'key': key, 'tools': toolchain}, f, indent=2,
+                      sort_keys=True)
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        log.warning('Unable to cache toolchain in %s: %s', cachefile, e)
+        if tmpfile and os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+    return toolchain
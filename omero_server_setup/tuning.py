@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Host resources, and PostgreSQL session settings for running upgrade scripts
+"""
+
+import os
+import re
+
+MEMORY_UNITS = {
+    'kB': 1,
+    'MB': 1024,
+    'GB': 1024 ** 2,
+    'TB': 1024 ** 3,
+}
+
+# Limits for automatically sized settings in kB. maintenance_work_mem is
+# shared between parallel workers building an index.
+MAINTENANCE_WORK_MEM_MIN = 64 * 1024
+MAINTENANCE_WORK_MEM_MAX = 8 * 1024 ** 2
+WORK_MEM_MIN = 4 * 1024
+WORK_MEM_MAX = 512 * 1024
+
+# cgroup v2 and v1 memory limit files, in a container the root is the
+# container's cgroup
+CGROUP_MEMORY_LIMITS = (
+    '/sys/fs/cgroup/memory.max',
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+)
+# cgroup v1 reports no limit as a very large number
+CGROUP_UNLIMITED = 2 ** 60
+
+# The default max_worker_processes and max_parallel_workers limit the number
+# of parallel maintenance workers a session can use
+PARALLEL_MAINTENANCE_WORKERS_MAX = 8
+
+
+def parse_memory(value):
+    """
+    Parse a PostgreSQL memory setting such as 512MB or 2GB
+    :return: The size in kB
+    """
+    m = re.match(r'^\s*(\d+)\s*(kB|MB|GB|TB)?\s*$', str(value))
+    if not m:
+        raise ValueError('Invalid memory size: {}'.format(value))
+    return int(m.group(1)) * MEMORY_UNITS[m.group(2) or 'kB']
+
+
+def format_memory(kb):
+    """
+    Format a size in kB as a PostgreSQL memory setting, using MB if exact
+    """
+    if kb % 1024 == 0:
+        return '{}MB'.format(kb // 1024)
+    return '{}kB'.format(kb)
+
+
+def cgroup_memory_limit(paths=CGROUP_MEMORY_LIMITS):
+    """
+    Get the cgroup memory limit in kB
+    :return: The limit, or None if there isn't one
+    """
+    for path in paths:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value == 'max':
+            return None
+        try:
+            limit = int(value)
+        except ValueError:
+            return None
+        return limit // 1024 if limit < CGROUP_UNLIMITED else None
+    return None
+
+
+def host_resources():
+    """
+    Get the physical memory in kB, or the cgroup limit if lower, and number
+    of usable CPUs of this host
+    :return: (memory, cpus), memory is None if unknown
+    """
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf(
+            'SC_PHYS_PAGES') // 1024
+    except (ValueError, OSError, AttributeError):
+        memory = None
+    limit = cgroup_memory_limit()
+    if limit:
+        memory = min(memory, limit) if memory else limit
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return memory, cpus
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def auto_tuning(memory, cpus):
+    """
+    Size the upgrade session settings for a PostgreSQL server dedicated to
+    OMERO on this host. The upgrade is the only active session so it can
+    use a large share of the memory and most of the cores.
+    :param memory: Physical memory in kB, or None if unknown
+    :param cpus: Number of CPUs
+    :return: (maintenance_work_mem in kB or None, parallel workers)
+    """
+    mem = None
+    if memory:
+        mem = _clamp(memory // 8, MAINTENANCE_WORK_MEM_MIN,
+                     MAINTENANCE_WORK_MEM_MAX)
+    # The leader process also takes part in building an index
+    workers = _clamp(cpus - 1, 0, PARALLEL_MAINTENANCE_WORKERS_MAX)
+    return mem, workers
+
+
+def upgrade_settings(memory=None, parallel=None):
+    """
+    Get the session settings for the upgrade scripts
+    :param memory: maintenance_work_mem in kB, or None to use the default.
+           work_mem is set to a quarter of this.
+    :param parallel: max_parallel_maintenance_workers, or None to use the
+           default
+    :return: A dictionary of settings
+    """
+    settings = {}
+    if memory is not None:
+        settings['maintenance_work_mem'] = format_memory(memory)
+        settings['work_mem'] = format_memory(
+            _clamp(memory // 4, WORK_MEM_MIN, WORK_MEM_MAX))
+    if parallel is not None:
+        settings['max_parallel_maintenance_workers'] = str(parallel)
+    return settings
+
+
+def session_options(settings):
+    """
+    Format session settings for the PGOPTIONS environment variable
+    """
+    return ' '.join('-c {}={}'.format(k, v)
+                    for k, v in sorted(settings.items()))
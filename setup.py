@@ -26,6 +26,9 @@ setuptools.setup(
     install_requires=[
         'omero-py>=5.6.0',
     ],
+    extras_require={
+        'cryptography': ['cryptography'],
+    },
     use_scm_version={
         'write_to': 'omero_server_setup/_version.py',
     },
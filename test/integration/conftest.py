@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+PostgreSQL fixtures for the integration tests.
+
+If POSTGRES_HOST is set an existing server is used. Otherwise a throwaway
+server is initialised and started once per test session, or per worker with
+pytest-xdist, using DbAdmin.pginit and pgstart. Its data directory is on
+tmpfs if available, durability is disabled and it only listens on a Unix
+socket so parallel sessions don't conflict.
+"""
+
+from argparse import Namespace
+import os
+import shutil
+from subprocess import check_output
+import tempfile
+from uuid import uuid4
+
+import pytest
+
+from omero_server_setup import DbAdmin
+
+# Settings for a server whose data can be lost
+EPHEMERAL_SETTINGS = """
+fsync = off
+synchronous_commit = off
+full_page_writes = off
+listen_addresses = ''
+"""
+
+TMPFS = '/dev/shm'
+
+
+class ServerConfig(object):
+    """
+    Configuration of the throwaway server, used by DbAdmin in place of
+    config.xml
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def get_config(self, raise_missing=True):
+        return dict(self.cfg)
+
+
+class PostgresServer(object):
+    """
+    Connection parameters for a PostgreSQL server
+    """
+
+    def __init__(self, host, port, adminuser, adminpass):
+        self.host = host
+        self.port = port
+        self.adminuser = adminuser
+        self.adminpass = adminpass
+
+    def args(self, dbid, **kwargs):
+        """
+        Arguments for DbAdmin using dbid as the database, user and password
+        """
+        args = dict(
+            dbcommand=None,
+            # Ignore config.xml, use our test credentials
+            no_db_config=True,
+            dry_run=False,
+            omerosql=None,
+            rootpass='omero',
+            dbname=dbid,
+            dbport=self.port,
+            dbuser=dbid,
+            dbhost=self.host,
+            dbpass=dbid,
+            adminuser=self.adminuser,
+            adminpass=self.adminpass,
+        )
+        args.update(kwargs)
+        return Namespace(**args)
+
+    def psqlc(self, query, *args, admin=True):
+        cmd = ['psql']
+        if self.host:
+            cmd += ['-h', self.host]
+        if self.port:
+            cmd += ['-p', self.port]
+        if admin:
+            cmd += ['-U', self.adminuser]
+        cmd += ['-At'] + list(args)
+        if query:
+            cmd += ['-c', query]
+        return check_output(cmd)
+
+
+def _ephemeral_dir(tmp_path_factory):
+    if os.path.isdir(TMPFS) and os.access(TMPFS, os.W_OK):
+        return tempfile.mkdtemp(prefix='omero-setup-pg-', dir=TMPFS)
+    return str(tmp_path_factory.mktemp('pg'))
+
+
+@pytest.fixture(scope='session')
+def postgres(tmp_path_factory):
+    """
+    A PostgreSQL server for this session
+    """
+    if os.getenv('POSTGRES_HOST'):
+        host, _, port = os.getenv('POSTGRES_HOST').partition(':')
+        adminuser = os.getenv('POSTGRES_USER', 'postgres')
+        yield PostgresServer(host, port or '5432', adminuser, adminuser)
+        return
+
+    if not shutil.which('pg_ctl'):
+        pytest.skip('Set POSTGRES_HOST or add the PostgreSQL programs '
+                    'including pg_ctl to PATH')
+    basedir = _ephemeral_dir(tmp_path_factory)
+    # Keep the socket path short, it's limited to 107 characters
+    cfg = ServerConfig({
+        'postgres.data.dir': os.path.join(basedir, 'data'),
+        'postgres.socket.dir': os.path.join(basedir, 's'),
+        'omero.db.name': 'postgres',
+        'omero.db.host': os.path.join(basedir, 's'),
+        'omero.db.port': '5432',
+        'omero.db.user': 'postgres',
+        'omero.db.pass': 'postgres',
+    })
+    db = DbAdmin(basedir, Namespace(
+        no_db_config=False, adminpass=None, mode='immediate', timeout=None),
+        cfg)
+    db.pginit()
+    with open(os.path.join(cfg.cfg['postgres.data.dir'],
+                           'postgresql.conf'), 'a') as f:
+        f.write(EPHEMERAL_SETTINGS)
+    db.pgstart()
+    try:
+        yield PostgresServer(
+            cfg.cfg['postgres.socket.dir'], '5432', 'postgres', None)
+    finally:
+        db.pgstop()
+        shutil.rmtree(basedir, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def template_db(postgres):
+    """
+    An initialised OMERO database used as a template. Its name is also its
+    user and password.
+    """
+    name = 'omero_template_{}'.format(
+        os.getenv('PYTEST_XDIST_WORKER', 'main'))
+    omerodir = os.getenv('OMERODIR')
+    DbAdmin(omerodir, postgres.args(name)).run('create')
+    DbAdmin(omerodir, postgres.args(name)).run('init')
+    yield name
+    postgres.psqlc('DROP DATABASE IF EXISTS {};'.format(name))
+    postgres.psqlc('DROP ROLE IF EXISTS {};'.format(name))
+
+
+@pytest.fixture
+def dbid(postgres):
+    """
+    A unique name for a test database and user, dropped after the test
+    """
+    dbid = 'x' + str(uuid4()).replace('-', '')
+    yield dbid
+    postgres.psqlc('DROP DATABASE IF EXISTS {};'.format(dbid))
+    postgres.psqlc('DROP ROLE IF EXISTS {};'.format(dbid))
+
+
+@pytest.fixture
+def initialised_db(postgres, template_db, dbid):
+    """
+    An initialised OMERO database cloned from template_db, owned by the
+    template_db user. Returns the arguments for DbAdmin.
+    """
+    postgres.psqlc('CREATE DATABASE {} WITH TEMPLATE {} OWNER {};'.format(
+        dbid, template_db, template_db))
+    return postgres.args(template_db, dbname=dbid)
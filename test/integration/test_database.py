@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from argparse import Namespace
 import os
-from subprocess import check_output
-from uuid import uuid4
+
+import pytest
 
 from omero_server_setup import (
     DbAdmin,
@@ -16,66 +15,31 @@ from omero_server_setup import (
 )
 
 
-DB_ADMIN_USER = os.getenv('POSTGRES_USER', 'postgres')
-DB_HOST, _, DB_PORT = os.getenv(
-    'POSTGRES_HOST', 'localhost:5432').partition(':')
-
-
-class Args(Namespace):
-    def __init__(self, dbid, **kwargs):
-        args = dict(
-            dbcommand=None,
-            # Ignore config.xml, use our test credentials
-            no_db_config=True,
-            dry_run=False,
-            omerosql=None,
-            rootpass='omero',
-            dbname=dbid,
-            dbport=DB_PORT,
-            dbuser=dbid,
-            dbhost=DB_HOST,
-            dbpass=dbid,
-            adminuser=DB_ADMIN_USER,
-            adminpass=DB_ADMIN_USER,
-        )
-        args.update(kwargs)
-        super().__init__(**args)
-
-
 class TestDbAdmin(object):
 
-    def setup_method(self, method):
-        self.dbid = 'x' + str(uuid4()).replace('-', '')
+    @pytest.fixture(autouse=True)
+    def setup_db(self, postgres, dbid):
+        self.postgres = postgres
+        self.dbid = dbid
         self.omerodir = os.getenv('OMERODIR')
         self.omero440sql = os.path.join(
             os.path.dirname(__file__), '..', 'resources', 'OMERO4.4__0.sql')
 
-    def teardown_method(self, method):
-        self.psqlc("DROP DATABASE IF EXISTS {0};")
-        self.psqlc("DROP ROLE IF EXISTS {0};")
+    def args(self, **kwargs):
+        return self.postgres.args(self.dbid, **kwargs)
 
     def create_db(self):
         self.psqlc("CREATE USER {0} WITH PASSWORD '{0}';")
         self.psqlc("CREATE DATABASE {0} WITH OWNER {0};")
 
     def psqlc(self, query, *args, admin=True):
-        cmd = ['psql']
-        if DB_HOST:
-            cmd += ['-h', DB_HOST]
-        if DB_PORT:
-            cmd += ['-p', DB_PORT]
-        if admin:
-            cmd += ['-U', DB_ADMIN_USER]
-        cmd += ['-At'] + list(args)
         if query:
-            cmd += ['-c', query.format(self.dbid)]
-        out = check_output(cmd)
-        # print(cmd, out)
-        return out
+            query = query.format(self.dbid)
+        return self.postgres.psqlc(query, *args, admin=admin)
 
     def test_check(self):
-        argscheck = Args(self.dbid, dry_run=True)
-        db = DbAdmin(self.omerodir, None, argscheck)
+        argscheck = self.args(dry_run=True)
+        db = DbAdmin(self.omerodir, argscheck)
 
         assert db.check() == DB_NO_CONNECTION
 
@@ -86,9 +50,15 @@ class TestDbAdmin(object):
                    '-U', self.dbid, admin=False)
         assert db.check() == DB_UPGRADE_NEEDED
 
+    def test_check_initialised(self, initialised_db):
+        initialised_db.dry_run = True
+        db = DbAdmin(self.omerodir, initialised_db)
+        assert db.check() == DB_UPTODATE
+
     def test_create(self):
-        args = Args(self.dbid)
-        db = DbAdmin(self.omerodir, 'create', args)
+        args = self.args()
+        db = DbAdmin(self.omerodir, args)
+        db.run('create')
         assert db.check() == DB_INIT_NEEDED
 
         user = self.psqlc("SELECT 1 FROM pg_roles WHERE rolname='{}';".format(
@@ -100,20 +70,20 @@ class TestDbAdmin(object):
 
     def test_init(self):
         self.create_db()
-        args = Args(self.dbid)
-        DbAdmin(self.omerodir, 'init', args)
+        args = self.args()
+        DbAdmin(self.omerodir, args).run('init')
         r = self.psqlc('SELECT currentversion, currentpatch FROM dbpatch '
                        'ORDER BY id DESC', '-d', self.dbid)
         assert r.splitlines() == [b'OMERO5.4|0']
 
-        argscheck = Args(self.dbid, dry_run=True)
-        db = DbAdmin(self.omerodir, None, argscheck)
+        argscheck = self.args(dry_run=True)
+        db = DbAdmin(self.omerodir, argscheck)
         assert db.check() == DB_UPTODATE
 
     def test_init_from_and_upgrade(self):
         self.create_db()
-        args = Args(self.dbid, omerosql=self.omero440sql)
-        DbAdmin(self.omerodir, 'init', args)
+        args = self.args(omerosql=self.omero440sql)
+        DbAdmin(self.omerodir, args).run('init')
         r = self.psqlc('SELECT currentversion, currentpatch FROM dbpatch '
                        'ORDER BY id ASC', '-d', self.dbid)
         assert r.splitlines() == [
@@ -127,25 +97,40 @@ class TestDbAdmin(object):
         # Only the temporary omerosql file should be deleted
         assert os.path.exists(self.omero440sql)
 
-        argscheck = Args(self.dbid, dry_run=True)
-        db = DbAdmin(self.omerodir, None, argscheck)
+        argscheck = self.args(dry_run=True)
+        db = DbAdmin(self.omerodir, argscheck)
         assert db.check() == DB_UPTODATE
 
     def test_justdoit(self):
-        args = Args(self.dbid)
-        DbAdmin(self.omerodir, 'justdoit', args)
+        args = self.args()
+        DbAdmin(self.omerodir, args).run('justdoit')
         r = self.psqlc('SELECT currentversion, currentpatch FROM dbpatch '
                        'ORDER BY id DESC', '-d', self.dbid)
         assert r.splitlines() == [b'OMERO5.4|0']
 
-        argscheck = Args(self.dbid, dry_run=True)
-        db = DbAdmin(self.omerodir, None, argscheck)
+        argscheck = self.args(dry_run=True)
+        db = DbAdmin(self.omerodir, argscheck)
         assert db.check() == DB_UPTODATE
 
-    def test_dump(self, tmpdir):
+    def test_dump(self, tmpdir, initialised_db):
         dumpfile = str(tmpdir.join('test.pgdump'))
-        self.create_db()
-        args = Args(self.dbid, dumpfile=dumpfile)
-        DbAdmin(self.omerodir, 'dump', args)
+        initialised_db.dumpfile = dumpfile
+        DbAdmin(self.omerodir, initialised_db).run('dump')
         with open(dumpfile, 'rb') as f:
             assert f.read(5) == b'PGDMP'
+
+    def test_status(self, tmpdir, initialised_db):
+        initialised_db.dump_dir = str(tmpdir)
+        status = DbAdmin(self.omerodir, initialised_db).status()
+        assert status['up'] is True
+        assert status['version']
+        assert status['upgrade_needed'] is False
+        assert status['tables']
+
+    def test_status_uninitialised(self, tmpdir):
+        args = self.args(dump_dir=str(tmpdir))
+        DbAdmin(self.omerodir, args).run('create')
+        status = DbAdmin(self.omerodir, args).status()
+        assert status['up'] is True
+        assert status['version'] is None
+        assert status['tables'] == {}
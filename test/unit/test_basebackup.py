@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta, timezone
+import pytest
+
+from omero_server_setup.basebackup import (
+    backup_chain,
+    choose_parent,
+    parse_time,
+    read_index,
+    select_expired,
+    select_restore_backup,
+    wal_filename,
+    write_index,
+)
+
+
+def _backup(label, backuptype, parent, time):
+    return {
+        'label': label,
+        'type': backuptype,
+        'parent': parent,
+        'time': '2026-10-{:02d}T00:00:00+00:00'.format(time),
+        'start_wal': '0000000100000000000000{:02X}'.format(time),
+    }
+
+
+BACKUPS = [
+    _backup('f1', 'full', None, 1),
+    _backup('i1', 'incremental', 'f1', 2),
+    _backup('f2', 'full', None, 3),
+    _backup('i2', 'incremental', 'f2', 4),
+    _backup('i3', 'incremental', 'i2', 5),
+    _backup('d1', 'differential', 'f2', 6),
+]
+
+
+@pytest.mark.parametrize('timeline,lsn,expected', [
+    (1, '0/2000028', '000000010000000000000002'),
+    (2, '1/FF000000', '0000000200000001000000FF'),
+])
+def test_wal_filename(timeline, lsn, expected):
+    assert wal_filename(timeline, lsn) == expected
+
+
+def test_read_write_index(tmpdir):
+    assert read_index(str(tmpdir)) == []
+    write_index(str(tmpdir), BACKUPS)
+    assert read_index(str(tmpdir)) == BACKUPS
+
+
+@pytest.mark.parametrize('backuptype,expected', [
+    ('full', None),
+    ('incremental', 'd1'),
+    ('differential', 'f2'),
+])
+def test_choose_parent(backuptype, expected):
+    parent = choose_parent(BACKUPS, backuptype)
+    assert (parent['label'] if parent else None) == expected
+    assert choose_parent([], backuptype) is None
+
+
+def test_backup_chain():
+    assert [b['label'] for b in backup_chain(BACKUPS, 'i3')] == [
+        'f2', 'i2', 'i3']
+    assert [b['label'] for b in backup_chain(BACKUPS, 'f1')] == ['f1']
+
+
+@pytest.mark.parametrize('keepfull,expected', [
+    (1, ['f1', 'i1']),
+    (2, []),
+    (0, ['f1', 'i1', 'f2', 'i2', 'i3', 'd1']),
+])
+def test_select_expired(keepfull, expected):
+    assert [b['label'] for b in select_expired(BACKUPS, keepfull)] == (
+        expected)
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('2026-10-01', datetime(2026, 10, 1)),
+    ('2026-10-01T12:30', datetime(2026, 10, 1, 12, 30)),
+    ('2026-10-01 12:30:05.5', datetime(2026, 10, 1, 12, 30, 5, 500000)),
+    ('2026-10-01T12:00:00Z', datetime(2026, 10, 1, 12, tzinfo=timezone.utc)),
+    ('2026-10-01T12:00:00-05:30', datetime(2026, 10, 1, 12, tzinfo=timezone(
+        -timedelta(hours=5, minutes=30)))),
+])
+def test_parse_time(value, expected):
+    t = parse_time(value)
+    assert t == expected
+    assert t.utcoffset() == expected.utcoffset()
+
+
+@pytest.mark.parametrize('value', ['', 'yesterday', '2026-13-01',
+                                   '2026-10-01T25:00', '2026-10-01T12'])
+def test_parse_time_invalid(value):
+    with pytest.raises(ValueError):
+        parse_time(value)
+
+
+def test_select_restore_backup():
+    assert select_restore_backup(BACKUPS)['label'] == 'd1'
+    target = datetime(2026, 10, 4, 12, tzinfo=timezone.utc)
+    assert select_restore_backup(BACKUPS, target)['label'] == 'i2'
+    target = datetime(2026, 9, 1, tzinfo=timezone.utc)
+    assert select_restore_backup(BACKUPS, target) is None
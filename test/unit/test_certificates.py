@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from mox3 import mox
+
+import json
+import os
+
+from omero_server_setup import (
+    certificates,
+    external,
+)
+from omero_server_setup.certificates import (
+    create_certificates,
+    create_host_certificates,
+    get_backend,
+    parse_subject,
+    read_hosts,
+)
+
+BACKENDS = [
+    'openssl',
+    pytest.param('cryptography', marks=pytest.mark.skipif(
+        certificates.x509 is None, reason='cryptography not installed')),
+]
+
+
+def test_parse_subject():
+    assert parse_subject('/L=OMERO/O=OMERO.server/CN=localhost') == [
+        ('L', 'OMERO'), ('O', 'OMERO.server'), ('CN', 'localhost')]
+
+
+class TestCertificates(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    def get_config(self, certdir, **kwargs):
+        cfg = {
+            'setup.omero.certificates': 'true',
+            'omero.glacier2.IceSSL.DefaultDir': certdir,
+            'ssl.certificate.commonname': 'localhost',
+            'ssl.certificate.owner': '/L=OMERO/O=OMERO.server',
+            'ssl.certificate.key': 'server.key',
+            'omero.glacier2.IceSSL.CertFile': 'server.p12',
+            'omero.glacier2.IceSSL.CAs': 'server.pem',
+            'omero.glacier2.IceSSL.Password': 'secret',
+        }
+        cfg.update(kwargs)
+        return cfg
+
+    def create(self, cfg, force=False, backend='openssl'):
+        ext = self.mox.CreateMock(external.External)
+        ext.get_config().AndReturn(cfg)
+        self.mox.ReplayAll()
+        create_certificates(ext, force=force, backend=backend)
+        self.mox.VerifyAll()
+        self.mox.ResetAll()
+
+    def check(self, certdir, subject='/L=OMERO/O=OMERO.server/CN=localhost',
+              password='secret', renewdays=30, keytype='rsa',
+              backend='openssl'):
+        return get_backend(backend).check(
+            os.path.join(certdir, 'server.key'),
+            os.path.join(certdir, 'server.pem'),
+            os.path.join(certdir, 'server.p12'),
+            subject, password, renewdays, keytype)
+
+    def test_check_missing(self, tmpdir):
+        assert self.check(str(tmpdir)).endswith('server.key not found')
+
+    @pytest.mark.parametrize('backend', BACKENDS)
+    @pytest.mark.parametrize('change', [
+        None, 'subject', 'password', 'renewdays', 'keytype', 'key'])
+    def test_check_certificates(self, tmpdir, change, backend):
+        certdir = str(tmpdir)
+        self.create(self.get_config(certdir), backend=backend)
+
+        def check(**kwargs):
+            return self.check(certdir, backend=backend, **kwargs)
+
+        if change is None:
+            assert check() is None
+        elif change == 'subject':
+            assert check(subject='/CN=example.org').startswith(
+                'subject changed')
+        elif change == 'password':
+            assert 'password changed' in check(password='other')
+        elif change == 'renewdays':
+            assert 'renewal window' in check(renewdays=400)
+        elif change == 'keytype':
+            assert check(keytype='ecdsa') == 'key type changed: rsa → ecdsa'
+        elif change == 'key':
+            os.remove(os.path.join(certdir, 'server.key'))
+            external.run('openssl', [
+                'genrsa', '-out', os.path.join(certdir, 'server.key'),
+                '2048'], capturestd=True)
+            assert check().startswith('key changed')
+
+    @pytest.mark.parametrize('keytype', ['rsa', 'ecdsa', 'ed25519'])
+    def test_check_openssl_runs(self, tmpdir, monkeypatch, keytype):
+        certdir = str(tmpdir)
+        self.create(self.get_config(certdir, **{
+            'ssl.certificate.keytype': keytype}))
+        calls = []
+
+        def run(exe, args, **kwargs):
+            calls.append(args[0])
+            return external.run(exe, args, **kwargs)
+
+        monkeypatch.setattr(certificates, 'run', run)
+        assert self.check(certdir, keytype=keytype) is None
+        assert calls == ['x509', 'pkcs12']
+
+    @pytest.mark.parametrize('backend', BACKENDS)
+    @pytest.mark.parametrize('keytype', ['rsa', 'ecdsa', 'ed25519'])
+    def test_create_certificates_keytype(self, tmpdir, backend, keytype):
+        certdir = str(tmpdir)
+        self.create(self.get_config(certdir, **{
+            'ssl.certificate.keytype': keytype,
+            'ssl.certificate.days': '10',
+        }), backend=backend)
+        # Certificates should be readable by both backends
+        assert self.check(certdir, keytype=keytype, renewdays=9) is None
+        assert 'renewal window' in self.check(
+            certdir, keytype=keytype, renewdays=11, backend=backend)
+
+    @pytest.mark.parametrize('force', [True, False])
+    def test_create_certificates_unchanged(self, tmpdir, force):
+        certdir = str(tmpdir)
+        cfg = self.get_config(certdir)
+        self.create(cfg)
+        pkcs12path = os.path.join(certdir, 'server.p12')
+        with open(pkcs12path, 'rb') as f:
+            pkcs12 = f.read()
+
+        self.create(cfg, force=force)
+        with open(pkcs12path, 'rb') as f:
+            assert (f.read() == pkcs12) != force
+        assert self.check(certdir) is None
+
+    def test_create_certificates_renewed(self, tmpdir):
+        certdir = str(tmpdir)
+        self.create(self.get_config(certdir))
+        self.create(self.get_config(
+            certdir, **{'ssl.certificate.commonname': 'example.org'}))
+        assert self.check(
+            certdir, subject='/L=OMERO/O=OMERO.server/CN=example.org') is None
+
+    @pytest.mark.parametrize('backend', BACKENDS)
+    def test_create_host_certificates(self, tmpdir, backend):
+        hostsfile = str(tmpdir.join('hosts.txt'))
+        with open(hostsfile, 'w') as f:
+            f.write('# comment\nnode1.example.org\n\n'
+                    'node2.example.org  # second\n192.0.2.1\n'
+                    'node1.example.org\n')
+        cadir = str(tmpdir.join('ca'))
+        cfg = self.get_config(str(tmpdir.join('certs')))
+
+        def create():
+            ext = self.mox.CreateMock(external.External)
+            ext.get_config().AndReturn(cfg)
+            self.mox.ReplayAll()
+            manifest = create_host_certificates(
+                ext, hostsfile, cadir, backend=backend, jobs=2)
+            self.mox.VerifyAll()
+            self.mox.ResetAll()
+            return manifest
+
+        manifest = create()
+        assert manifest['ca']['issued']
+        assert [e['host'] for e in manifest['hosts']] == [
+            'node1.example.org', 'node2.example.org', '192.0.2.1']
+        for e in manifest['hosts']:
+            assert e['issued']
+            assert len(e['fingerprint']) == 95
+            external.run('openssl', [
+                'verify', '-CAfile', os.path.join(cadir, 'ca.pem'),
+                e['certificate']], capturestd=True)
+        with open(os.path.join(cadir, 'manifest.json')) as f:
+            assert json.load(f) == manifest
+
+        reused = create()
+        assert not reused['ca']['issued']
+        assert not any(e['issued'] for e in reused['hosts'])
+        assert [e['fingerprint'] for e in reused['hosts']] == [
+            e['fingerprint'] for e in manifest['hosts']]
+
+    def test_read_hosts(self, tmpdir):
+        hostsfile = str(tmpdir.join('hosts.txt'))
+        with open(hostsfile, 'w') as f:
+            f.write('../etc\n')
+        with pytest.raises(Exception) as excinfo:
+            read_hosts(hostsfile)
+        assert str(excinfo.value) == 'Invalid hostname: ../etc'
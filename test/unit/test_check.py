@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import subprocess
+import pytest
+from mox3 import mox
+
+from omero_server_setup.check import (
+    DB_INIT_NEEDED,
+    DB_NO_CONNECTION,
+    DB_UNREACHABLE,
+    DB_UPGRADE_NEEDED,
+    DB_UPTODATE,
+    check_database,
+    main,
+    read_config,
+)
+
+CONFIG_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<icegrid>
+  <properties id="__ACTIVE__">
+    <property name="omero.config.profile" value="default"/>
+    <property name="omero.config.version" value="5.1.0"/>
+  </properties>
+  <properties id="default">
+    <property name="omero.db.name" value="dbname"/>
+    <property name="omero.db.pass" value="dbpass"/>
+  </properties>
+  <properties id="other">
+    <property name="omero.db.name" value="other"/>
+  </properties>
+</icegrid>
+'''
+
+
+def _omerodir(tmpdir):
+    tmpdir.ensure('etc', 'grid', 'config.xml').write(CONFIG_XML)
+    tmpdir.ensure('sql', 'psql', 'OMERO5.4__0', 'OMERO5.3__0.sql')
+    return str(tmpdir)
+
+
+def test_read_config(tmpdir, monkeypatch):
+    omerodir = _omerodir(tmpdir)
+    monkeypatch.delenv('OMERO_CONFIG', raising=False)
+    assert read_config(omerodir) == {
+        'omero.db.name': 'dbname', 'omero.db.pass': 'dbpass'}
+    monkeypatch.setenv('OMERO_CONFIG', 'other')
+    assert read_config(omerodir) == {'omero.db.name': 'other'}
+    assert read_config(str(tmpdir.join('missing'))) == {}
+
+
+class TestCheckDatabase(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    @pytest.mark.parametrize('returncode,stdout,stderr,rc', [
+        (0, b'OMERO5.4|0\n', b'', DB_UPTODATE),
+        (0, b'OMERO5.3|0\n', b'', DB_UPGRADE_NEEDED),
+        (0, b'', b'', DB_INIT_NEEDED),
+        (3, b'', b'ERROR:  relation "dbpatch" does not exist', DB_INIT_NEEDED),
+        (2, b'', b'psql: error: connection to server at "localhost", port '
+         b'5432 failed: Connection refused', DB_UNREACHABLE),
+        (2, b'', b'FATAL:  password authentication failed for user "omero"',
+         DB_NO_CONNECTION),
+    ])
+    def test_check_database(self, tmpdir, returncode, stdout, stderr, rc):
+        omerodir = _omerodir(tmpdir)
+        self.mox.StubOutWithMock(subprocess, 'run')
+        subprocess.run(
+            ['psql', '-v', 'ON_ERROR_STOP=on', '-w', '-A', '-t',
+             '-h', 'dbhost', '-p', '5432', '-U', 'omero', '-d', 'dbname',
+             '-c', mox.StrContains('FROM dbpatch')],
+            env=mox.ContainsKeyValue('PGPASSWORD', 'dbpass'),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).AndReturn(
+            subprocess.CompletedProcess([], returncode, stdout, stderr))
+        self.mox.ReplayAll()
+
+        result = check_database(omerodir, {
+            'omero.db.host': 'dbhost', 'omero.db.name': 'ignored'})
+        assert result['rc'] == rc
+        if rc in (DB_UPTODATE, DB_UPGRADE_NEEDED):
+            assert result['version'] in ('OMERO5.4__0', 'OMERO5.3__0')
+        if rc in (DB_UNREACHABLE, DB_NO_CONNECTION):
+            assert result['error'] in ('refused', 'auth')
+        self.mox.VerifyAll()
+
+    def test_main(self, tmpdir, capsys):
+        omerodir = _omerodir(tmpdir)
+        self.mox.StubOutWithMock(subprocess, 'run')
+        subprocess.run(
+            mox.IsA(list), env=mox.ContainsKeyValue('PGCONNECT_TIMEOUT', '2'),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).AndReturn(
+            subprocess.CompletedProcess([], 0, b'OMERO5.4|0\n', b''))
+        self.mox.ReplayAll()
+
+        assert main(['--omerodir', omerodir, '--timeout', '2']) == 0
+        result = json.loads(capsys.readouterr().out)
+        assert result['status'] == 'uptodate'
+        self.mox.VerifyAll()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from mox3 import mox
+
+from argparse import ArgumentParser
+
+from omero_server_setup import external
+import omero_server_setup.db
+from omero_server_setup.cli import SetupControl
+from omero_server_setup.createconfig import CreateConfig
+from omero_server_setup.db import DbAdmin
+
+
+class Parser(ArgumentParser):
+    """
+    The parts of omero.cli.Parser used by SetupControl
+    """
+
+    def sub(self):
+        return self.add_subparsers()
+
+
+def parse_args(argv):
+    parser = Parser()
+    SetupControl()._configure(parser)
+    return parser.parse_args(argv)
+
+
+class TestCli(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    @pytest.mark.parametrize('command', [
+        'backup', 'justdoit', 'pgstop', 'upgrade'])
+    def test_pgadmin_args(self, command):
+        args = parse_args([command, '--adminuser', 'a', '--adminpass', 'b'])
+        assert (args.adminuser, args.adminpass) == ('a', 'b')
+
+    def test_upgrade_backup_admin_connection(self, tmpdir):
+        args = parse_args([
+            'upgrade', '--backup', '--adminuser', 'pgadmin',
+            '--adminpass', 'secret'])
+        ext = self.mox.CreateMock(external.External)
+        ext.get_config().MultipleTimes().AndReturn({})
+        self.mox.StubOutWithMock(omero_server_setup.db, 'run')
+
+        def is_admin(psqlargs):
+            return (psqlargs[psqlargs.index('-U') + 1] == 'pgadmin' and
+                    psqlargs[psqlargs.index('-d') + 1] == 'postgres')
+
+        omero_server_setup.db.run(
+            'psql', mox.Func(is_admin), capturestd=True,
+            env=mox.Func(lambda env: env['PGPASSWORD'] == 'secret'),
+        ).AndReturn((b'1|1000\n', b''))
+        self.mox.ReplayAll()
+
+        # One other session so the database can't be cloned
+        assert not DbAdmin(str(tmpdir), args, ext).can_clone_database()
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('error', [
+        FileNotFoundError('psql'),
+        external.RunException('', 'psql', [], 2, b'', b'no database'),
+        None,
+    ])
+    def test_createconfig_connection_report(self, tmpdir, monkeypatch,
+                                            error):
+        monkeypatch.setenv('OMERODIR', str(tmpdir))
+        args = parse_args(['createconfig'])
+        control = SetupControl()
+        control.ctx = self.mox.CreateMockAnything()
+        control._externals = {str(tmpdir): self.mox.CreateMock(
+            external.External)}
+        self.mox.StubOutWithMock(CreateConfig, 'create_or_update_config')
+        self.mox.StubOutWithMock(DbAdmin, 'connection_report')
+
+        CreateConfig.create_or_update_config().AndReturn(({}, ['a: → b']))
+        control.ctx.out('a: → b')
+        call = DbAdmin.connection_report()
+        if error:
+            call.AndRaise(error)
+        else:
+            call.AndReturn(('Database connections: headroom 1', 1))
+            control.ctx.out('Database connections: headroom 1')
+        self.mox.ReplayAll()
+
+        control.createconfig(args)
+        self.mox.VerifyAll()
+
+    def test_run_captured_exception(self):
+        control = SetupControl()
+        control.ctx = self.mox.CreateMockAnything()
+
+        def invoke(argv):
+            print('partial')
+            raise KeyError('boom')
+
+        control.ctx.invoke(['setup', 'dump']).WithSideEffects(invoke)
+        self.mox.ReplayAll()
+
+        rc, stdout, stderr = control.run_captured(['dump'])
+        assert (rc, stdout) == (1, 'partial\n')
+        assert "KeyError: 'boom'" in stderr
+        self.mox.VerifyAll()
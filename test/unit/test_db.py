@@ -27,9 +27,18 @@ import os
 import re
 
 from omero_server_setup import external
+from omero_server_setup.basebackup import (
+    read_index,
+    write_index,
+)
 import omero_server_setup.db
 from omero_server_setup.db import (
+    CHECKPOINT_TIMEOUT,
+    CONNECT_TIMEOUT,
+    DB_NO_CONNECTION,
+    DB_UNREACHABLE,
     DbAdmin,
+    SchemaVersion,
     is_schema,
     sort_schemas,
     parse_schema_files,
@@ -59,6 +68,20 @@ def test_sort_schemas():
     assert sort_schemas(permuted) == ordered
 
 
+def test_schema_version():
+    v = SchemaVersion('OMERO5.1DEV__10')
+    assert v is SchemaVersion('OMERO5.1DEV__10')
+    assert v is SchemaVersion.from_db('OMERO5.1DEV', '10')
+    assert (v.version, v.patch) == ('OMERO5.1DEV', '10')
+    assert str(v) == 'OMERO5.1DEV__10'
+    assert v == 'OMERO5.1DEV__10'
+    assert hash(v) == hash('OMERO5.1DEV__10')
+    assert SchemaVersion('OMERO5.1DEV__2') < v < SchemaVersion('OMERO5.1__0')
+    assert v > 'OMERO5.0__0'
+    with pytest.raises(ValueError):
+        SchemaVersion('OMERO5.2__precheck')
+
+
 def test_parse_schema_files():
     files = [
         # Parsed schema files
@@ -112,15 +135,52 @@ class TestDb(object):
             s = timestamp_filename('name')
             assert re.match(r'^name-\d{8}-\d{6}-\d{6}$', s)
 
+    def test_run(self):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(db, 'status')
+        db.status().AndReturn({'up': True})
+        self.mox.ReplayAll()
+
+        assert db.run('status') == {'up': True}
+        with pytest.raises(Stop) as excinfo:
+            db.run('check_connection')
+        assert excinfo.value.rc == 10
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('client,server,ok', [
+        ('16.2', 160004, True),
+        ('17.0', 160004, True),
+        ('12.1', 160004, False),
+        ('9.6.3', 90624, True),
+        ('9.5.1', 90624, False),
+    ])
+    def test_check_client_version(self, client, server, ok):
+        db = self.PartialMockDb(None, None)
+        db._toolchain = {
+            'pg_dump': {'path': '/bin/pg_dump', 'version': client}}
+        self.mox.StubOutWithMock(db, 'get_server_version_num')
+        db.get_server_version_num().AndReturn(server)
+        self.mox.ReplayAll()
+
+        if ok:
+            db.check_client_version('pg_dump')
+            # Only checked once
+            db.check_client_version('pg_dump')
+        else:
+            with pytest.raises(Stop) as excinfo:
+                db.check_client_version('pg_dump')
+            assert excinfo.value.rc == 60
+        self.mox.VerifyAll()
+
     @pytest.mark.parametrize('connected', [True, False])
     def test_check_connection(self, connected):
         db = self.PartialMockDb(None, None)
         self.mox.StubOutWithMock(db, 'psql')
 
         if connected:
-            db.psql('-c', r'\conninfo')
+            db.psql('-c', r'\conninfo', connect_timeout=10)
         else:
-            db.psql('-c', r'\conninfo').AndRaise(
+            db.psql('-c', r'\conninfo', connect_timeout=10).AndRaise(
                 external.RunException('', '', [], 1, '', ''))
         self.mox.ReplayAll()
 
@@ -133,6 +193,64 @@ class TestDb(object):
 
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('errors,rc', [
+        (['Connection refused', 'timeout expired'], None),
+        (['Connection refused'] * 3, DB_UNREACHABLE),
+        (['could not translate host name "x"', 'FATAL:  role "omero" does '
+          'not exist'], DB_NO_CONNECTION),
+    ])
+    def test_check_connection_retry(self, errors, rc):
+        args = self.Args({'connect_timeout': 2, 'connect_retries': 2,
+                          'connect_backoff': 0})
+        db = self.PartialMockDb(args, None)
+        self.mox.StubOutWithMock(db, 'psql')
+
+        for error in errors:
+            db.psql('-c', r'\conninfo', connect_timeout=2).AndRaise(
+                external.RunException('', '', [], 2, b'', error.encode()))
+        if rc is None:
+            db.psql('-c', r'\conninfo', connect_timeout=2)
+        self.mox.ReplayAll()
+
+        if rc is None:
+            probe = db.check_connection()
+            assert probe['attempts'] == 3
+            assert len(probe['rtts']) == 3
+        else:
+            with pytest.raises(Stop) as excinfo:
+                db.check_connection()
+            assert excinfo.value.rc == rc
+        self.mox.VerifyAll()
+
+    def test_out(self, tmpdir, capsys):
+        ctx = self.mox.CreateMockAnything()
+        ctx.out('a')
+        ctx.out('b')
+        self.mox.ReplayAll()
+
+        DbAdmin(str(tmpdir), None, object(), ctx).out('a', 'b')
+        self.mox.VerifyAll()
+        DbAdmin(str(tmpdir), None, object()).out('c')
+        assert capsys.readouterr().out == 'c\n'
+
+    def test_memoize(self):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(db, 'psql')
+        q = ('SELECT currentversion, currentpatch FROM dbpatch '
+             'ORDER BY id DESC LIMIT 1')
+        db.psql('-c', r'\conninfo', connect_timeout=10)
+        db.psql('-c', q).AndReturn('OMERO5.3|0\n')
+        db.psql('-c', q).AndReturn('OMERO5.4|0\n')
+        self.mox.ReplayAll()
+
+        db.check_connection()
+        db.check_connection()
+        assert db.get_current_db_version() == SchemaVersion('OMERO5.3__0')
+        assert db.get_current_db_version() == SchemaVersion('OMERO5.3__0')
+        db.invalidate('upgrade')
+        assert db.get_current_db_version() == SchemaVersion('OMERO5.4__0')
+        self.mox.VerifyAll()
+
     @pytest.mark.parametrize('sqlfile', ['exists', 'missing', 'notprovided'])
     @pytest.mark.parametrize('dryrun', [True, False])
     def test_init(self, sqlfile, dryrun):
@@ -241,7 +359,7 @@ class TestDb(object):
             db.psql('-c', "CREATE DATABASE name WITH OWNER user;",
                     admin=True)
 
-        db.psql('-c', r'\conninfo')
+        db.psql('-c', r'\conninfo', connect_timeout=10)
 
         self.mox.ReplayAll()
 
@@ -256,21 +374,28 @@ class TestDb(object):
         self.mox.StubOutWithMock(db, 'sql_version_matrix')
         self.mox.StubOutWithMock(db, 'sql_version_resolve')
         self.mox.StubOutWithMock(db, 'check_connection')
+        self.mox.StubOutWithMock(db, 'get_upgrade_settings')
         self.mox.StubOutWithMock(db, 'psql')
 
         db.check_connection()
 
         versions = ['OMERO3.0__0', 'OMERO4.4__0', 'OMERO5.0__0']
         if needupdate:
-            db.get_current_db_version().AndReturn(('OMERO3.0', '0'))
+            db.get_current_db_version().AndReturn(
+                SchemaVersion('OMERO3.0__0'))
             db.sql_version_matrix().AndReturn(([], versions))
             db.sql_version_resolve([], versions, versions[0]).AndReturn(
                 ['./sql/psql/OMERO4.4__0/OMERO3.0__0.sql',
                  './sql/psql/OMERO5.0__0/OMERO4.4__0.sql'])
-            db.psql('-f', './sql/psql/OMERO4.4__0/OMERO3.0__0.sql')
-            db.psql('-f', './sql/psql/OMERO5.0__0/OMERO4.4__0.sql')
+            settings = {'maintenance_work_mem': '1GB'}
+            db.get_upgrade_settings().AndReturn(settings)
+            db.psql('-f', './sql/psql/OMERO4.4__0/OMERO3.0__0.sql',
+                    settings=settings)
+            db.psql('-f', './sql/psql/OMERO5.0__0/OMERO4.4__0.sql',
+                    settings=settings)
         else:
-            db.get_current_db_version().AndReturn(('OMERO5.0', '0'))
+            db.get_current_db_version().AndReturn(
+                SchemaVersion('OMERO5.0__0'))
             db.sql_version_matrix().AndReturn(([], versions))
 
         self.mox.ReplayAll()
@@ -278,6 +403,114 @@ class TestDb(object):
         db.upgrade()
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('cfg,args,expected', [
+        ({}, {}, {}),
+        ({'postgres.upgrade.memory': '512MB'}, {'upgrade_parallel': 2}, {
+            'maintenance_work_mem': '512MB',
+            'work_mem': '128MB',
+            'max_parallel_maintenance_workers': '2',
+        }),
+        ({'postgres.data.dir': '/data', 'postgres.upgrade.parallel': '0'},
+         {'upgrade_memory': '1GB'}, {
+            'maintenance_work_mem': '1024MB',
+            'work_mem': '256MB',
+            'max_parallel_maintenance_workers': '0',
+        }),
+        ({'postgres.data.dir': '/data'}, {}, {
+            'maintenance_work_mem': '2048MB',
+            'work_mem': '512MB',
+            'max_parallel_maintenance_workers': '3',
+        }),
+    ])
+    def test_get_upgrade_settings(self, cfg, args, expected):
+        ext = self.mox.CreateMock(external.External)
+        db = self.PartialMockDb(self.Args(args), ext)
+        self.mox.StubOutWithMock(omero_server_setup.db, 'host_resources')
+        self.mox.StubOutWithMock(db, 'get_server_version_num')
+        ext.get_config().AndReturn(cfg)
+        if cfg == {'postgres.data.dir': '/data'}:
+            omero_server_setup.db.host_resources().AndReturn(
+                (16 * 1024 ** 2, 4))
+        if expected:
+            db.get_server_version_num().AndReturn(160000)
+        self.mox.ReplayAll()
+
+        assert db.get_upgrade_settings() == expected
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('method', ['template', 'dump'])
+    @pytest.mark.parametrize('fail', [True, False])
+    def test_upgrade_backup(self, method, fail):
+        args = self.Args({'dry_run': False, 'backup': True,
+                          'keep_backup': False})
+        db = self.PartialMockDb(args, None)
+        self.mox.StubOutWithMock(db, 'get_current_db_version')
+        self.mox.StubOutWithMock(db, 'sql_version_matrix')
+        self.mox.StubOutWithMock(db, 'sql_version_resolve')
+        self.mox.StubOutWithMock(db, 'check_connection')
+        self.mox.StubOutWithMock(db, 'backup_database')
+        self.mox.StubOutWithMock(db, 'restore_backup')
+        self.mox.StubOutWithMock(db, 'drop_database')
+        self.mox.StubOutWithMock(db, 'get_upgrade_settings')
+        self.mox.StubOutWithMock(db, 'psql')
+
+        db.check_connection()
+        versions = ['OMERO4.4__0', 'OMERO5.0__0']
+        db.get_current_db_version().AndReturn(SchemaVersion('OMERO4.4__0'))
+        db.sql_version_matrix().AndReturn(([], versions))
+        db.sql_version_resolve([], versions, versions[0]).AndReturn(
+            ['./sql/psql/OMERO5.0__0/OMERO4.4__0.sql'])
+        backup = {'method': method, 'name': 'backup', 'seconds': 1}
+        db.backup_database().AndReturn(backup)
+        db.get_upgrade_settings().AndReturn({})
+        exc = external.RunException(
+            'test psql failure', 'psql', [], 1, '', '')
+        if fail:
+            db.psql('-f', './sql/psql/OMERO5.0__0/OMERO4.4__0.sql',
+                    settings={}).AndRaise(exc)
+            db.restore_backup(backup)
+        else:
+            db.psql('-f', './sql/psql/OMERO5.0__0/OMERO4.4__0.sql',
+                    settings={})
+            if method == 'template':
+                db.drop_database('backup')
+        self.mox.ReplayAll()
+
+        if fail:
+            with pytest.raises(external.RunException):
+                db.upgrade()
+        else:
+            db.upgrade()
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('sessions,free,expected', [
+        ('0', 300, True),
+        ('1', 300, False),
+        ('0', 100, False),
+    ])
+    def test_can_clone_database(self, tmpdir, sessions, free, expected):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(db, 'get_db_args_env')
+        db.external = self.mox.CreateMock(external.External)
+        self.mox.StubOutWithMock(db, 'psql')
+        self.mox.StubOutWithMock(omero_server_setup.db.shutil, 'disk_usage')
+
+        db.get_db_args_env().AndReturn(self.create_db_test_params())
+        db.psql('-c', (
+            "SELECT count(*), pg_database_size('name') FROM pg_stat_activity "
+            "WHERE datname = 'name';"), admin=True).AndReturn(
+            '%s|100\n' % sessions)
+        if sessions == '0':
+            db.external.get_config().AndReturn(
+                {'postgres.data.dir': str(tmpdir)})
+            omero_server_setup.db.shutil.disk_usage(str(tmpdir)).AndReturn(
+                omero_server_setup.db.shutil._ntuple_diskusage(
+                    1000, 1000 - free, free))
+        self.mox.ReplayAll()
+
+        assert db.can_clone_database() is expected
+        self.mox.VerifyAll()
+
     @pytest.mark.parametrize('needupdate', [True, False])
     def test_upgrade_dryrun(self, needupdate):
         args = self.Args({'dry_run': True})
@@ -293,12 +526,14 @@ class TestDb(object):
 
         versions = ['OMERO4.4__0', 'OMERO5.0__0']
         if needupdate:
-            db.get_current_db_version().AndReturn(('OMERO4.4', '0'))
+            db.get_current_db_version().AndReturn(
+                SchemaVersion('OMERO4.4__0'))
             db.sql_version_matrix().AndReturn(([], versions))
             db.sql_version_resolve([], versions, versions[0]).AndReturn(
                 ['./sql/psql/OMERO5.0__0/OMERO4.4__0.sql'])
         else:
-            db.get_current_db_version().AndReturn(('OMERO5.0', '0'))
+            db.get_current_db_version().AndReturn(
+                SchemaVersion('OMERO5.0__0'))
             db.sql_version_matrix().AndReturn(([], versions))
 
         self.mox.ReplayAll()
@@ -341,7 +576,9 @@ class TestDb(object):
                 'ORDER BY id DESC LIMIT 1').AndReturn('OMERO4.4|0')
         self.mox.ReplayAll()
 
-        assert db.get_current_db_version() == ('OMERO4.4', '0')
+        v = db.get_current_db_version()
+        assert v is SchemaVersion('OMERO4.4__0')
+        assert (v.version, v.patch) == ('OMERO4.4', '0')
         self.mox.VerifyAll()
 
     @pytest.mark.parametrize('dumpfile', ['test.pgdump', None])
@@ -353,6 +590,8 @@ class TestDb(object):
         self.mox.StubOutWithMock(db, 'get_db_args_env')
         self.mox.StubOutWithMock(db, 'pgdump')
         self.mox.StubOutWithMock(db, 'check_connection')
+        self.mox.StubOutWithMock(omero_server_setup.db, 'record_dump')
+        self.mox.StubOutWithMock(db, 'check_client_version')
 
         db.check_connection()
         if not dumpfile:
@@ -361,15 +600,185 @@ class TestDb(object):
             dumpfile = 'omero-database-name-00000000-000000-000000.pgdump'
             omero_server_setup.db.timestamp_filename(
                 'omero-database-name', 'pgdump').AndReturn(dumpfile)
+        db.check_client_version('pg_dump')
 
         if not dryrun:
             db.pgdump('-Fc', '-f', dumpfile).AndReturn('')
+            omero_server_setup.db.record_dump(dumpfile, mox.IsA(float))
 
         self.mox.ReplayAll()
 
         db.dump()
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('vacuum', [True, False])
+    def test_maintain(self, vacuum):
+        args = self.Args({'dry_run': False, 'jobs': 1, 'vacuum': vacuum})
+        db = self.PartialMockDb(args, None)
+        self.mox.StubOutWithMock(db, 'psql')
+        self.mox.StubOutWithMock(db, 'out')
+
+        db.psql('-c', mox.StrContains('pg_stat_user_tables')).AndReturn(
+            'image|1000|5|0\npixels|5000|50|2\n')
+        for target in ('1', '10'):
+            for table in ('pixels', 'image'):
+                db.psql('-c', 'SET default_statistics_target = %s;' % target,
+                        '-c', 'ANALYZE "%s";' % table).InAnyOrder(target)
+        for table in ('pixels', 'image'):
+            db.psql('-c', '%s "%s";' % (
+                'VACUUM (ANALYZE)' if vacuum else 'ANALYZE', table)
+            ).InAnyOrder('default')
+        db.out(*([mox.IsA(str)] * 9))
+        db.out(mox.StrContains('Maintenance of 2 tables completed'))
+        self.mox.ReplayAll()
+
+        db.maintain()
+        self.mox.VerifyAll()
+
+    def test_status(self, tmpdir):
+        args = self.Args({'format': 'json', 'top': 2,
+                          'dump_dir': str(tmpdir)})
+        db = self.PartialMockDb(args, None)
+        db.external = self.mox.CreateMock(external.External)
+        self.mox.StubOutWithMock(db, 'psql')
+        self.mox.StubOutWithMock(db, 'sql_version_matrix')
+        self.mox.StubOutWithMock(db, 'get_db_args_env')
+        self.mox.StubOutWithMock(db, 'out')
+        tmpdir.join(
+            'omero-database-name-20261019-000000-000000.pgdump').write('')
+
+        db.psql('-c', mox.StrContains('LIMIT 2'),
+                connect_timeout=CONNECT_TIMEOUT).AndReturn(
+            '{"version" : "OMERO4.4__0", "size" : 100, '
+            '"tables" : [{"name":"pixels","size":60}]}\n')
+        db.sql_version_matrix().AndReturn(
+            ([], [SchemaVersion('OMERO4.4__0'), SchemaVersion('OMERO5.0__0')]))
+        db.external.get_config(raise_missing=False).AndReturn({})
+        db.get_db_args_env().AndReturn(self.create_db_test_params())
+        db.out(mox.IsA(str))
+        self.mox.ReplayAll()
+
+        status = db.status()
+        self.mox.VerifyAll()
+        assert status['up'] is True
+        assert status['upgrade_needed'] is True
+        assert status['latest'] == 'OMERO5.0__0'
+        assert status['tables'] == {'pixels': 60}
+        assert status['last_dump_age'] > 0
+        assert 'postgres_running' not in status
+
+    def test_status_uninitialised(self, tmpdir):
+        args = self.Args({'format': 'json', 'connect_timeout': 3,
+                          'dump_dir': str(tmpdir.join('missing'))})
+        db = self.PartialMockDb(args, None)
+        db.external = self.mox.CreateMock(external.External)
+        self.mox.StubOutWithMock(db, 'psql')
+        self.mox.StubOutWithMock(db, 'sql_version_matrix')
+        self.mox.StubOutWithMock(db, 'get_db_args_env')
+        self.mox.StubOutWithMock(db, 'out')
+        self.mox.StubOutWithMock(omero_server_setup.db, 'get_backend')
+        certdir = tmpdir.mkdir('certs')
+        certdir.join('server.pem').write('invalid')
+
+        db.psql('-c', mox.StrContains('to_regclass'),
+                connect_timeout=3).AndReturn(
+            '{"version" : null, "size" : 100, "tables" : []}\n')
+        db.sql_version_matrix().AndReturn(
+            ([], [SchemaVersion('OMERO5.0__0')]))
+        db.external.get_config(raise_missing=False).AndReturn({
+            'omero.glacier2.IceSSL.DefaultDir': str(certdir),
+            'omero.glacier2.IceSSL.CAs': 'server.pem',
+        })
+        backend = self.mox.CreateMockAnything()
+        omero_server_setup.db.get_backend().AndReturn(backend)
+        backend.read_certificate(str(certdir.join('server.pem'))).AndRaise(
+            ValueError('invalid certificate'))
+        db.get_db_args_env().AndReturn(self.create_db_test_params())
+        db.out(mox.IsA(str))
+        self.mox.ReplayAll()
+
+        status = db.status()
+        self.mox.VerifyAll()
+        assert status['up'] is True
+        assert status['version'] is None
+        assert 'upgrade_needed' not in status
+        assert 'certificate_expiry' not in status
+        assert 'last_dump_age' not in status
+
+    def test_take_base_backup(self, tmpdir):
+        args = self.Args({'dry_run': False, 'type': 'incremental',
+                          'compress': 'none', 'keep_full': 1})
+        db = self.PartialMockDb(args, None)
+        self.mox.StubOutWithMock(omero_server_setup.db, 'timestamp_filename')
+        self.mox.StubOutWithMock(db, 'pgbasebackup')
+        self.mox.StubOutWithMock(db, 'pgtool')
+        self.mox.StubOutWithMock(db, 'check_client_version')
+
+        basedir = tmpdir.mkdir('base')
+        waldir = tmpdir.mkdir('wal')
+        backups = []
+        for label, parent in (('full-1', None), ('full-2', None)):
+            basedir.mkdir(label)
+            backups.append({
+                'label': label, 'type': 'full', 'parent': parent,
+                'time': '2026-10-01T00:00:00+00:00', 'compress': 'none',
+                'start_wal': '000000010000000000000001', 'size': 1})
+        backups[1]['start_wal'] = '000000010000000000000003'
+        write_index(str(basedir), backups)
+
+        def write_manifest(*args):
+            path = basedir.mkdir('incremental-3')
+            path.join('backup_manifest').write(
+                '{"WAL-Ranges": [{"Timeline": 1, "Start-LSN": "0/5000028"}]}')
+
+        omero_server_setup.db.timestamp_filename('incremental').AndReturn(
+            'incremental-3')
+        db.check_client_version('pg_basebackup')
+        db.pgbasebackup(
+            '-D', str(basedir.join('incremental-3')), '-X', 'stream',
+            '--checkpoint=fast', '-l', 'incremental-3', '-Fp',
+            '--incremental={}'.format(
+                basedir.join('full-2', 'backup_manifest'))
+        ).WithSideEffects(write_manifest)
+        db.pgtool('pg_archivecleanup', str(waldir),
+                  '000000010000000000000003')
+        self.mox.ReplayAll()
+
+        db.take_base_backup(str(basedir), str(waldir))
+        self.mox.VerifyAll()
+
+        index = read_index(str(basedir))
+        assert [(b['label'], b['parent']) for b in index] == [
+            ('full-2', None), ('incremental-3', 'full-2')]
+        assert index[1]['start_wal'] == '000000010000000000000005'
+        assert not basedir.join('full-1').exists()
+
+    @pytest.mark.parametrize('problem', ['target_time', 'staging'])
+    def test_restore_base_backup_invalid(self, tmpdir, problem):
+        args = self.Args({
+            'dry_run': False, 'restore': 'latest',
+            'target_time': 'yesterday' if problem == 'target_time' else None})
+        db = self.PartialMockDb(args, None)
+        self.mox.StubOutWithMock(db, 'pgisrunning')
+        basedir = tmpdir.mkdir('base')
+        waldir = tmpdir.mkdir('wal')
+        basedir.mkdir('full-1')
+        write_index(str(basedir), [{
+            'label': 'full-1', 'type': 'full', 'parent': None,
+            'time': '2026-10-01T00:00:00+00:00', 'compress': 'none',
+            'start_wal': '000000010000000000000001', 'size': 1}])
+        tmpdir.mkdir('pgdata.restore')
+        db.pgisrunning().AndReturn(False)
+        self.mox.ReplayAll()
+
+        with pytest.raises(Stop) as excinfo:
+            db.restore_base_backup(
+                {'postgres.data.dir': str(tmpdir.join('pgdata'))},
+                str(basedir), str(waldir))
+        assert excinfo.value.rc == (
+            54 if problem == 'target_time' else 55)
+        self.mox.VerifyAll()
+
     def create_db_test_params(self, prefix=''):
         db = {
             'name': '%sname' % prefix,
@@ -431,6 +840,185 @@ class TestDb(object):
                 db.get_db_args_env()
             assert str(excinfo.value) == 'Database name required'
 
+    @pytest.mark.parametrize('running', [True, False])
+    def test_get_db_args_env_socket(self, tmpdir, running):
+        ext = self.mox.CreateMock(external.External)
+        args = self.Args({'no_db_config': False})
+        db = self.PartialMockDb(args, ext)
+        self.mox.StubOutWithMock(db.external, 'get_config')
+        socketdir = tmpdir.ensure('pgsocket', dir=True)
+        if running:
+            socketdir.ensure('.s.PGSQL.5432')
+        db.external.get_config().AndReturn({
+            'omero.db.host': 'localhost',
+            'postgres.socket.dir': str(socketdir),
+        })
+        self.mox.ReplayAll()
+
+        rcfg, renv = db.get_db_args_env()
+        assert rcfg['host'] == (str(socketdir) if running else 'localhost')
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('retcode', [0, 3])
+    def test_pgstatus_fallback(self, tmpdir, retcode):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(omero_server_setup.db, 'run')
+        tmpdir.ensure('postmaster.pid', dir=True)
+        call = omero_server_setup.db.run(
+            'pg_ctl', ['--pgdata={}'.format(tmpdir), 'status'],
+            capturestd=True)
+        if retcode:
+            call.AndRaise(external.RunException(
+                '', 'pg_ctl', [], retcode, b'', b''))
+        else:
+            call.AndReturn((b'pg_ctl: server is running', b''))
+        self.mox.ReplayAll()
+
+        status = db.pgstatus({'postgres.data.dir': str(tmpdir)})
+        assert status == {'running': not retcode, 'datadir': str(tmpdir)}
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('running', [True, False])
+    @pytest.mark.parametrize('settings', [False, True])
+    def test_pgstart(self, running, settings):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(db, 'get_and_check_config')
+        self.mox.StubOutWithMock(db, 'pgisrunning')
+        self.mox.StubOutWithMock(db, 'pg_ctl')
+        cfg = {'postgres.data.dir': '/data', 'omero.db.port': '15432'}
+        options = '-p 15432'
+        if settings:
+            cfg['postgres.max_connections'] = '133'
+            cfg['postgres.shared_buffers'] = '2GB'
+            options += ' -c max_connections=133 -c shared_buffers=2048MB'
+        db.get_and_check_config().AndReturn(cfg)
+        db.pgisrunning(cfg).AndReturn(running)
+        db.pg_ctl('restart' if running else 'start',
+                  '--log=/data/postgres.log', '-o', options, cfg=cfg)
+        self.mox.ReplayAll()
+
+        db.pgstart()
+        self.mox.VerifyAll()
+
+    def test_pgstart_invalid(self):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(db, 'get_and_check_config')
+        self.mox.StubOutWithMock(db, 'pgisrunning')
+        cfg = {'postgres.data.dir': '/data', 'omero.db.port': '15432',
+               'postgres.shared_buffers': '2 gigabytes'}
+        db.get_and_check_config().AndReturn(cfg)
+        db.pgisrunning(cfg).AndReturn(False)
+        self.mox.ReplayAll()
+
+        with pytest.raises(Stop) as excinfo:
+            db.pgstart()
+        assert excinfo.value.rc == 70
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('running', [True, False])
+    @pytest.mark.parametrize('checkpoint', [True, False])
+    @pytest.mark.parametrize('timeout', [30, None])
+    def test_pgstop(self, running, checkpoint, timeout):
+        ext = self.mox.CreateMock(external.External)
+        args = self.Args({'mode': 'immediate', 'timeout': timeout})
+        db = self.PartialMockDb(args, ext)
+        self.mox.StubOutWithMock(db, 'get_and_check_config')
+        self.mox.StubOutWithMock(db, 'pgisrunning')
+        self.mox.StubOutWithMock(db, 'psql')
+        self.mox.StubOutWithMock(db, 'pg_ctl')
+        cfg = {'postgres.data.dir': '/data'}
+        db.get_and_check_config().AndReturn(cfg)
+        db.pgisrunning(cfg).AndReturn(running)
+        if running:
+            call = db.psql(
+                '-c', 'CHECKPOINT', admin=True,
+                connect_timeout=CONNECT_TIMEOUT, settings={
+                    'statement_timeout': '{}s'.format(
+                        timeout or CHECKPOINT_TIMEOUT)})
+            if checkpoint:
+                call.AndReturn('')
+            else:
+                # Timed out
+                call.AndRaise(external.RunException(
+                    '', 'psql', [], 1, b'',
+                    b'canceling statement due to statement timeout'))
+            stopargs = ['stop', '--mode=immediate']
+            if timeout:
+                stopargs.append('--timeout={}'.format(timeout))
+            db.pg_ctl(*stopargs, cfg=cfg)
+        self.mox.ReplayAll()
+
+        db.pgstop()
+        self.mox.VerifyAll()
+
+    def test_get_db_args_env_pooler(self):
+        ext = self.mox.CreateMock(external.External)
+        db = self.PartialMockDb(self.Args({'no_db_config': False}), ext)
+        db.external.get_config().AndReturn({
+            'omero.db.port': '16432',
+            'postgres.port': '15432',
+        })
+        self.mox.ReplayAll()
+
+        rcfg, renv = db.get_db_args_env()
+        assert rcfg['port'] == '15432'
+        self.mox.VerifyAll()
+
+    def test_write_pooler_config(self, tmpdir):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(omero_server_setup.db, 'host_resources')
+        omero_server_setup.db.host_resources().AndReturn((None, 2))
+        self.mox.ReplayAll()
+
+        poolerdir = tmpdir.join('pgbouncer')
+        ini = db.write_pooler_config({
+            'postgres.pooler.dir': str(poolerdir),
+            'postgres.pooler.port': '6432',
+            'postgres.port': '15432',
+            'omero.db.name': 'omero',
+            'omero.db.host': 'localhost',
+            'omero.db.port': '16432',
+            'omero.db.user': 'omero',
+            'omero.db.pass': 'secret',
+        })
+        assert ini == str(poolerdir.join('pgbouncer.ini'))
+        lines = poolerdir.join('pgbouncer.ini').read().splitlines()
+        assert 'omero = host=localhost port=15432 dbname=omero' in lines
+        assert 'listen_port = 6432' in lines
+        assert 'default_pool_size = 4' in lines
+        userlist = poolerdir.join('userlist.txt')
+        assert userlist.read() == '"omero" "secret"\n'
+        assert userlist.stat().mode & 0o777 == 0o600
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('pooler', [False, True])
+    @pytest.mark.parametrize('limits,headroom', [
+        ('100|3', 67),
+        ('20|5', -15),
+    ])
+    def test_connection_report(self, pooler, limits, headroom):
+        ext = self.mox.CreateMock(external.External)
+        db = self.PartialMockDb(self.Args({'connect_timeout': 10}), ext)
+        self.mox.StubOutWithMock(db, 'psql')
+        self.mox.StubOutWithMock(omero_server_setup.db, 'host_resources')
+        cfg = {}
+        if pooler:
+            cfg['postgres.pooler.dir'] = '/pgbouncer'
+        ext.get_config(raise_missing=False).AndReturn(cfg)
+        if pooler:
+            omero_server_setup.db.host_resources().AndReturn((None, 2))
+        db.psql('-c', mox.Func(lambda q: 'max_connections' in q),
+                connect_timeout=10).AndReturn(limits + '\n')
+        self.mox.ReplayAll()
+
+        report, h = db.connection_report()
+        if pooler:
+            # 4 + 1 server connections
+            headroom += 30 - 5
+        assert h == headroom
+        assert report.endswith('headroom {}'.format(headroom))
+        self.mox.VerifyAll()
+
     def test_psql(self):
         db = self.PartialMockDb(None, None)
         self.mox.StubOutWithMock(db, 'get_db_args_env')
@@ -458,7 +1046,7 @@ class TestDb(object):
         self.mox.StubOutWithMock(db, 'get_db_args_env')
         self.mox.StubOutWithMock(omero_server_setup.db, 'run')
 
-        pgdumpargs = ['-d', 'name', '-h', 'host', '-U', 'user',
+        pgdumpargs = ['-d', 'name', '-h', 'host', '-p', '5432', '-U', 'user',
                       '-w', 'arg1', 'arg2']
         db.get_db_args_env().AndReturn(self.create_db_test_params())
         omero_server_setup.db.run(
@@ -468,3 +1056,18 @@ class TestDb(object):
 
         db.pgdump('arg1', 'arg2')
         self.mox.VerifyAll()
+
+    def test_get_table_stats(self):
+        db = self.PartialMockDb(None, None)
+        self.mox.StubOutWithMock(db, 'psql')
+        db.psql('-c', mox.IsA(str)).AndReturn(
+            'pixels|100|8192|16384\nimage|-1|0|8192\n|120004|0|0\n')
+        self.mox.ReplayAll()
+
+        stats, version = db.get_table_stats()
+        assert stats == {
+            'pixels': {'rows': 100, 'size': 8192, 'totalsize': 16384},
+            'image': {'rows': 0, 'size': 0, 'totalsize': 8192},
+        }
+        assert version == 120004
+        self.mox.VerifyAll()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+import pytest
+
+from omero_server_setup.dumps import (
+    format_dump_index,
+    list_dumps,
+    parse_dump_timestamp,
+    prune_dumps,
+    record_dump,
+    select_dumps_to_keep,
+)
+
+# Wednesday 2026-10-07 to Monday 2026-10-19, two dumps on the 19th
+TIMES = [
+    datetime(2026, 10, 7, 1),
+    datetime(2026, 10, 11, 1),
+    datetime(2026, 10, 12, 1),
+    datetime(2026, 10, 18, 1),
+    datetime(2026, 10, 19, 1),
+    datetime(2026, 10, 19, 13),
+]
+
+
+def _name(t):
+    return t.strftime('omero-database-omero-%Y%m%d-%H%M%S-%f.pgdump')
+
+
+DUMPS = [(t, _name(t)) for t in TIMES]
+
+
+def test_parse_dump_timestamp():
+    assert parse_dump_timestamp(
+        '/dumps/omero-database-omero-20261019-010203-000004.pgdump',
+        'omero') == datetime(2026, 10, 19, 1, 2, 3, 4)
+    assert parse_dump_timestamp(
+        'omero-database-other-20261019-010203-000004.pgdump', 'omero') is None
+    assert parse_dump_timestamp('test.pgdump', 'omero') is None
+
+
+@pytest.mark.parametrize('keep,expected', [
+    ({'keep_last': 2}, [4, 5]),
+    ({'keep_daily': 3}, [2, 3, 5]),
+    ({'keep_weekly': 2}, [3, 5]),
+    ({'keep_last': 1, 'keep_weekly': 3}, [1, 3, 5]),
+    ({}, []),
+])
+def test_select_dumps_to_keep(keep, expected):
+    assert select_dumps_to_keep(DUMPS, **keep) == set(
+        DUMPS[i][1] for i in expected)
+
+
+@pytest.mark.parametrize('recorded', [True, False])
+def test_prune_dumps(tmpdir, recorded):
+    for t, f in DUMPS:
+        tmpdir.join(f).write(f)
+    tmpdir.join('test.pgdump').write('')
+    if recorded:
+        # The newest dump is incomplete so the previous one must be kept
+        for t, f in DUMPS[:-1]:
+            record_dump(str(tmpdir.join(f)), 1.0)
+
+    deleted = prune_dumps(str(tmpdir), 'omero', keep_last=1, jobs=2)
+    remaining = [f for t, f in list_dumps(str(tmpdir), 'omero')]
+    if recorded:
+        assert deleted == [f for t, f in DUMPS[:4]]
+        assert remaining == [DUMPS[4][1], DUMPS[5][1]]
+        lines = format_dump_index(str(tmpdir), 'omero')
+        assert lines[0].startswith(DUMPS[4][1] + '\t50 B\t1.0 s\t')
+        assert lines[1] == DUMPS[5][1] + '\t-\t-\t-'
+    else:
+        assert deleted == []
+        assert len(remaining) == len(DUMPS)
+    assert tmpdir.join('test.pgdump').exists()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from omero_server_setup.estimate import (
+    Classification,
+    estimate_upgrade,
+    format_estimate,
+    split_sql_statements,
+    classify_statement,
+)
+
+
+def test_split_sql_statements():
+    sql = ('\\set ON_ERROR_STOP on\n'
+           '-- comment;\n'
+           "SELECT 'a;b';;\n"
+           '/* block;\n comment */ CREATE FUNCTION f() RETURNS void AS $$\n'
+           'BEGIN; END;\n'
+           '$$ LANGUAGE plpgsql;\n'
+           'UPDATE "x;y" SET é = 1')
+    stmts = split_sql_statements(sql)
+    assert [(s.text, s.line) for s in stmts] == [
+        ('\\set ON_ERROR_STOP on', 1),
+        ("SELECT 'a;b'", 3),
+        ('CREATE FUNCTION f() RETURNS void AS $$\nBEGIN; END;\n'
+         '$$ LANGUAGE plpgsql', 5),
+        ('UPDATE "x;y" SET é = 1', 8),
+    ]
+    encoded = sql.encode()
+    for s in stmts:
+        assert encoded[s.start:s.end].decode() == s.text
+    assert stmts[-1].end == len(encoded)
+
+
+@pytest.mark.parametrize('sql,version,expected', [
+    ('CREATE INDEX i ON public.Pixels (image)', None,
+     ('index', 'pixels', 'SHARE')),
+    ('create unique index concurrently i on "Pixels"(a)', None,
+     ('index', 'Pixels', 'SHARE UPDATE EXCLUSIVE')),
+    ('ALTER TABLE pixels ALTER COLUMN sizex TYPE int8', None,
+     ('rewrite', 'pixels', 'ACCESS EXCLUSIVE')),
+    ('ALTER TABLE pixels ADD CONSTRAINT fk FOREIGN KEY (a) REFERENCES b',
+     None, ('scan', 'pixels', 'SHARE ROW EXCLUSIVE')),
+    ('ALTER TABLE pixels ADD COLUMN a int4 DEFAULT 0', 100000,
+     ('rewrite', 'pixels', 'ACCESS EXCLUSIVE')),
+    ('ALTER TABLE pixels ADD COLUMN a int4 DEFAULT 0', 110000,
+     ('alter', 'pixels', 'ACCESS EXCLUSIVE')),
+    ('ALTER TABLE pixels ADD COLUMN a float8 DEFAULT random()', 110000,
+     ('rewrite', 'pixels', 'ACCESS EXCLUSIVE')),
+    ('ALTER TABLE pixels DROP COLUMN a', None,
+     ('alter', 'pixels', 'ACCESS EXCLUSIVE')),
+    ('UPDATE pixels SET a = 1', None,
+     ('update', 'pixels', 'ROW EXCLUSIVE')),
+    ('UPDATE pixels SET a = 1 WHERE id = 2', None,
+     ('scan', 'pixels', 'ROW EXCLUSIVE')),
+    ('INSERT INTO a (x) SELECT y FROM image', None,
+     ('scan', 'image', 'ROW EXCLUSIVE')),
+    ('SELECT 1', None, ('other', None, None)),
+])
+def test_classify_statement(sql, version, expected):
+    assert classify_statement(sql, version) == Classification(*expected)
+
+
+def test_estimate_upgrade(tmpdir):
+    script = tmpdir.join('OMERO5.1__0.sql')
+    script.write('BEGIN;\n'
+                 'CREATE INDEX i ON pixels (image);\n'
+                 'ALTER TABLE pixels ALTER COLUMN a TYPE int8;\n'
+                 'UPDATE image SET a = 1;\n'
+                 'CREATE TABLE new (id int8);\n'
+                 'COMMIT;\n')
+    stats = {
+        'pixels': {'rows': 1000000, 'size': 400e6, 'totalsize': 600e6},
+        'image': {'rows': 1000, 'size': 300e6, 'totalsize': 300e6},
+    }
+    report = estimate_upgrade([str(script)], stats, 110000)
+
+    assert [(s['kind'], s['line']) for s in report['heaviest']] == [
+        ('rewrite', 3), ('index', 2), ('update', 4)]
+    assert report['locks'] == {
+        'pixels': 'ACCESS EXCLUSIVE', 'image': 'ROW EXCLUSIVE'}
+    assert report['disk'] == 600e6 + 40 * 1000000 + 300e6
+    assert report['seconds'] == pytest.approx(12 + 10 + 10 + 0.006)
+    lines = format_estimate(report)
+    assert lines[0] == 'Estimated duration: 32.0 s'
@@ -22,6 +22,7 @@
 import pytest
 from mox3 import mox
 
+import os
 import subprocess
 import tempfile
 
@@ -44,6 +45,13 @@ class TestRunException(object):
         assert self.ex.fullstr() == s
 
 
+def test_get_config_diff():
+    old = {'a': '1', 'b': '2', 'c': '3'}
+    new = {'a': '1', 'b': '4', 'd': '5'}
+    assert external.get_config_diff(old, new) == {
+        'b': ('2', '4'), 'd': (None, '5')}
+
+
 class TestExternal(object):
 
     def setup_method(self, method):
@@ -58,9 +66,47 @@ class TestExternal(object):
     def test_get_config(self):
         assert False
 
-    @pytest.mark.xfail(reason='Not implemented')
-    def test_update_config(self):
-        assert False
+    def test_get_config_cached(self, tmpdir, monkeypatch):
+        monkeypatch.delenv('OMERO_CONFIG', raising=False)
+        self.ext.dir = str(tmpdir)
+        configxml = tmpdir.ensure('etc', 'grid', 'config.xml')
+        cfg = self.mox.CreateMock(external.ConfigXml)
+        self.mox.StubOutWithMock(external, 'ConfigXml')
+        for n in range(2):
+            external.ConfigXml(
+                str(configxml), read_only=True).AndReturn(cfg)
+            cfg.as_map().AndReturn({'a': str(n)})
+            cfg.close()
+        self.mox.ReplayAll()
+
+        assert self.ext.get_config() == {'a': '0'}
+        self.ext.get_config()['a'] = 'modified'
+        assert self.ext.get_config() == {'a': '0'}
+        configxml.setmtime(configxml.mtime() - 10)
+        assert self.ext.get_config() == {'a': '1'}
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('changed', [True, False])
+    def test_update_config(self, changed):
+        self.ext.dir = '.'
+        current = {'a': '1', 'b': '2'}
+        newcfg = {'a': '1', 'b': '3' if changed else '2'}
+        cfg = self.mox.CreateMock(external.ConfigXml)
+        self.mox.StubOutWithMock(external, 'ConfigXml')
+        if changed:
+            external.ConfigXml(
+                os.path.join('.', 'etc', 'grid', 'config.xml')).AndReturn(cfg)
+            cfg.as_map().AndReturn(current)
+            cfg['b'] = '3'
+            cfg.close()
+        self.mox.ReplayAll()
+
+        diff = self.ext.update_config(newcfg, current=current)
+        if changed:
+            assert diff == {'b': ('2', '3')}
+        else:
+            assert diff == {}
+        self.mox.VerifyAll()
 
     def test_omero_cli(self):
         self.mox.StubOutWithMock(self.ext.cli, 'invoke')
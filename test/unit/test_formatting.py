@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from omero_server_setup.formatting import (
+    format_bytes,
+    format_seconds,
+)
+
+
+@pytest.mark.parametrize('n,expected', [
+    (0, '0 B'),
+    (1023, '1023 B'),
+    (1536, '2 kB'),
+    (5 * 1024 ** 3, '5 GB'),
+    (1.5 * 1024 ** 4, '1.5 TB'),
+])
+def test_format_bytes(n, expected):
+    assert format_bytes(n) == expected
+
+
+@pytest.mark.parametrize('s,expected', [
+    (0.3, '0.3 s'),
+    (59.9, '59.9 s'),
+    (60, '0:01:00'),
+    (3725.5, '1:02:05'),
+])
+def test_format_seconds(s, expected):
+    assert format_seconds(s) == expected
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from omero_server_setup.maintain import (
+    format_maintenance_report,
+    maintenance_commands,
+    order_tables,
+    parse_table_activity,
+)
+
+
+def test_parse_order_tables():
+    tables = parse_table_activity(
+        'image|1000|5|0\npixels|5000|5|2\nsession|100|50|10\nempty|10|0|0\n')
+    assert [t['name'] for t in order_tables(tables)] == [
+        'session', 'pixels', 'image', 'empty']
+    assert tables[1] == {
+        'name': 'pixels', 'size': 5000, 'modified': 5, 'dead': 2}
+
+
+@pytest.mark.parametrize('target,vacuum,expected', [
+    (1, False, ['SET default_statistics_target = 1;', 'ANALYZE "pixels";']),
+    (None, False, ['ANALYZE "pixels";']),
+    (None, True, ['VACUUM (ANALYZE) "pixels";']),
+])
+def test_maintenance_commands(target, vacuum, expected):
+    assert maintenance_commands('pixels', target, vacuum) == expected
+
+
+def test_format_maintenance_report():
+    table = {'name': 'pixels', 'size': 2048}
+    lines = format_maintenance_report([
+        ('1/2 analyze', table, 1.5), ('2/2 analyze', table, 2)])
+    assert lines == [
+        'Stage 1/2 analyze:',
+        '  pixels                                      1.5 s 2 kB',
+        'Stage 2/2 analyze:',
+        '  pixels                                      2.0 s 2 kB',
+    ]
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from omero_server_setup.memory import (
+    allocate_memory,
+    format_heap_size,
+    unconfigured_jvm_roles,
+)
+
+GB = 1024 ** 2
+
+
+def test_format_heap_size():
+    assert format_heap_size(3 * GB + 100) == '3072m'
+
+
+@pytest.mark.parametrize('memory,manage_postgres,expected', [
+    # Small hosts get the minimum heaps
+    (4 * GB, True, {
+        'postgres': 768 * 1024, 'shared_buffers': 384 * 1024,
+        'blitz': 512 * 1024, 'indexer': 512 * 1024,
+        'pixeldata': 512 * 1024}),
+    (40 * GB, False, {
+        'blitz': 6912 * 1024, 'indexer': 4608 * 1024,
+        'pixeldata': 6912 * 1024}),
+    (256 * GB, True, {
+        'postgres': 57.6 * GB, 'shared_buffers': 16 * GB,
+        'blitz': 31 * GB, 'indexer': 21.6 * GB, 'pixeldata': 31 * GB}),
+])
+def test_allocate_memory(memory, manage_postgres, expected):
+    allocation = allocate_memory(memory, manage_postgres)
+    assert allocation == pytest.approx(expected, abs=1024)
+
+
+@pytest.mark.parametrize('cfgmap,expected', [
+    ({}, ['blitz', 'indexer', 'pixeldata']),
+    ({'omero.db.name': 'omero'}, ['blitz', 'indexer', 'pixeldata']),
+    ({'omero.jvmcfg.percent.blitz': '20'}, ['indexer', 'pixeldata']),
+    ({'omero.jvmcfg.strategy.indexer': 'manual',
+      'omero.jvmcfg.heap_size.pixeldata': '2g'}, ['blitz']),
+    ({'omero.jvmcfg.heap_size.repository': '1g'},
+     ['blitz', 'indexer', 'pixeldata']),
+    ({'omero.jvmcfg.strategy': 'percent'}, []),
+    ({'omero.jvmcfg.system_memory': '16000'}, []),
+    ({'omero.jvmcfg.heap_size': '4g'}, []),
+    ({'omero.jvmcfg.percent': '20'}, []),
+])
+def test_unconfigured_jvm_roles(cfgmap, expected):
+    assert unconfigured_jvm_roles(cfgmap) == expected
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from omero_server_setup.pooler import (
+    connection_headroom,
+    format_connection_report,
+    format_pgbouncer_ini,
+    format_userlist,
+    pool_sizes,
+    recommended_pool_size,
+    required_max_connections,
+)
+
+
+@pytest.mark.parametrize('cpus,concurrency,expected', [
+    (2, None, 10),
+    (8, None, 17),
+    (8, 20, 20),
+    (8, 100, 32),
+    (8, 4, 10),
+])
+def test_recommended_pool_size(cpus, concurrency, expected):
+    assert recommended_pool_size(cpus, concurrency) == expected
+
+
+@pytest.mark.parametrize('poolsize,sizes,expected', [
+    (10, None, 100),
+    ('40', None, 133),
+    (40, {'max_db_connections': 10}, 100),
+])
+def test_required_max_connections(poolsize, sizes, expected):
+    assert required_max_connections(poolsize, sizes) == expected
+
+
+def test_connection_headroom():
+    assert connection_headroom(10, 100, 3) == 67
+    assert connection_headroom('40', '100', 3) == -23
+    assert connection_headroom(40, 100, 3, {'max_db_connections': 10}) == 87
+
+
+def test_format_connection_report():
+    assert format_connection_report(17, '133', 3) == (
+        'Database connections: omero.db.poolsize 17 x 3 processes, '
+        'max_connections 133, 3 reserved, headroom 79')
+    assert format_connection_report(
+        17, 100, 3, {'max_db_connections': 10}) == (
+        'Database connections: PgBouncer max_db_connections 10, '
+        'max_connections 100, 3 reserved, headroom 87')
+
+
+@pytest.mark.parametrize('poolsize,cpus,expected', [
+    (10, 1, (2, 1, 3, 50)),
+    (10, 4, (8, 2, 10, 50)),
+    ('50', 64, (50, 12, 62, 170)),
+])
+def test_pool_sizes(poolsize, cpus, expected):
+    sizes = pool_sizes(poolsize, cpus)
+    assert (sizes['default_pool_size'], sizes['reserve_pool_size'],
+            sizes['max_db_connections'], sizes['max_client_conn']) == expected
+
+
+def test_format_userlist():
+    assert format_userlist({'omero': 'a"b', 'b': 'c'}) == (
+        '"b" "c"\n"omero" "a""b"\n')
+
+
+def test_format_pgbouncer_ini():
+    ini = format_pgbouncer_ini(
+        '/pgbouncer', '16432', 'omero', '/pgsocket', '15432',
+        {'default_pool_size': 8}).splitlines()
+    assert ini[:2] == [
+        '[databases]',
+        'omero = host=/pgsocket port=15432 dbname=omero',
+    ]
+    assert 'listen_port = 16432' in ini
+    assert 'pool_mode = transaction' in ini
+    assert 'auth_file = /pgbouncer/userlist.txt' in ini
+    assert ini[-1] == 'default_pool_size = 8'
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+
+from omero_server_setup.postmaster import (
+    PidFileUnreadable,
+    parse_pidfile,
+    process_start_time,
+    read_postmaster_status,
+)
+
+
+def _pidfile(pid, start, socketdir=''):
+    return ('{}\n/data\n{}\n5432\n{}\nlocalhost\n  1234 5678\n'
+            'ready   \n').format(pid, start, socketdir)
+
+
+def test_parse_pidfile():
+    assert parse_pidfile(_pidfile(10, 1700000000, '/tmp')) == {
+        'pid': 10,
+        'datadir': '/data',
+        'start': 1700000000,
+        'port': 5432,
+        'socketdir': '/tmp',
+        'listen': 'localhost',
+        'state': 'ready',
+    }
+    assert parse_pidfile('10\n/data\n') == {
+        'pid': 10,
+        'datadir': '/data',
+        'start': None,
+        'port': None,
+        'socketdir': None,
+        'listen': None,
+        'state': None,
+    }
+
+
+@pytest.mark.parametrize('listening', [True, False])
+def test_read_postmaster_status(tmpdir, listening):
+    # Use this process as the server
+    pid = os.getpid()
+    start = process_start_time(pid)
+    if start is None:
+        pytest.skip('Process start time not available')
+    socketdir = tmpdir.ensure('socket', dir=True)
+    if listening:
+        socketdir.ensure('.s.PGSQL.5432')
+    tmpdir.join('postmaster.pid').write(_pidfile(
+        pid, int(start), str(socketdir)))
+
+    status = read_postmaster_status(str(tmpdir), now=int(start) + 60)
+    assert status == {
+        'running': True,
+        'datadir': str(tmpdir),
+        'pid': pid,
+        'port': 5432,
+        'start': int(start),
+        'uptime': 60,
+        'socketdir': str(socketdir),
+        'state': 'ready',
+        'listening': listening,
+    }
+
+
+@pytest.mark.parametrize('content', [
+    None,
+    '',
+    # PID reused by a process started at a different time
+    _pidfile(os.getpid(), 1000),
+])
+def test_read_postmaster_status_stopped(tmpdir, content):
+    if content is not None:
+        tmpdir.join('postmaster.pid').write(content)
+    if content and process_start_time(os.getpid()) is None:
+        pytest.skip('Process start time not available')
+    assert read_postmaster_status(str(tmpdir)) == {
+        'running': False, 'datadir': str(tmpdir)}
+
+
+def test_read_postmaster_status_unreadable(tmpdir):
+    # A directory can't be opened as a file
+    tmpdir.ensure('postmaster.pid', dir=True)
+    with pytest.raises(PidFileUnreadable):
+        read_postmaster_status(str(tmpdir))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+from omero_server_setup.progress import (
+    UpgradeProgress,
+    match_statement,
+    normalise_query,
+)
+
+
+def test_normalise_query():
+    assert normalise_query(
+        '-- comment\nCREATE  INDEX i\n  ON /* x */ t (a);') == (
+        'CREATE INDEX i ON t (a)')
+
+
+def test_match_statement():
+    normalised = ['BEGIN', 'UPDATE a SET x = 1', 'UPDATE b SET x = 1',
+                  'UPDATE a SET x = 1']
+    assert match_statement(normalised, 'UPDATE a\n SET x = 1') == 1
+    assert match_statement(normalised, 'UPDATE a SET x = 1', 2) == 3
+    assert match_statement(normalised, 'SELECT 1') is None
+
+
+def test_upgrade_progress(tmpdir):
+    scripts = []
+    for n in range(2):
+        script = tmpdir.join('script{}.sql'.format(n))
+        script.write('BEGIN;\nUPDATE a SET x = 1;\n'
+                     'CREATE INDEX i ON a (x);\nCOMMIT;\n')
+        scripts.append(str(script))
+    statusfile = str(tmpdir.join('status.jsonl'))
+    lines = []
+    progress = UpgradeProgress(scripts, statusfile, lines.append)
+
+    progress.script_started(0)
+    progress.script_finished(0)
+    progress.script_started(1)
+    progress.update('CREATE INDEX i ON a (x)', {
+        'phase': 'building index', 'blocks_done': 25, 'blocks_total': 100,
+        'tuples_done': 0, 'tuples_total': 0})
+    progress.update('unknown query')
+
+    assert lines[0].startswith('[1/2] script0.sql statement 0/4 0%')
+    assert lines[1].startswith('[1/2] script0.sql statement 4/4 50%')
+    assert lines[3].startswith('[2/2] script1.sql statement 3/4 ')
+    assert lines[3].endswith(': CREATE INDEX i ON a (x) [building index 25%]')
+    # Unmatched queries leave the progress unchanged
+    assert lines[4].startswith('[2/2] script1.sql statement 3/4 ')
+
+    with open(statusfile) as f:
+        statuses = [json.loads(line) for line in f]
+    assert len(statuses) == 5
+    assert statuses[3]['line'] == 3
+    assert statuses[3]['index']['blocks_done'] == 25
+    assert 50 < statuses[3]['percent'] < 100
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import pytest
+from mox3 import mox
+
+from omero_server_setup import serve
+
+
+@pytest.mark.parametrize('line,rc,stderr', [
+    (b'{"argv": ["status", "--format", "json"]}\n', 0, ''),
+    (b'{"argv": ["pgstop"]}\n', serve.SERVE_INVALID,
+     'Command must be one of: '),
+    (b'{"argv": "status"}\n', serve.SERVE_INVALID, 'Invalid request: '),
+    (b'not json\n', serve.SERVE_INVALID, 'Invalid request: '),
+])
+def test_handle_request(line, rc, stderr):
+    calls = []
+
+    def handler(argv):
+        calls.append(argv)
+        return 0, 'out', ''
+
+    response = serve.handle_request(line, handler)
+    assert response['rc'] == rc
+    assert response['stderr'].startswith(stderr)
+    if rc:
+        assert calls == []
+    else:
+        assert calls == [['status', '--format', 'json']]
+        assert response['stdout'] == 'out'
+
+
+def test_handle_request_exception():
+    def handler(argv):
+        raise KeyError('boom')
+
+    response = serve.handle_request(b'{"argv": ["dump"]}\n', handler)
+    assert response['rc'] == 1
+    assert response['stdout'] == ''
+    assert 'KeyError' in response['stderr']
+
+
+class TestServe(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+
+    def test_request(self, tmpdir):
+        path = str(tmpdir.join('var', serve.SOCKET_NAME))
+        # A stale socket from a daemon that was killed
+        tmpdir.ensure('var', serve.SOCKET_NAME)
+        server = serve.make_server(
+            path, lambda argv: (2, ' '.join(argv), 'err'))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+            assert serve.request(path, ['check', '-v']) == {
+                'rc': 2, 'stdout': 'check -v', 'stderr': 'err'}
+            with pytest.raises(RuntimeError):
+                serve.make_server(path, None)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_request_handler_exception(self, tmpdir):
+        path = str(tmpdir.join(serve.SOCKET_NAME))
+
+        def handler(argv):
+            raise RuntimeError('boom')
+
+        server = serve.make_server(path, handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            response = serve.request(path, ['dump'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        assert response['rc'] == 1
+        assert 'RuntimeError: boom' in response['stderr']
+
+    @pytest.mark.parametrize('error', [
+        FileNotFoundError(2, 'No such file'),
+        ConnectionRefusedError(111, 'Connection refused'),
+    ])
+    def test_main_not_running(self, tmpdir, error):
+        self.mox.StubOutWithMock(serve, 'request')
+        self.mox.StubOutWithMock(serve, 'run_local')
+        serve.request(mox.IgnoreArg(), ['dump']).AndRaise(error)
+        serve.run_local(['dump']).AndReturn(0)
+        self.mox.ReplayAll()
+
+        assert serve.main(['--omerodir', str(tmpdir), 'dump']) == 0
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('error', [
+        serve.RequestError('No response'),
+        PermissionError(13, 'Permission denied'),
+    ])
+    def test_main_failed(self, tmpdir, capsys, error):
+        # The command must not be run again locally
+        self.mox.StubOutWithMock(serve, 'request')
+        self.mox.StubOutWithMock(serve, 'run_local')
+        serve.request(mox.IgnoreArg(), ['dump']).AndRaise(error)
+        self.mox.ReplayAll()
+
+        assert serve.main(
+            ['--omerodir', str(tmpdir), 'dump']) == serve.SERVE_FAILED
+        assert capsys.readouterr().err.startswith('Setup daemon failed: ')
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('command', ['status', 'pgstart'])
+    def test_main_local(self, tmpdir, command):
+        self.mox.StubOutWithMock(serve, 'run_local')
+        serve.run_local([command, '-v']).AndReturn(3)
+        self.mox.ReplayAll()
+
+        assert serve.main(['--omerodir', str(tmpdir), command, '-v']) == 3
+        self.mox.VerifyAll()
+
+    def test_main(self, tmpdir, capsys):
+        self.mox.StubOutWithMock(serve, 'request')
+        serve.request(str(tmpdir.join('var', serve.SOCKET_NAME)), [
+            'check']).AndReturn({'rc': 4, 'stdout': json.dumps({
+                'status': 'no_connection'}) + '\n', 'stderr': ''})
+        self.mox.ReplayAll()
+
+        assert serve.main(['--omerodir', str(tmpdir), 'check']) == 4
+        assert json.loads(capsys.readouterr().out) == {
+            'status': 'no_connection'}
+        self.mox.VerifyAll()
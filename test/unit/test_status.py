@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from omero_server_setup.status import (
+    format_prometheus,
+    parse_status_query,
+)
+
+
+def test_parse_status_query():
+    assert parse_status_query(
+        '{"version" : "OMERO5.4__0", "size" : 1000, "tables" : '
+        '[{"name":"pixels","size":600}, {"name":"image","size":300}]}\n'
+    ) == {
+        'version': 'OMERO5.4__0',
+        'size': 1000,
+        'tables': {'pixels': 600, 'image': 300},
+    }
+
+
+def test_format_prometheus():
+    lines = format_prometheus({
+        'up': True,
+        'latency': 0.05,
+        'version': 'OMERO5.3__0',
+        'latest': 'OMERO5.4__0',
+        'upgrade_needed': True,
+        'size': 1000,
+        'tables': {'pixels': 600, 'a"b': 1},
+        'postgres_running': False,
+    })
+    assert lines[:3] == [
+        '# HELP omero_setup_database_up '
+        'Whether the OMERO database could be queried',
+        '# TYPE omero_setup_database_up gauge',
+        'omero_setup_database_up 1',
+    ]
+    assert 'omero_setup_database_latency_seconds 0.05' in lines
+    assert 'omero_setup_database_upgrade_needed 1' in lines
+    assert 'omero_setup_postgres_running 0' in lines
+    assert ('omero_setup_database_info{latest="OMERO5.4__0",'
+            'version="OMERO5.3__0"} 1') in lines
+    assert lines[-2:] == [
+        'omero_setup_table_size_bytes{table="a\\"b"} 1',
+        'omero_setup_table_size_bytes{table="pixels"} 600',
+    ]
+    assert not any('certificate' in line for line in lines)
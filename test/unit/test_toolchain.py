@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import pytest
+
+from omero_server_setup.toolchain import (
+    discover_toolchain,
+    parse_version,
+    version_num,
+)
+
+
+@pytest.mark.parametrize('out,expected', [
+    ('psql (PostgreSQL) 16.2 (Ubuntu 16.2-1.pgdg22.04+1)', '16.2'),
+    ('pg_dump (PostgreSQL) 9.6.24', '9.6.24'),
+    ('OpenSSL 3.0.2 15 Mar 2022 (Library: OpenSSL 3.0.2 15 Mar 2022)',
+     '3.0.2'),
+    ('pg_ctl (PostgreSQL) 18devel', '18'),
+    ('unknown', None),
+])
+def test_parse_version(out, expected):
+    assert parse_version(out) == expected
+
+
+@pytest.mark.parametrize('version,expected', [
+    ('16.2', 160000), ('18', 180000), ('9.6.24', 90600)])
+def test_version_num(version, expected):
+    assert version_num(version) == expected
+
+
+def _write_tool(bindir, name, version):
+    tool = bindir.join(name)
+    tool.write('#!/bin/sh\necho "{} (PostgreSQL) {}"\n'.format(name, version))
+    os.chmod(str(tool), stat.S_IRWXU)
+    return tool
+
+
+def test_discover_toolchain(tmpdir, monkeypatch):
+    bindir = tmpdir.mkdir('bin')
+    cachefile = str(tmpdir.join('cache', 'toolchain.json'))
+    psql = _write_tool(bindir, 'psql', '16.2')
+    monkeypatch.setenv('PATH', str(bindir))
+
+    toolchain = discover_toolchain(cachefile, ('psql', 'pg_dump'))
+    assert toolchain['psql']['version'] == '16.2'
+    assert toolchain['psql']['bindir'] == str(bindir)
+    assert toolchain['pg_dump'] is None
+    assert tmpdir.join('cache').listdir() == [tmpdir.join(
+        'cache', 'toolchain.json')]
+
+    # Cached: changing the script contents without updating the mtime
+    # isn't detected
+    mtime = os.stat(str(psql)).st_mtime
+    dirmtime = os.stat(str(bindir)).st_mtime
+    psql.write('#!/bin/sh\necho "psql (PostgreSQL) 17.0"\n')
+    os.utime(str(psql), (mtime, mtime))
+    os.utime(str(bindir), (dirmtime, dirmtime))
+    assert discover_toolchain(cachefile, ('psql', 'pg_dump')) == toolchain
+
+    # Adding a program changes the directory mtime
+    _write_tool(bindir, 'pg_dump', '16.2')
+    toolchain = discover_toolchain(cachefile, ('psql', 'pg_dump'))
+    assert toolchain['psql']['version'] == '17.0'
+    assert toolchain['pg_dump']['version'] == '16.2'
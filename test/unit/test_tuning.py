@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from omero_server_setup.tuning import (
+    auto_tuning,
+    cgroup_memory_limit,
+    format_memory,
+    parse_memory,
+    session_options,
+    upgrade_settings,
+)
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('512', 512),
+    ('64kB', 64),
+    ('512MB', 512 * 1024),
+    (' 2 GB ', 2 * 1024 ** 2),
+])
+def test_parse_memory(value, expected):
+    assert parse_memory(value) == expected
+
+
+@pytest.mark.parametrize('v2,v1,expected', [
+    ('max\n', None, None),
+    ('4294967296\n', None, 4 * 1024 ** 2),
+    (None, '9223372036854771712\n', None),
+    (None, '2147483648\n', 2 * 1024 ** 2),
+    (None, None, None),
+])
+def test_cgroup_memory_limit(tmpdir, v2, v1, expected):
+    paths = [str(tmpdir.join('memory.max')),
+             str(tmpdir.join('memory.limit_in_bytes'))]
+    for path, value in zip(paths, (v2, v1)):
+        if value is not None:
+            with open(path, 'w') as f:
+                f.write(value)
+    assert cgroup_memory_limit(paths) == expected
+
+
+@pytest.mark.parametrize('value', ['', '1.5GB', '2gb', '-1MB'])
+def test_parse_memory_invalid(value):
+    with pytest.raises(ValueError):
+        parse_memory(value)
+
+
+def test_format_memory():
+    assert format_memory(2048) == '2MB'
+    assert format_memory(1000) == '1000kB'
+
+
+@pytest.mark.parametrize('memory,cpus,expected', [
+    (None, 1, (None, 0)),
+    (256 * 1024, 2, (64 * 1024, 1)),
+    (16 * 1024 ** 2, 4, (2 * 1024 ** 2, 3)),
+    (1024 ** 4, 64, (8 * 1024 ** 2, 8)),
+])
+def test_auto_tuning(memory, cpus, expected):
+    assert auto_tuning(memory, cpus) == expected
+
+
+def test_upgrade_settings():
+    assert upgrade_settings() == {}
+    settings = upgrade_settings(8 * 1024, 2)
+    assert settings == {
+        'maintenance_work_mem': '8MB',
+        'work_mem': '4MB',
+        'max_parallel_maintenance_workers': '2',
+    }
+    assert session_options(settings) == (
+        '-c maintenance_work_mem=8MB -c max_parallel_maintenance_workers=2 '
+        '-c work_mem=4MB')